@@ -3,6 +3,12 @@
 #include "hardware.h"
 #include <SPI.h>
 
+// Prefixes every sample frame with the sync word and 16-bit little endian frame counter, so that the host can
+// realign the stream after byte loss and detect lost frames (syncWord "a55a" and frameCounter in serial settings)
+// #define SERIAL_FRAMING
+#define SYNC_WORD_0 0xA5
+#define SYNC_WORD_1 0x5A
+
 IntervalTimer statusTimer;
 
 int counter = 0;
@@ -36,6 +42,12 @@ void loop() {
 
   if(Serial.dtr() && dataReady){
       channelData = buff[0] << 8 | buff[1];
+#ifdef SERIAL_FRAMING
+      static uint16_t frameCounter = 0;
+      byte header[4] = {SYNC_WORD_0, SYNC_WORD_1, (byte)(frameCounter & 0xFF), (byte)(frameCounter >> 8)};
+      Serial.write(header, sizeof(header));
+      frameCounter++;
+#endif
       Serial.write(buff, SAMPLE_SIZE);
       dataReady = false;
     }
@@ -1,14 +1,15 @@
+import hashlib
+import os
 from enum import Enum
-from typing import List, Callable, NamedTuple
+from typing import List, Callable, NamedTuple, Dict, Tuple, Iterable
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib import gridspec
 # noinspection PyUnresolvedReferences
 from mpl_toolkits.mplot3d import Axes3D
-from scipy.optimize import fsolve
 
-from localizator.receiver import Receiver
+from localizator.receiver import Receiver, ReceiverArray
 
 
 class MLE(object):
@@ -24,6 +25,29 @@ class MLE(object):
     class InvalidInput(Exception):
         pass
 
+    class MethodResult(NamedTuple):
+        """Batch result of single mode and calculation mode combination, rows correspond to events"""
+        positions: np.ndarray  # (n, 3) chosen roots
+        other_positions: np.ndarray  # (n, 3) remaining roots
+        residuals: np.ndarray  # (n,) HLS objective function value of the chosen root
+        converged: np.ndarray  # (n,) False if iterative solver did not converge for any of the roots
+        degenerate: np.ndarray  # (n,) True if the quadratic coefficient was near-zero
+        plausible: np.ndarray  # (n,) False if none of the roots met the source conditions
+
+    class Geometry(NamedTuple):
+        """Immutable solver state derived from receiver positions. It is built and validated aside and then swapped in
+           as a whole, computations capture it once, so they never see partially updated geometry"""
+        positions: np.ndarray  # (N, 3) receiver positions
+        k: np.ndarray  # (N,) K = xi^2 + yi^2 + zi^2
+        ref_idx: int
+        others: List[int]  # indexes of non-reference receivers
+        pos_matrix: np.ndarray  # -inv(C), C = positions of others relative to the reference receiver
+        version: Tuple[int, int] = (0, 0)  # receiver array version and the reference receiver id
+        grid: object = None  # TDoA lookup grid for these positions and reference, swapped in together with them
+
+    # |a| coefficient of the reference distance quadratic below which the closed form solution is ill-conditioned
+    degenerate_threshold: float = 1e-3
+
     def __init__(self, receivers: List[Receiver], src_conditions:Callable[[np.ndarray], bool] = None,
                  reference_rec_id: int = 0, mode: Mode = Mode.MLE_HLS):
 
@@ -41,137 +65,214 @@ class MLE(object):
 
         self.condition_fun = src_conditions
         self._receivers = receivers
-        self._refRec = receivers[reference_rec_id]
-        self._refRec.is_reference = True
+        self._recArray = ReceiverArray.from_receivers(receivers)
+        self._geometry: MLE.Geometry = None
 
-        self._posMatrix = None  # -inv(C) matrix
-        self._refRec_k = None
         self._estimatedPositions = []
         self._chosenRootIdx = None
         self._mode = mode
+        self._isDegenerate = False
+        self._rootsPlausible = True
+        self._converged = True
 
         self._k_dist_matrix: np.matrix = None
         self._dist_matrix: np.matrix = None
         self._d_ref = None
 
-        self.__setup_constants()
+        self.set_geometry(MLE.build_geometry(self._recArray.positions, reference_rec_id))
 
     @property
     def receivers(self) -> List[Receiver]:
         return self._receivers
 
+    @property
+    def receiver_array(self) -> ReceiverArray:
+        return self._recArray
+
     @property
     def root_idx(self):
         return self._chosenRootIdx
 
+    @property
+    def is_degenerate(self) -> bool:
+        """True if the last computation hit near-zero quadratic coefficient, so the roots are unreliable"""
+        return self._isDegenerate
+
+    @property
+    def roots_plausible(self) -> bool:
+        """False if none of the roots found in the last computation met the source conditions"""
+        return self._rootsPlausible
+
+    @property
+    def converged(self) -> bool:
+        """False if the iterative solver did not converge for any of the roots in the last computation"""
+        return self._converged
+
+    @property
+    def geometry(self) -> 'MLE.Geometry':
+        """Current geometry snapshot, computations running concurrently with set_geometry keep the one they took"""
+        return self._geometry
+
+    @property
+    def ref_idx(self) -> int:
+        return self._geometry.ref_idx
+
     @property
     def ref_rec(self):
-        return self._refRec
+        return self._receivers[self._geometry.ref_idx]
 
     @ref_rec.setter
     def ref_rec(self, ref_idx: int):
-        if len(self._receivers) - 1 < ref_idx < 0:
-            raise MLE.InvalidInput("Reference receiver id of {} is invalid!".format(ref_idx))
-        self.ref_rec.is_reference = False
-        self._refRec = self._receivers[ref_idx]
-        self._refRec.is_reference = True
-        self.__setup_constants()
-
-    def __setup_constants(self) -> None:
+        self.set_geometry(MLE.build_geometry(self._recArray.positions, ref_idx))
 
-        """Initializes constants:
+    @staticmethod
+    def build_geometry(positions: np.ndarray, ref_idx: int = 0) -> 'MLE.Geometry':
+        """Precomputes and validates solver constants for the given receiver positions, without touching any solver:
            position Matrix - C = [x2 - x1, y2 - y1, z2 - z1
                                   x3 - x1, y3 - y1, z3 - z1
                                   x4 - x1, y4 - y1, z4 - z1]
            K = xi^2 + yi^2 + zi^2"""
 
-        self._posMatrix = np.matrix([rec.position - self._refRec.position
-                                    for rec in self._receivers if rec != self._refRec], np.float64)
-        try:
-            self._posMatrix = -np.linalg.inv(self._posMatrix)
+        positions = np.array(positions, np.float64)
+        if positions.shape != (4, 3) or not np.all(np.isfinite(positions)):
+            raise MLE.InvalidInput("4 finite receiver positions required, got {}".format(positions.tolist()))
+        if not 0 <= ref_idx < len(positions):
+            raise MLE.InvalidInput("Reference receiver id of {} is invalid!".format(ref_idx))
 
+        others = [idx for idx in range(len(positions)) if idx != ref_idx]
+        try:
+            pos_matrix = -np.linalg.inv(positions[others] - positions[ref_idx])
         except np.linalg.LinAlgError:
             raise MLE.InvalidInput("The receiver positions create singular matrix, which cannot be inversed")
 
-        self._refRec_k = self._refRec.calc_k()
+        positions.setflags(write=False)
+        pos_matrix.setflags(write=False)
+        k = np.sum(positions ** 2, axis=1)
+        k.setflags(write=False)
+        return MLE.Geometry(positions, k, ref_idx, others, pos_matrix)
+
+    def set_geometry(self, geometry: 'MLE.Geometry') -> None:
+        """Swaps the geometry snapshot in at once. Receivers follow the new positions, computations in progress finish
+           on the snapshot they started with"""
 
-    def __apply_hls_of(self) -> np.ndarray:
+        if len(geometry.positions) != len(self._receivers):
+            raise MLE.InvalidInput("Geometry of {} receivers does not match {} receivers"
+                                   .format(len(geometry.positions), len(self._receivers)))
+
+        if not np.array_equal(geometry.positions, self._recArray.positions):
+            self._recArray._replace(geometry.positions)
+        for idx, rec in enumerate(self._receivers):
+            rec.is_reference = idx == geometry.ref_idx
+        self._geometry = geometry._replace(version=(self._recArray.version, geometry.ref_idx))
+
+    def __apply_hls_of(self, geometry: 'MLE.Geometry', roots_converged: np.ndarray) -> np.ndarray:
         """Evaluates OF function for src positions returned by MLE equation, solution with
-           lowest OF value is returned"""
+           lowest OF value is returned. Roots the solver did not converge to never meet the source conditions"""
 
-        src_positions = [self.__calc_src(D).flatten() for D in self._d_ref]
+        src_positions = [self.__calc_src(geometry, D).flatten() for D in self._d_ref]
         #src_positions = np.around(src_positions, 2)
         of_solutions = np.array([0.0, 0.0], np.float64)
-        d = [np.linalg.norm(rec.position - src_pos) for rec in self._receivers for src_pos in src_positions]
-        d = [d[0::2], d[1::2]]
-
-        if Receiver.isSimulation:
-            for i in range(1, len(self.receivers)):
-                self.receivers[i].tDoA = np.around(self.receivers[i]._received_time - self.receivers[0]._received_time,
-                                                   Receiver.decimal_num)
+        # d[root][receiver] - distance between receiver and the source position of given root
+        d = [[np.linalg.norm(pos - src_pos) for pos in geometry.positions] for src_pos in src_positions]
+        ref = geometry.ref_idx
 
-        for i in range(1, len(self._receivers)):
-            of_solutions[0] += (d[0][i] - d[0][0] - self.receivers[i].tDoA * Receiver.c) ** 2
-            of_solutions[1] += (d[1][i] - d[1][0] - self.receivers[i].tDoA * Receiver.c) ** 2
+        for i, idx in enumerate(geometry.others):
+            of_solutions[0] += (d[0][idx] - d[0][ref] - self._dist_matrix[i, 0]) ** 2
+            of_solutions[1] += (d[1][idx] - d[1][ref] - self._dist_matrix[i, 0]) ** 2
 
         self._estimatedPositions = src_positions
         self._chosenRootIdx = np.argmin(of_solutions)
 
+        user_cond_met = [bool(converged) for converged in roots_converged]
         if self.condition_fun is not None:
-            user_cond_met = [self.condition_fun(np.array(res[0]).flatten()) for res in self._estimatedPositions]
-            if user_cond_met[0] != user_cond_met[1]:
-                self._chosenRootIdx = np.argwhere(user_cond_met)
+            user_cond_met = [met and self.condition_fun(np.array(res[0]).flatten())
+                             for met, res in zip(user_cond_met, self._estimatedPositions)]
+        self._rootsPlausible = any(user_cond_met)
+        if user_cond_met[0] != user_cond_met[1]:
+            self._chosenRootIdx = np.argwhere(user_cond_met)
 
         return src_positions[int(self._chosenRootIdx)]
 
-    def __calc_src(self, d: np.float64) -> np.ndarray:
+    def __calc_src(self, geometry: 'MLE.Geometry', d: np.float64) -> np.ndarray:
         """Applies the matrix equation for source coordinates, assuming known d - distance between the reference
            receiver(usually 1) and the source"""
 
-        return np.matmul(self._posMatrix, (self._dist_matrix * d + self._k_dist_matrix))
-
-    def __mle_distance_equation(self, d: np.float64) -> np.float64:
-        """Realizes 4-th equation for d - distance between the reference receiver and the source,
-           utilized in the equation solver to provide next steps for further iterations"""
-
-        src = self.__calc_src(d)
-        x_s, y_s, z_s = src[0], src[1], src[2]
-        ref_pos = self._refRec.position
-
-        return -d ** 2 + x_s ** 2 + y_s ** 2 + z_s ** 2 - 2 * x_s * ref_pos[0] - 2 * y_s * ref_pos[1] \
-               - 2 * z_s * ref_pos[2] + self._refRec_k
+        return np.matmul(np.matrix(geometry.pos_matrix), (self._dist_matrix * d + self._k_dist_matrix))
+
+    def calculate(self, calc_mode: CalcMode = CalcMode.MLE_COMPUTATION,
+                  geometry: 'MLE.Geometry' = None, tdoa: np.ndarray = None) -> np.ndarray:
+        """Performs all the calculations for the source position, returns best guess of the source location (x,y,z).
+           tdoa is (N-1,) vector of TDoAs(in seconds) of non-reference receivers to the reference one, taken from the
+           receivers (see receiver_tdoa) when not given. The current geometry snapshot is used, unless one is given"""
+
+        self._isDegenerate = False
+        self._rootsPlausible = True
+        self._converged = True
+        if geometry is None:
+            geometry = self._geometry
+        if tdoa is None:
+            tdoa = self.receiver_tdoa(geometry)
+        ref_pos = geometry.positions[geometry.ref_idx]
+        ref_k = geometry.k[geometry.ref_idx]
+        pos_matrix = np.matrix(geometry.pos_matrix)
 
-    def calculate(self, calc_mode: CalcMode = CalcMode.MLE_COMPUTATION) -> np.ndarray:
-        """Performs all the calculations for the source position, returns best guess of the source location (x,y,z)"""
+        # V matrix
+        self._dist_matrix = np.asarray(tdoa, np.float64).reshape(-1, 1) * Receiver.c
 
         # R matrix
-        self._k_dist_matrix = 0.5 * np.array([[rec.dist(self._refRec) ** 2 - rec.calc_k() + self._refRec_k]
-                                              for rec in self._receivers if rec != self._refRec], np.float64)
+        self._k_dist_matrix = 0.5 * (self._dist_matrix ** 2 - geometry.k[geometry.others][:, np.newaxis] + ref_k)
+        n_mat = np.matmul(pos_matrix, self._dist_matrix)
+        r_mat = np.matmul(pos_matrix, self._k_dist_matrix)
+        a = np.matmul(np.transpose(n_mat), n_mat) - 1
+        b = 2 * (np.matmul(np.transpose(n_mat), r_mat) -
+                 np.transpose(n_mat) * np.transpose(np.matrix(ref_pos)))
+        c = -2 * np.matmul(np.matrix(ref_pos), r_mat) + \
+            np.matmul(np.transpose(r_mat), r_mat) + ref_k
 
-        # V matrix
-        self._dist_matrix = np.array([[rec.dist(self._refRec)] for rec in self._receivers if rec != self._refRec],
-                                     np.float64)
         if calc_mode == MLE.CalcMode.MLE_SOLVER:
-            self._d_ref = fsolve(lambda d: self.__mle_distance_equation(d), np.array([-40, 40]))
+            roots, converged = MLE.solve_reference_distance(np.asarray(a).flatten(), np.asarray(b).flatten(),
+                                                            np.asarray(c).flatten())
+            self._d_ref = list(roots[0])
+            roots_converged = converged[0]
+            self._converged = bool(np.all(roots_converged))
         else:
-            n_mat = np.matmul(self._posMatrix, self._dist_matrix)
-            r_mat = np.matmul(self._posMatrix, self._k_dist_matrix)
-            a = np.matmul(np.transpose(n_mat), n_mat) - 1
-            b = 2 * (np.matmul(np.transpose(n_mat), r_mat) -
-                     np.transpose(n_mat) * np.transpose(np.matrix(self._refRec.position)))
-            c = -2 * np.matmul(np.matrix(self._refRec.position), r_mat) + \
-                np.matmul(np.transpose(r_mat), r_mat) + self._refRec_k
-
             delta_sqr = np.sqrt(np.abs(b ** 2 - 4 * a * c))
             self._d_ref = [(-b - delta_sqr) / (2 * a), (-b + delta_sqr) / (2 * a)]
+            roots_converged = np.ones(2, bool)
+        # near-zero a makes the equation ill-conditioned for both ways of solving it
+        self._isDegenerate = bool(np.abs(a) < MLE.degenerate_threshold)
+        self._rootsPlausible = bool(np.any(roots_converged))
 
         if self._mode == self.Mode.MLE_HLS:
-            return self.__apply_hls_of()
+            return self.__apply_hls_of(geometry, roots_converged)
 
         elif self._mode == self.Mode.MLE_PLUS:
-            return self.__calc_src(np.float64(max(self._d_ref))).flatten()
+            return self.__calc_src(geometry, np.float64(max(self._d_ref))).flatten()
 
-        return self.__calc_src(np.float64(min(self._d_ref))).flatten()
+        return self.__calc_src(geometry, np.float64(min(self._d_ref))).flatten()
+
+    def receiver_tdoa(self, geometry: 'MLE.Geometry' = None) -> np.ndarray:
+        """Returns (N-1,) vector of TDoAs(in seconds) of non-reference receivers to the reference one of the geometry.
+           Simulated TDoAs are computed from the snapshot positions, measured ones are read from the receivers"""
+
+        if geometry is None:
+            geometry = self._geometry
+        if Receiver.isSimulation:
+            src_position = np.array([Receiver.get_source_position()], np.float64)
+            return MLE.simulated_tdoa(src_position, geometry)[0, geometry.others]
+
+        tdoa = np.array([rec.tDoA for rec in self._receivers], np.float64)
+        return tdoa[geometry.others] - tdoa[geometry.ref_idx]
+
+    @staticmethod
+    def simulated_tdoa(src_positions: np.ndarray, geometry: 'MLE.Geometry') -> np.ndarray:
+        """Returns (n, N) array of TDoAs(in seconds) of all receivers to the reference one for (n, 3) simulated source
+           positions, with the same rounding as simulated receivers use"""
+
+        received_time = np.linalg.norm(src_positions[:, np.newaxis, :] - geometry.positions[np.newaxis, :, :],
+                                       axis=2) / Receiver.c
+        ref_time = received_time[:, [geometry.ref_idx]]
+        return np.around((received_time - ref_time) * Receiver.c, Receiver.decimal_num) / Receiver.c
 
     def get_other_solution(self) -> np.ndarray:
         """Returns remaining solution of MLE equation"""
@@ -180,6 +281,133 @@ class MLE(object):
             return self._estimatedPositions[1]
         return self._estimatedPositions[0]
 
+    def calculate_ensemble(self, tdoa: np.ndarray,
+                           modes: Iterable[Mode] = tuple(Mode),
+                           calc_modes: Iterable[CalcMode] = tuple(CalcMode),
+                           geometry: 'MLE.Geometry' = None) -> Dict[Tuple[Mode, CalcMode], MethodResult]:
+        """Evaluates all requested mode and calculation mode combinations for a batch of events at once.
+           tdoa is (n, N-1) array of TDoAs(in seconds) of non-reference receivers (in receivers order) to the reference
+           one. The geometry and the quadratic coefficients are shared by all the methods, roots are computed once per
+           calculation mode. The current geometry snapshot is used, unless one is given"""
+
+        tdoa = np.atleast_2d(np.asarray(tdoa, np.float64))
+        if geometry is None:
+            geometry = self._geometry
+        n_mat, r_mat, a, b, c = self._batch_coefficients(tdoa, geometry)
+
+        results = {}
+        for calc_mode in calc_modes:
+            if calc_mode == MLE.CalcMode.MLE_SOLVER:
+                d_roots, roots_converged = MLE.solve_reference_distance(a, b, c)
+            else:
+                d_roots = self._batch_roots(a, b, c)
+                roots_converged = np.ones((len(tdoa), 2), bool)
+            converged = np.all(roots_converged, axis=1)
+            degenerate = np.abs(a) < MLE.degenerate_threshold
+
+            # (n, 2, 3) source positions for both roots
+            candidates = n_mat[:, np.newaxis, :] * d_roots[:, :, np.newaxis] + r_mat[:, np.newaxis, :]
+            residuals = self._batch_hls_of(candidates, tdoa, geometry)
+            if self.condition_fun is not None:
+                cond_met = np.array([[self.condition_fun(src) for src in event] for event in candidates], bool)
+            else:
+                cond_met = np.ones((len(tdoa), 2), bool)
+            # roots the solver did not converge to can not be the source
+            cond_met &= roots_converged
+
+            for mode in modes:
+                chosen = self._batch_choose(mode, d_roots, residuals, cond_met)
+                rows = np.arange(len(tdoa))
+                results[(mode, calc_mode)] = MLE.MethodResult(candidates[rows, chosen],
+                                                              candidates[rows, 1 - chosen],
+                                                              residuals[rows, chosen],
+                                                              converged,
+                                                              degenerate,
+                                                              np.any(cond_met, axis=1))
+        return results
+
+    def calculate_batch(self, tdoa: np.ndarray, calc_mode: CalcMode = CalcMode.MLE_COMPUTATION,
+                        geometry: 'MLE.Geometry' = None) -> MethodResult:
+        """Batch counterpart of calculate for (n, N-1) array of TDoAs(in seconds), uses mode of the instance"""
+
+        return self.calculate_ensemble(tdoa, (self._mode,), (calc_mode,), geometry)[(self._mode, calc_mode)]
+
+    @staticmethod
+    def _batch_coefficients(tdoa: np.ndarray, geometry: 'MLE.Geometry') -> Tuple[np.ndarray, ...]:
+        """Computes N = -inv(C)V and R' = -inv(C)R for every event as well as a, b, c coefficients of the quadratic
+           equation for the reference distance"""
+
+        ref_pos = geometry.positions[geometry.ref_idx]
+        ref_k = geometry.k[geometry.ref_idx]
+        k_others = geometry.k[geometry.others]
+        pos_matrix = geometry.pos_matrix
+
+        v = tdoa * Receiver.c
+        r = 0.5 * (v ** 2 - k_others + ref_k)
+        n_mat = v @ pos_matrix.T
+        r_mat = r @ pos_matrix.T
+
+        a = np.sum(n_mat * n_mat, axis=1) - 1
+        b = 2 * (np.sum(n_mat * r_mat, axis=1) - n_mat @ ref_pos)
+        c = -2 * r_mat @ ref_pos + np.sum(r_mat * r_mat, axis=1) + ref_k
+        return n_mat, r_mat, a, b, c
+
+    @staticmethod
+    def solve_reference_distance(a: np.ndarray, b: np.ndarray, c: np.ndarray,
+                                 initial_guess: Tuple[float, float] = (-40.0, 40.0),
+                                 max_iter: int = 100, tol: float = 1e-12) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized Newton solver of the reference distance equation a*d^2 + b*d + c = 0 for many events at once,
+           started from both initial guesses. Derivative is known analytically, number of iterations is bounded.
+           Returns (n, 2) array of roots and (n, 2) array of convergence flags"""
+
+        a = np.asarray(a, np.float64)[:, np.newaxis]
+        b = np.asarray(b, np.float64)[:, np.newaxis]
+        c = np.asarray(c, np.float64)[:, np.newaxis]
+        d = np.tile(np.array(initial_guess, np.float64), (len(a), 1))
+        converged = np.zeros(d.shape, bool)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(max_iter):
+                f = (a * d + b) * d + c
+                df = 2 * a * d + b
+                step = np.where((df != 0) & ~converged, f / df, 0.0)
+                d = d - step
+                converged |= (np.abs(step) <= tol * (1 + np.abs(d))) & (df != 0)
+                if converged.all():
+                    break
+
+        converged &= np.isfinite(d)
+        return d, converged
+
+    @staticmethod
+    def _batch_roots(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+        """Returns (n, 2) array of reference distance roots of the quadratic equation"""
+
+        delta_sqr = np.sqrt(np.abs(b ** 2 - 4 * a * c))
+        return np.stack(((-b - delta_sqr) / (2 * a), (-b + delta_sqr) / (2 * a)), axis=1)
+
+    @staticmethod
+    def _batch_hls_of(candidates: np.ndarray, tdoa: np.ndarray, geometry: 'MLE.Geometry') -> np.ndarray:
+        """Evaluates HLS objective function for (n, 2, 3) candidate positions, returns (n, 2) array"""
+
+        dist = np.linalg.norm(candidates[:, :, np.newaxis, :] - geometry.positions, axis=3)
+        range_diff = dist[:, :, geometry.others] - dist[:, :, [geometry.ref_idx]]
+        return np.sum((range_diff - tdoa[:, np.newaxis, :] * Receiver.c) ** 2, axis=2)
+
+    @staticmethod
+    def _batch_choose(mode: Mode, d_roots: np.ndarray, residuals: np.ndarray, cond_met: np.ndarray) -> np.ndarray:
+        """Returns index of the chosen root for every event, following the same rules as calculate"""
+
+        if mode == MLE.Mode.MLE_PLUS:
+            return np.argmax(d_roots, axis=1)
+        if mode == MLE.Mode.MLE_MINUS:
+            return np.argmin(d_roots, axis=1)
+
+        chosen = np.argmin(residuals, axis=1)
+        single = cond_met[:, 0] != cond_met[:, 1]
+        chosen[single] = np.argmax(cond_met[single], axis=1)
+        return chosen
+
 
 class PerformanceTest(object):
     """Setups the performance test for localization algorithm. Sources are placed inside a cuboid of dimensions:
@@ -189,7 +417,14 @@ class PerformanceTest(object):
        One can choose between MLE- or MLE+ solution or get one chosen by HLS function.
        If all_roots are set to true, the simulation takes into account both solutions.
        Additionally computation mode can be chosen: either using iterative solver, or by solving quadratic equation
-       manually"""
+       manually.
+
+       If cache_dir is given, localization errors are persisted there, one file per x-plane in a directory keyed by
+       hash of receiver positions and modes, so interrupted sweeps resume from the last finished plane and
+       overlapping grids reuse points computed before. Complete sweeps are stored under hash of the ranges as well"""
+
+    class InvalidInput(Exception):
+        pass
 
     class Range(NamedTuple):
         start: float
@@ -212,14 +447,18 @@ class PerformanceTest(object):
                  spacing_precision=-1,
                  all_roots: bool = False,
                  mle_mode: MLE.Mode = MLE.Mode.MLE_HLS,
-                 mle_calc_mode: MLE.CalcMode = MLE.CalcMode.MLE_COMPUTATION):
+                 mle_calc_mode: MLE.CalcMode = MLE.CalcMode.MLE_COMPUTATION,
+                 cache_dir: str = None):
 
-        self.xRange, self.yRange, self.zRange = x_range, y_range, z_range
+        self.xRange, self.yRange, self.zRange = (PerformanceTest.Range(*rng) for rng in (x_range, y_range, z_range))
         self.spacing_precision = spacing_precision
+        self.rec_positions = np.array(rec_positions, np.float64)
+        self.cache_dir = cache_dir
 
         receivers = [Receiver(*rec_pos) for rec_pos in rec_positions]
 
         self.localizer = MLE(receivers, mode=mle_mode)
+        self.mle_mode = mle_mode
         self.mle_calc_mode = mle_calc_mode
 
         self.gAccuracy = []  # err <= 0.05
@@ -231,20 +470,125 @@ class PerformanceTest(object):
         self.captions = []
         self.percentage = 0.0
 
+        # raw localization error of every grid point, (x, y, z) indexed, filled by execute
+        self.errors: np.ndarray = None
+
+    @property
+    def config_key(self) -> str:
+        """Hash of everything the error of single point depends on"""
+
+        digest = hashlib.sha1(np.round(self.rec_positions, 9).tobytes())
+        digest.update("{}|{}|{}".format(self.mle_mode.name, self.mle_calc_mode.name, self.allRoots).encode())
+        return digest.hexdigest()[:16]
+
+    @property
+    def sweep_key(self) -> str:
+        """Hash of the configuration and the swept ranges"""
+
+        digest = hashlib.sha1(self.config_key.encode())
+        digest.update(repr((tuple(self.xRange), tuple(self.yRange), tuple(self.zRange),
+                            self.spacing_precision)).encode())
+        return digest.hexdigest()[:16]
+
+    def grid(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return tuple(rng.expand_to_pts(precision=self.spacing_precision) for rng in (self.xRange, self.yRange,
+                                                                                      self.zRange))
+
     def execute(self) -> None:
         """Performs the actual simulation in the cuboid"""
 
-        for xPos in self.xRange.expand_to_pts(precision=self.spacing_precision):
-            # change X pos
-            print(xPos)
-            for yPos in self.yRange.expand_to_pts(precision=self.spacing_precision):
-                # change Y pos
-                for zPos in self.zRange.expand_to_pts(precision=self.spacing_precision):
-                    # change Z pos
-                    self.setup_source_position(xPos, yPos, zPos)
-                    pos = self.localizer.calculate(self.mle_calc_mode)
-                    # print(pos)
-                    self.asses_accuracy(pos)
+        x_pts, y_pts, z_pts = self.grid()
+        self.errors = self._load_sweep()
+        if self.errors is None:
+            self.errors = np.full((len(x_pts), len(y_pts), len(z_pts)), np.nan)
+
+            for x_idx, xPos in enumerate(x_pts):
+                # change X pos
+                print(xPos)
+                plane = self._load_plane(xPos)
+                computed = False
+                for y_idx, yPos in enumerate(y_pts):
+                    # change Y pos
+                    for z_idx, zPos in enumerate(z_pts):
+                        # change Z pos
+                        key = PerformanceTest._point_key(yPos, zPos)
+                        if key not in plane:
+                            plane[key] = self.point_error(xPos, yPos, zPos)
+                            computed = True
+                        self.errors[x_idx, y_idx, z_idx] = plane[key]
+                if computed:
+                    self._save_plane(xPos, plane)
+
+            self._save_sweep()
+
+        for x_idx, y_idx, z_idx in np.ndindex(*self.errors.shape):
+            self.classify((x_pts[x_idx], y_pts[y_idx], z_pts[z_idx]), self.errors[x_idx, y_idx, z_idx])
+
+    def point_error(self, x_pos: float, y_pos: float, z_pos: float) -> float:
+        """Simulates the source at the given position and returns localization error"""
+
+        self.setup_source_position(x_pos, y_pos, z_pos)
+        pos = self.localizer.calculate(self.mle_calc_mode)
+        return self.localization_error(pos)
+
+    @staticmethod
+    def _point_key(y_pos: float, z_pos: float) -> Tuple[float, float]:
+        return round(float(y_pos), 9), round(float(z_pos), 9)
+
+    def _config_dir(self) -> str:
+        return os.path.join(self.cache_dir, self.config_key)
+
+    def _plane_path(self, x_pos: float) -> str:
+        return os.path.join(self._config_dir(), "x_{:.9f}.npz".format(float(x_pos)))
+
+    def _load_plane(self, x_pos: float) -> Dict[Tuple[float, float], float]:
+        """Errors of all points of the x-plane computed by any previous sweep of the same configuration"""
+
+        if self.cache_dir is None or not os.path.exists(self._plane_path(x_pos)):
+            return {}
+        with np.load(self._plane_path(x_pos)) as data:
+            return {PerformanceTest._point_key(y, z): err for (y, z), err in zip(data["points"], data["errors"])}
+
+    def _save_plane(self, x_pos: float, plane: Dict[Tuple[float, float], float]) -> None:
+        if self.cache_dir is None:
+            return
+        PerformanceTest._save_atomic(self._plane_path(x_pos), points=np.array(list(plane.keys()), np.float64),
+                                     errors=np.array(list(plane.values()), np.float64))
+
+    def _sweep_path(self) -> str:
+        return os.path.join(self._config_dir(), "sweep_{}.npz".format(self.sweep_key))
+
+    def _load_sweep(self) -> np.ndarray:
+        if self.cache_dir is None or not os.path.exists(self._sweep_path()):
+            return None
+        with np.load(self._sweep_path()) as data:
+            return data["errors"]
+
+    def _save_sweep(self) -> None:
+        if self.cache_dir is not None:
+            self.export_errors(self._sweep_path())
+
+    @staticmethod
+    def _save_atomic(path: str, **arrays: np.ndarray) -> None:
+        """Writes npz file under temporary name first, so that a crash never leaves a truncated file behind"""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, path)
+
+    def export_errors(self, path: str) -> None:
+        """Saves raw per-point errors together with grid axes, receiver positions and modes into npz file"""
+
+        if self.errors is None:
+            raise PerformanceTest.InvalidInput("No results to export, execute the test first")
+
+        x_pts, y_pts, z_pts = self.grid()
+        PerformanceTest._save_atomic(path, errors=self.errors, x=x_pts, y=y_pts, z=z_pts,
+                                     receivers=self.rec_positions, mle_mode=np.array(self.mle_mode.name),
+                                     mle_calc_mode=np.array(self.mle_calc_mode.name),
+                                     all_roots=np.array(self.allRoots))
 
     def setup_source_position(self, x_pos: float, y_pos: float, z_pos: float) -> None:
         """Places source in new location, specified by arguments, and simulates the sound propagation"""
@@ -254,9 +598,8 @@ class PerformanceTest(object):
         for rec in self.localizer.receivers:
             rec.receive()
 
-    def asses_accuracy(self, calc_src_position: np.ndarray) -> None:
-        """Computes the accuracy of the position obtained with algorithm and qualifies it into several tiers:
-           good, medium, poor, bad"""
+    def localization_error(self, calc_src_position: np.ndarray) -> float:
+        """Distance between the position obtained with algorithm and the simulated source"""
 
         actual_pos = Receiver.get_source_position()
         err = np.linalg.norm(calc_src_position - actual_pos)
@@ -264,6 +607,16 @@ class PerformanceTest(object):
         if self.allRoots:
             err2 = np.linalg.norm(self.localizer.get_other_solution() - actual_pos)
             err = min(err, err2)
+        return float(err)
+
+    def asses_accuracy(self, calc_src_position: np.ndarray) -> None:
+        """Computes the accuracy of the position obtained with algorithm and qualifies it into several tiers:
+           good, medium, poor, bad"""
+
+        self.classify(Receiver.get_source_position(), self.localization_error(calc_src_position))
+
+    def classify(self, actual_pos: Iterable[float], err: float) -> None:
+        """Qualifies error of the source at actual_pos into accuracy tier"""
 
         if err <= 0.05:
             self.gAccuracy.append(tuple(actual_pos))
@@ -1,13 +1,22 @@
 from enum import Enum
-from typing import Tuple, List, Callable
+from typing import Tuple, List, Callable, Dict, Hashable
 
 from twisted.internet.protocol import ReconnectingClientFactory
 from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 import json
 import threading
+import numpy as np
 from localizator.receiver import Receiver
-from localizator.MLE import MLE
+from localizator.MLE import MLE, PerformanceTest
+
+
+class InvalidRequest(Exception):
+    pass
 
 
 class Messages:
@@ -40,6 +49,38 @@ class Messages:
         }
         return json.dumps(msg).encode('utf-8')
 
+    @staticmethod
+    def batch_result(batch_id, offset: int, results: List[List[np.ndarray]]):
+        msg = {
+            "type": "SimulateBatchResult",
+            "batchId": batch_id,
+            "offset": offset,
+            "results": [{
+                "roots": [{"pos": {"x": float(root[0]), "y": float(root[1]), "z": float(root[2])}}
+                          for root in roots[:2]],
+                "chosenRootId": 0
+            } for roots in results]
+        }
+        return json.dumps(msg).encode('utf-8')
+
+    @staticmethod
+    def progress(batch_id, done: int, total: int):
+        msg = {
+            "type": "Progress",
+            "batchId": batch_id,
+            "done": done,
+            "total": total
+        }
+        return json.dumps(msg).encode('utf-8')
+
+    @staticmethod
+    def stats(stats: dict):
+        msg = {
+            "type": "Stats",
+            "stats": stats
+        }
+        return json.dumps(msg).encode('utf-8')
+
     @staticmethod
     def error(err_msg: str):
         msg = {
@@ -49,6 +90,82 @@ class Messages:
         return json.dumps(msg).encode("utf-8")
 
 
+class Dispatcher(object):
+    """Runs CPU bound message handlers in a thread pool instead of the reactor thread, so that a slow request does not
+       stall pings and other messages. Every client gets its own semaphore limiting the number of its requests
+       executed at once, the rest waits in the queue, so a long batch of one client does not hold back requests of
+       the others. Results are delivered back in the reactor thread through the returned Deferred. Requests of one
+       client are expected to run in order (settings before simulations), which the default limit of 1 ensures"""
+
+    def __init__(self, pool_size: int = 4, max_concurrent_per_client: int = 1):
+        self.pool_size = pool_size
+        self.max_concurrent_per_client = max_concurrent_per_client
+        self._pool = ThreadPool(minthreads=0, maxthreads=pool_size, name="localizator-dispatcher")
+        self._semaphores: Dict[Hashable, DeferredSemaphore] = {}
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if not self._pool.started:
+            self._pool.start()
+            reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self) -> None:
+        if self._pool.started:
+            self._pool.stop()
+
+    def dispatch(self, client: Hashable, handler: Callable, *args, **kwargs) -> Deferred:
+        """Queues handler call on behalf of the client, returned Deferred fires in the reactor thread"""
+
+        self.start()
+        semaphore = self._semaphores.get(client)
+        if semaphore is None:
+            semaphore = self._semaphores[client] = DeferredSemaphore(self.max_concurrent_per_client)
+
+        self.queued += 1
+
+        def run(_):
+            self.queued -= 1
+            self.in_flight += 1
+            return deferToThreadPool(reactor, self._pool, handler, *args, **kwargs)
+
+        def finish(result):
+            self.in_flight -= 1
+            if isinstance(result, Failure):
+                self.failed += 1
+            else:
+                self.completed += 1
+            semaphore.release()
+            return result
+
+        deferred = semaphore.acquire()
+        deferred.addCallback(run)
+        deferred.addBoth(finish)
+        return deferred
+
+    def forget(self, client: Hashable) -> None:
+        """Drops the semaphore of disconnected client, requests already queued are still executed"""
+
+        self._semaphores.pop(client, None)
+
+    @property
+    def clients(self) -> List[Hashable]:
+        return list(self._semaphores)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "inFlight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "poolSize": self.pool_size,
+            "clients": len(self._semaphores)
+        }
+
+
 server = "10.128.99.64"  # Server IP Address or domain eg: tabvn.com
 port = 8081  # Server Port
 
@@ -57,8 +174,15 @@ class App:
 
     onSettings: Callable[[List[Tuple[float, float, float]], int], None] = None
     onSimulate: Callable[[Tuple[float, float, float]], List[Tuple[float, float, float]]] = None
+    # vectorized simulation of (n, 3) sources, returns both roots of every source
+    onSimulateBatch: Callable[[np.ndarray], List[List[np.ndarray]]] = None
+    batch_chunk_size: int = 256
+    max_batch_size: int = 100000
     on_settings_req: Callable[[], None] = None
     on_result_ready: Callable[[], None] = None
+    dispatcher: Dispatcher = Dispatcher()
+    # report of the memory profiler of the worker, included in stats if set
+    memory_stats: Callable[[], dict] = None
 
 
 class AppProtocol(WebSocketClientProtocol):
@@ -82,13 +206,32 @@ class AppProtocol(WebSocketClientProtocol):
             except KeyError as ex:
                 print("Message: {0}\nis invalid!".format(msg))
                 self.sendMessage(Messages.error("Invalid Message !"))
-            except MLE.InvalidInput as ex:
+            except (MLE.InvalidInput, InvalidRequest) as ex:
                 print(str(ex))
                 self.sendMessage(Messages.error(str(ex)))
 
 
     def onClose(self, wasClean, code, reason):
         print("Connect closed {0}".format(reason))
+        for client in App.dispatcher.clients:
+            if client[0] is self:
+                App.dispatcher.forget(client)
+
+    def dispatch(self, obj: dict, handler: Callable, *args) -> Deferred:
+        """The worker has a single connection to the webserver, requests are told apart by the id of the originating
+           client, which the server adds to every forwarded request. Requests without it share one key"""
+
+        return App.dispatcher.dispatch((self, obj.get("clientId")), handler, *args)
+
+    def on_handler_failed(self, failure) -> None:
+        """Reports errors of handlers executed by the dispatcher, in the same way onMessage does for inline ones"""
+
+        if failure.check(KeyError):
+            print("Handler failed on invalid message")
+            self.sendMessage(Messages.error("Invalid Message !"))
+        else:
+            print(failure.getErrorMessage())
+            self.sendMessage(Messages.error(failure.getErrorMessage()))
 
     def decode_message(self, msg: str):
         obj = json.loads(msg)
@@ -97,8 +240,20 @@ class AppProtocol(WebSocketClientProtocol):
             pos = (src["pos"]["x"], src["pos"]["y"], src["pos"]["z"])
             print(pos)
             if App.onSimulate:
-                res = App.onSimulate(pos)
-                self.sendMessage(Messages.result(res[0], res[1], 0))
+                deferred = self.dispatch(obj, App.onSimulate, pos)
+                deferred.addCallback(lambda res: self.sendMessage(Messages.result(res[0], res[1], 0)))
+                deferred.addErrback(self.on_handler_failed)
+
+        elif obj["type"] == "SimulateBatch":
+            sources = self.decode_batch_sources(obj)
+            batch_id = obj.get("batchId", 0)
+            chunk_size = int(obj.get("chunkSize", App.batch_chunk_size))
+            if chunk_size <= 0:
+                raise InvalidRequest("Chunk size must be positive, got {}".format(chunk_size))
+
+            if App.onSimulateBatch:
+                deferred = self.dispatch(obj, self.simulate_batch, batch_id, sources, chunk_size)
+                deferred.addErrback(self.on_batch_failed, batch_id)
 
         elif obj["type"] == "Settings":
             rec_settings = obj["receivers"]
@@ -110,7 +265,56 @@ class AppProtocol(WebSocketClientProtocol):
                     ref_idx = idx
 
             if App.onSettings:
-                App.onSettings(positions, ref_idx)
+                deferred = self.dispatch(obj, App.onSettings, positions, ref_idx)
+                deferred.addErrback(self.on_handler_failed)
+
+        elif obj["type"] == "GetStats":
+            stats = {"dispatcher": App.dispatcher.stats}
+            if App.memory_stats:
+                stats["memory"] = App.memory_stats()
+            self.sendMessage(Messages.stats(stats))
+
+        elif obj["type"] == "ClientClosed":
+            App.dispatcher.forget((self, obj["clientId"]))
+
+    @staticmethod
+    def decode_batch_sources(obj: dict) -> np.ndarray:
+        """Returns (n, 3) source positions of SimulateBatch message, given either as a list of sources or as a grid
+           spec with start, stop and step for each axis"""
+
+        if "sources" in obj:
+            sources = np.array([(src["pos"]["x"], src["pos"]["y"], src["pos"]["z"]) for src in obj["sources"]],
+                               np.float64).reshape(-1, 3)
+        else:
+            grid = obj["grid"]
+            axes = []
+            for axis in ("x", "y", "z"):
+                axis_range = PerformanceTest.Range(grid[axis]["start"], grid[axis]["stop"], grid[axis]["step"])
+                if axis_range.step <= 0:
+                    raise InvalidRequest("Grid step of {} axis must be positive".format(axis))
+                axes.append(axis_range.expand_to_pts())
+            sources = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        if len(sources) > App.max_batch_size:
+            raise InvalidRequest("Batch of {} sources exceeds the limit of {}".format(len(sources),
+                                                                                    App.max_batch_size))
+        return sources
+
+    def simulate_batch(self, batch_id, sources: np.ndarray, chunk_size: int) -> None:
+        """Runs in a worker thread, results and progress of every chunk are sent from the reactor thread"""
+
+        for offset in range(0, len(sources), chunk_size):
+            results = App.onSimulateBatch(sources[offset: offset + chunk_size])
+            done = min(offset + chunk_size, len(sources))
+            reactor.callFromThread(self.sendMessage, Messages.batch_result(batch_id, offset, results), False)
+            reactor.callFromThread(self.sendMessage, Messages.progress(batch_id, done, len(sources)), False)
+
+        if len(sources) == 0:
+            reactor.callFromThread(self.sendMessage, Messages.progress(batch_id, 0, 0), False)
+
+    def on_batch_failed(self, failure, batch_id) -> None:
+        print("Batch {} failed: {}".format(batch_id, failure.getErrorMessage()))
+        self.sendMessage(Messages.error("Batch {} failed: {}".format(batch_id, failure.getErrorMessage())))
 
 
 class AppFactory(WebSocketClientFactory, ReconnectingClientFactory):
@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import queue
+import time
+from typing import NamedTuple, Dict, Optional
+
+import numpy as np
+
+
+class DebugRenderer(object):
+    """Renders debug snapshots in a background process, so that debug mode does not stall real-time localization.
+       The hot path only submits snapshots (small arrays like event windows, GCC histograms or envelopes), which are
+       rate limited per kind and put to a bounded queue without waiting. Snapshots exceeding the rate or arriving at
+       full queue are dropped and counted. The renderer process draws them headlessly (Agg) into PNG files and
+       optionally stores the raw arrays as NPZ files next to them"""
+
+    class InvalidInput(Exception):
+        pass
+
+    class Snapshot(NamedTuple):
+        kind: str  # "tdoa" or "history", selects the drawing routine
+        name: str  # base name of the written files
+        arrays: Dict[str, np.ndarray]
+
+    # long signal histories are expensive to render, by default one per 30 s is taken
+    default_rates = {"history": 1.0 / 30}
+
+    def __init__(self, output_dir: str = "debug", max_rate: float = 2.0, queue_size: int = 16,
+                 save_png: bool = True, save_npz: bool = True, rates: Dict[str, float] = None):
+        self.rates = dict(DebugRenderer.default_rates)
+        self.rates.update(rates or {})
+        if max_rate <= 0 or queue_size <= 0 or min(self.rates.values()) <= 0:
+            raise DebugRenderer.InvalidInput("Rate limits and queue size must be positive")
+
+        self.output_dir = output_dir
+        self.max_rate = max_rate
+        self.queue_size = queue_size
+        self.save_png = save_png
+        self.save_npz = save_npz
+
+        self._queue: Optional[multiprocessing.Queue] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self._last_submit: Dict[str, float] = {}
+        self._counter = 0
+
+        self.submitted = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._queue = multiprocessing.Queue(self.queue_size)
+        self._process = multiprocessing.Process(target=_render_loop, name="debug-renderer", daemon=True,
+                                                args=(self._queue, self.output_dir, self.save_png, self.save_npz))
+        self._process.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Renders snapshots still waiting in the queue and terminates the renderer process"""
+
+        if self._process is None:
+            return
+
+        try:
+            self._queue.put(None, timeout=timeout)
+            self._process.join(timeout)
+        except queue.Full:
+            pass
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self._queue = None
+
+    def ready(self, kind: str) -> bool:
+        """True if snapshot of the given kind would pass the rate limit, so that the caller can skip gathering its
+           arrays otherwise. False result is counted as rate limited snapshot"""
+
+        if self._queue is None:
+            return False
+        if time.monotonic() - self._last_submit.get(kind, -np.inf) < 1.0 / self.rates.get(kind, self.max_rate):
+            self.rate_limited += 1
+            return False
+        return True
+
+    def submit(self, kind: str, force: bool = False, **arrays: np.ndarray) -> bool:
+        """Enqueues snapshot of the given kind without blocking, returns False if it was dropped. Forced snapshots
+           (e.g. the final history) bypass the rate limit, but not the queue bound"""
+
+        if self._queue is None:
+            return False
+
+        if not force and not self.ready(kind):
+            return False
+
+        self._counter += 1
+        snapshot = DebugRenderer.Snapshot(kind, "{}_{:06d}".format(kind, self._counter),
+                                          {key: np.asarray(value) for key, value in arrays.items()})
+        try:
+            self._queue.put_nowait(snapshot)
+        except queue.Full:
+            self.queue_full += 1
+            return False
+
+        self._last_submit[kind] = time.monotonic()
+        self.submitted += 1
+        return True
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "rateLimited": self.rate_limited,
+            "queueFull": self.queue_full
+        }
+
+
+def _render_loop(snapshots: multiprocessing.Queue, output_dir: str, save_png: bool, save_npz: bool) -> None:
+    # figures are drawn on Agg canvases directly, pyplot state and GUI backends are never touched
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+
+        path = os.path.join(output_dir, snapshot.name)
+        try:
+            if save_npz:
+                np.savez_compressed(path + ".npz", **snapshot.arrays)
+            if save_png:
+                figure = Figure(figsize=(18, 10))
+                FigureCanvasAgg(figure)
+                _renderers[snapshot.kind](figure, **snapshot.arrays)
+                figure.savefig(path + ".png")
+        except Exception as ex:
+            print("Rendering of {} failed: {}".format(snapshot.name, ex))
+
+
+def _render_tdoa(figure, windows: np.ndarray, histograms: np.ndarray = None, delays: np.ndarray = None,
+                 interpolation: int = 1) -> None:
+    """Event windows of all receivers compared with the reference one, GCC histograms with estimated delays"""
+
+    pairs = len(windows) - 1
+    columns = 1 if histograms is None else 2
+    for pair_idx in range(pairs):
+        ax = figure.add_subplot(pairs, columns, pair_idx * columns + 1)
+        ax.plot(windows[0], label="mic_1")
+        ax.plot(windows[pair_idx + 1], label="mic_{}".format(pair_idx + 2))
+        ax.legend()
+
+        if histograms is not None:
+            ax = figure.add_subplot(pairs, columns, pair_idx * columns + 2)
+            lags = (np.arange(histograms.shape[-1]) - histograms.shape[-1] // 2) / int(interpolation)
+            ax.plot(lags, histograms[pair_idx])
+            if delays is not None:
+                ax.axvline(x=delays[pair_idx], color="r")
+    figure.axes[-columns].set_xlabel("Sample number")
+    figure.tight_layout()
+
+
+def _render_history(figure, signal: np.ndarray, envelope: np.ndarray = None, events: np.ndarray = None,
+                    thresholds: np.ndarray = None, time_offset: int = 0) -> None:
+    """Signal of the strongest channel with detector envelope, thresholds and detected events"""
+
+    ax = figure.add_subplot(1, 1, 1)
+    time_axis = np.arange(len(signal)) + int(time_offset)
+    ax.plot(time_axis, signal, 'b.-')
+    if thresholds is not None:
+        for threshold in thresholds:
+            ax.axhline(y=threshold)
+    if events is not None:
+        for start_idx, end_idx in events:
+            ax.axvspan(start_idx, end_idx, facecolor='#2ca02c', alpha=0.5)
+    if envelope is not None and len(envelope) > 0:
+        ax.plot(time_axis[-len(envelope):], envelope[-len(time_axis):], 'r')
+    ax.set_xlabel("Sample number", fontsize=20)
+    ax.set_ylabel("ADC value", fontsize=20)
+    figure.tight_layout(rect=[0.02, 0.03, 1, 0.95])
+
+
+_renderers = {
+    "tdoa": _render_tdoa,
+    "history": _render_history
+}
@@ -14,8 +14,12 @@ class DFT:
         self._frequencies = np.linspace(0, self._samplingRate, self._size)
 
     def transform(self, signal: np.ndarray) -> np.ndarray:
-        if len(signal) < self._size:
-            signal = np.pad(signal, mode="constant", pad_width=(self._size - len(signal), 0))
+        """Transforms the signal, or each row of 2-D array of signals. Shorter signals are zero padded at front"""
+
+        signal = np.asarray(signal)
+        if signal.shape[-1] < self._size:
+            pad_width = [(0, 0)] * (signal.ndim - 1) + [(self._size - signal.shape[-1], 0)]
+            signal = np.pad(signal, mode="constant", pad_width=pad_width)
 
         return np.fft.rfft(signal * self._window)
 
@@ -32,9 +36,9 @@ class DFT:
         return self.get_spectrum(dft)
 
     def inverse_transform(self, fft_transform: np.ndarray, padding_factor: int = 1) -> np.ndarray:
-        if len(fft_transform) != self._dtfSize:
+        if fft_transform.shape[-1] != self._dtfSize:
             raise self.InvalidSignalLength("Invalid dft length: {}, should be: {}"
-                                           .format(len(fft_transform), self._dtfSize))
+                                           .format(fft_transform.shape[-1], self._dtfSize))
 
         result = np.fft.irfft(fft_transform, n=padding_factor * self._size)
         # result[0] = 0  # Bit Questionable is it ?
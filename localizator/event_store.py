@@ -0,0 +1,212 @@
+import os
+import time
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+
+class EventStore(object):
+    """Append-only columnar log of localization results. Events are kept as structured arrays written in blocks of
+       block_size rows into separate .npy files, which are memory mapped on queries, so only the touched pages are
+       read. A sparse index holds time range and bounding box of chosen positions of every block, blocks outside of
+       the queried range or box are skipped without opening them. Within a block rows are in time order, so the time
+       range is found by binary search.
+
+       Results carry timestamps relative to the start of their localization session, they are stored shifted by the
+       time base set by begin_session, so that sessions appended to the same store keep the time order"""
+
+    class InvalidInput(Exception):
+        pass
+
+    index_dtype = np.dtype([("t_min", np.float64), ("t_max", np.float64), ("box_min", np.float64, (3,)),
+                            ("box_max", np.float64, (3,)), ("count", np.int64), ("block", np.int64)])
+
+    @staticmethod
+    def event_dtype(rec_nr: int) -> np.dtype:
+        return np.dtype([("timestamp", np.float64),
+                         ("sample_idx", np.int64),
+                         ("roots", np.float64, (2, 3)),
+                         ("root_idx", np.int8),
+                         ("position", np.float64, (3,)),  # the chosen root
+                         ("tdoa", np.float64, (rec_nr,)),
+                         ("confidence", np.float32),
+                         ("gated", np.bool_)])
+
+    def __init__(self, path: str, rec_nr: int = 4, block_size: int = 4096):
+        if block_size <= 0:
+            raise EventStore.InvalidInput("Block size must be positive")
+
+        self.path = path
+        self.block_size = block_size
+        self.dtype = EventStore.event_dtype(rec_nr)
+        os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, "index.npy")
+        self._index = np.load(index_path) if os.path.exists(index_path) else np.zeros(0, EventStore.index_dtype)
+        if len(self._index) > 0 and self._open_block(self._index[0]["block"]).dtype != self.dtype:
+            raise EventStore.InvalidInput("Store {} holds events of different receiver number".format(path))
+
+        self._buffer = np.zeros(block_size, self.dtype)
+        self._buffered = 0
+        # added to timestamps of appended results
+        self.time_base = 0.0
+
+    def __len__(self) -> int:
+        return int(np.sum(self._index["count"])) + self._buffered
+
+    def begin_session(self, start_time: float = None) -> float:
+        """Sets the time base of results appended from now on, the current epoch time by default. The base never
+           precedes the last stored event, so that sessions processed faster than real time (wav replays) do not
+           overlap. Returns the time base"""
+
+        start_time = time.time() if start_time is None else start_time
+        stored = self.time_range()
+        self.time_base = start_time if stored is None else max(start_time, stored[1])
+        return self.time_base
+
+    def append(self, result) -> None:
+        """Appends SensorMatrix.LocalizationResult, so the store can be used directly as the on_result callback"""
+
+        roots = np.asarray(result.roots, np.float64).reshape(2, 3)
+        self.append_event(self.time_base + result.timestamp, result.start_idx, roots, result.root_idx, result.tdoa,
+                          result.weight, result.gated)
+
+    def append_event(self, timestamp: float, sample_idx: int, roots: np.ndarray, root_idx: int, tdoa: np.ndarray,
+                     confidence: float = 1.0, gated: bool = False) -> None:
+        last = self._buffer[self._buffered - 1]["timestamp"] if self._buffered > 0 else \
+            (self._index["t_max"][-1] if len(self._index) > 0 else -np.inf)
+        if timestamp < last:
+            raise EventStore.InvalidInput("Events must be appended in time order")
+
+        row = self._buffer[self._buffered]
+        row["timestamp"] = timestamp
+        row["sample_idx"] = sample_idx
+        row["roots"] = roots
+        row["root_idx"] = root_idx
+        row["position"] = row["roots"][root_idx]
+        row["tdoa"] = tdoa
+        row["confidence"] = confidence
+        row["gated"] = gated
+        self._buffered += 1
+
+        if self._buffered == self.block_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes buffered events as a new block, partial blocks are written as well"""
+
+        if self._buffered == 0:
+            return
+
+        events = self._buffer[:self._buffered]
+        block = int(self._index["block"].max()) + 1 if len(self._index) > 0 else 0
+        # the block is complete before the index refers to it
+        EventStore._save_atomic(self._block_path(block), events)
+
+        entry = np.zeros(1, EventStore.index_dtype)
+        entry["t_min"] = events["timestamp"][0]
+        entry["t_max"] = events["timestamp"][-1]
+        with np.errstate(invalid="ignore"):
+            entry["box_min"] = np.nanmin(events["position"], axis=0)
+            entry["box_max"] = np.nanmax(events["position"], axis=0)
+        entry["count"] = len(events)
+        entry["block"] = block
+        self._index = np.concatenate((self._index, entry))
+
+        # the index is replaced at once, so readers never see a partially written one
+        EventStore._save_atomic(os.path.join(self.path, "index.npy"), self._index)
+
+        self._buffered = 0
+
+    @staticmethod
+    def _save_atomic(path: str, array: np.ndarray) -> None:
+        """Writes npy file under temporary name first, so that a crash never leaves a truncated file behind"""
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, array)
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def query(self, t_start: float = None, t_end: float = None,
+              box: Tuple[Tuple[float, float, float], Tuple[float, float, float]] = None,
+              include_gated: bool = True) -> np.ndarray:
+        """Returns structured array of events with t_start <= timestamp < t_end, whose chosen position lies within
+           box (min corner, max corner). Unset bounds are not applied, unflushed events are included"""
+
+        t_start = -np.inf if t_start is None else t_start
+        t_end = np.inf if t_end is None else t_end
+        box_min, box_max = (np.full(3, -np.inf), np.full(3, np.inf)) if box is None else \
+            (np.asarray(box[0], np.float64), np.asarray(box[1], np.float64))
+
+        candidates = self._index[(self._index["t_max"] >= t_start) & (self._index["t_min"] < t_end) &
+                                 np.all(self._index["box_max"] >= box_min, axis=1) &
+                                 np.all(self._index["box_min"] <= box_max, axis=1)]
+
+        parts: List[np.ndarray] = []
+        for entry in candidates:
+            parts.append(self._select(self._open_block(entry["block"]), t_start, t_end, box_min, box_max))
+        parts.append(self._select(self._buffer[:self._buffered], t_start, t_end, box_min, box_max))
+
+        events = np.concatenate(parts)
+        if not include_gated:
+            events = events[~events["gated"]]
+        return events
+
+    @staticmethod
+    def _select(events: np.ndarray, t_start: float, t_end: float, box_min: np.ndarray,
+                box_max: np.ndarray) -> np.ndarray:
+        timestamps = events["timestamp"]
+        l_idx = np.searchsorted(timestamps, t_start, side="left")
+        h_idx = np.searchsorted(timestamps, t_end, side="left")
+        events = events[l_idx: h_idx]
+
+        positions = events["position"]
+        in_box = np.all((positions >= box_min) & (positions <= box_max), axis=1)
+        return np.array(events[in_box])
+
+    def _block_path(self, block: int) -> str:
+        return os.path.join(self.path, "block_{:06d}.npy".format(block))
+
+    def _open_block(self, block: int) -> np.ndarray:
+        return np.load(self._block_path(int(block)), mmap_mode="r")
+
+    def time_range(self) -> Optional[Tuple[float, float]]:
+        """Timestamps of the first and the last stored event, None for empty store"""
+
+        first = [self._index["t_min"].min()] if len(self._index) > 0 else []
+        last = [self._index["t_max"].max()] if len(self._index) > 0 else []
+        if self._buffered > 0:
+            first.append(self._buffer[0]["timestamp"])
+            last.append(self._buffer[self._buffered - 1]["timestamp"])
+        if len(first) == 0:
+            return None
+        return float(min(first)), float(max(last))
+
+
+def __test_event_store():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        rng = np.random.RandomState(0)
+        roots = rng.uniform(0, 2, (1000, 2, 3))
+        with EventStore(path, 4, block_size=128) as store:
+            for idx in range(1000):
+                store.append_event(idx * 0.1, idx * 4410, roots[idx], idx % 2, np.zeros(4), 0.5, False)
+
+        store = EventStore(path, 4, block_size=128)
+        events = store.query(10.0, 20.0, box=((0, 0, 0), (1, 1, 1)))
+        positions = roots[np.arange(1000), np.arange(1000) % 2]
+        expected = [idx for idx in range(100, 200) if np.all(positions[idx] <= 1)]
+        assert np.array_equal(events["sample_idx"], np.array(expected) * 4410)
+        print(len(store), store.time_range(), len(events))
+
+# __test_event_store()
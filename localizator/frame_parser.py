@@ -0,0 +1,163 @@
+from typing import Optional
+
+import numpy as np
+
+
+class FrameParser(object):
+    """Streaming parser of the serial sample stream. Bytes of incomplete frames are carried over to the next read, so
+       short reads never misalign channels. If the driver is built with SERIAL_FRAMING, every frame starts with the
+       sync word followed by 16-bit little endian frame counter. Frame boundaries are then verified for whole reads at
+       once, after a corrupted frame the parser scans for the next sync word confirmed by the following frame and
+       continues from there. Dropped bytes, resynchronizations and frames lost according to the counter are counted
+       in stats"""
+
+    class InvalidInput(Exception):
+        pass
+
+    default_sync_word = b"\xA5\x5A"
+
+    def __init__(self, channel_nr: int = 4, sample_size: int = 2, sync_word: Optional[bytes] = None,
+                 frame_counter: bool = False):
+
+        if frame_counter and not sync_word:
+            raise FrameParser.InvalidInput("Frame counter requires the sync word to locate frame headers")
+
+        self.sync_word = bytes(sync_word) if sync_word else b""
+        self.frame_counter = frame_counter
+        self.header_size = len(self.sync_word) + (2 if frame_counter else 0)
+        self.payload_size = channel_nr * sample_size
+        self.frame_size = self.header_size + self.payload_size
+
+        self._sync = np.frombuffer(self.sync_word, np.uint8)
+        self._carry = b""
+        self._last_counter: Optional[int] = None
+
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self.lost_frames = 0
+        self.gaps = 0
+
+    def reset(self) -> None:
+        self._carry = b""
+        self._last_counter = None
+
+    def feed(self, data: bytes) -> bytes:
+        """Consumes bytes read from the serial port and returns payload of all complete, valid frames"""
+
+        buffer = np.frombuffer(self._carry + data, np.uint8)
+        if len(self._sync) == 0:
+            count = len(buffer) // self.frame_size
+            self._carry = buffer[count * self.frame_size:].tobytes()
+            self.frames += count
+            return buffer[:count * self.frame_size].tobytes()
+
+        payloads = []
+        pos = 0
+        while True:
+            count = (len(buffer) - pos) // self.frame_size
+            if count == 0:
+                break
+
+            frames = buffer[pos: pos + count * self.frame_size].reshape(count, self.frame_size)
+            synced = np.all(frames[:, :len(self._sync)] == self._sync, axis=1)
+
+            # a frame is accepted only if the next one starts with the sync word as well, so that a frame missing some
+            # bytes is not taken, the last frame waits for the next read if its successor is not complete yet
+            next_start = pos + count * self.frame_size
+            if next_start + len(self._sync) <= len(buffer):
+                next_synced = bool(np.all(buffer[next_start: next_start + len(self._sync)] == self._sync))
+            else:
+                next_synced = None
+            confirmed = synced & np.append(synced[1:], next_synced is True)
+            invalid = np.flatnonzero(~confirmed)
+            valid = count if len(invalid) == 0 else int(invalid[0])
+
+            if valid > 0:
+                self._count_frames(frames[:valid])
+                payloads.append(frames[:valid, self.header_size:])
+                pos += valid * self.frame_size
+            if valid == count or (valid == count - 1 and synced[-1] and next_synced is None):
+                break
+
+            next_pos = self._find_sync(buffer, pos + 1)
+            self.dropped_bytes += next_pos - pos
+            pos = next_pos
+            if pos + self.frame_size > len(buffer):
+                break
+            self.resyncs += 1
+
+        self._carry = buffer[pos:].tobytes()
+        if len(payloads) == 0:
+            return b""
+        return np.concatenate(payloads).tobytes()
+
+    def _find_sync(self, buffer: np.ndarray, start: int) -> int:
+        """Returns position of the first sync word after start, which is confirmed by the sync word of the next frame
+           or which can not be confirmed yet. Without any candidate, the tail which may hold its beginning is kept"""
+
+        sync_len = len(self._sync)
+        if len(buffer) - start < sync_len:
+            return max(start, len(buffer) - sync_len + 1)
+
+        windows = np.lib.stride_tricks.sliding_window_view(buffer[start:], sync_len)
+        candidates = np.flatnonzero(np.all(windows == self._sync, axis=1)) + start
+        if len(candidates) == 0:
+            return len(buffer) - sync_len + 1
+
+        following = candidates + self.frame_size
+        complete = following + sync_len <= len(buffer)
+        confirmed = np.zeros(len(candidates), np.bool_)
+        confirmed[complete] = np.all(buffer[following[complete, np.newaxis] + np.arange(sync_len)] == self._sync,
+                                     axis=1)
+        return int(candidates[np.flatnonzero(confirmed | ~complete)[0]]) if np.any(confirmed | ~complete) \
+            else len(buffer) - sync_len + 1
+
+    def _count_frames(self, frames: np.ndarray) -> None:
+        self.frames += len(frames)
+        if not self.frame_counter:
+            return
+
+        offset = len(self._sync)
+        counters = frames[:, offset].astype(np.int64) | (frames[:, offset + 1].astype(np.int64) << 8)
+        if self._last_counter is not None:
+            counters = np.concatenate(([self._last_counter], counters))
+
+        missing = (np.diff(counters) - 1) % 65536
+        self.lost_frames += int(np.sum(missing))
+        self.gaps += int(np.count_nonzero(missing))
+        self._last_counter = int(counters[-1])
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "droppedBytes": self.dropped_bytes,
+            "resyncs": self.resyncs,
+            "lostFrames": self.lost_frames,
+            "gaps": self.gaps
+        }
+
+
+def __test_frame_parser():
+    rng = np.random.RandomState(0)
+    parser = FrameParser(4, 2, FrameParser.default_sync_word, frame_counter=True)
+    samples = rng.randint(-32768, 32767, (1000, 4)).astype("<i2")
+    counters = np.arange(1000, dtype="<u2")
+    frames = [parser.default_sync_word + counter.tobytes() + sample.tobytes() for counter, sample in
+              zip(counters, samples)]
+
+    # frame 300 loses a byte, frames 500-509 are lost completely
+    frames[300] = frames[300][:5] + frames[300][6:]
+    stream = b"".join(frames[:500] + frames[510:])
+
+    payload = b""
+    for start in range(0, len(stream), 777):
+        payload += parser.feed(stream[start: start + 777])
+
+    # the last frame is held back until the sync word of its successor arrives
+    expected = np.concatenate((samples[:300], samples[301:500], samples[510:-1]))
+    assert np.array_equal(np.frombuffer(payload, "<i2").reshape(-1, 4), expected)
+    print(parser.stats)
+
+# __test_frame_parser()
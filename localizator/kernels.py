@@ -0,0 +1,312 @@
+from enum import Enum
+from typing import Tuple
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class Backend(Enum):
+    NUMPY = 0
+    NUMBA = 1
+    AUTO = 2
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+_backend: Backend = Backend.NUMPY
+_compiled = {}
+
+
+def _envelope_hysteresis_ref(signal: np.ndarray, data_offset: int, envelope: float, release_factor: float,
+                             upper_threshold: float, lower_threshold: float, is_above: bool,
+                             start_idx: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float, bool, int]:
+    """Reference implementation of peak envelope follower with hysteresis thresholds. Returns envelope values for
+       samples from data_offset on, start and end indexes of detected events and the final state of the follower"""
+
+    envelopes = np.empty(max(len(signal) - data_offset, 0), np.float64)
+    starts, ends = [], []
+
+    for idx in range(data_offset, len(signal)):
+        envelope *= release_factor
+        envelope = max(abs(float(signal[idx])), envelope)
+        envelopes[idx - data_offset] = envelope
+
+        if envelope > upper_threshold and not is_above:
+            is_above = True
+            start_idx = idx
+
+        elif envelope <= lower_threshold and is_above:
+            is_above = False
+            starts.append(start_idx)
+            ends.append(idx)
+            start_idx = -1
+
+    return envelopes, np.array(starts, np.int64), np.array(ends, np.int64), envelope, is_above, start_idx
+
+
+def _envelope_hysteresis_multi_ref(signals: np.ndarray, data_offset: int, envelope: np.ndarray, release_factor: float,
+                                   upper_threshold: np.ndarray, lower_threshold: np.ndarray, is_above: np.ndarray,
+                                   start_idx: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Reference implementation of the multi-channel envelope follower, each row of signals is processed with its own
+       state and thresholds. Returns (channels, n) envelopes, channel, start and end indexes of detected events and
+       the final state of all followers"""
+
+    results = [_envelope_hysteresis_ref(signals[ch], data_offset, float(envelope[ch]), release_factor,
+                                        float(upper_threshold[ch]), float(lower_threshold[ch]), bool(is_above[ch]),
+                                        int(start_idx[ch])) for ch in range(len(signals))]
+
+    envelopes = np.array([res[0] for res in results], np.float64).reshape(len(signals), -1)
+    channels = np.concatenate([np.full(len(res[1]), ch, np.int64) for ch, res in enumerate(results)] +
+                              [np.empty(0, np.int64)])
+    starts = np.concatenate([res[1] for res in results] + [np.empty(0, np.int64)])
+    ends = np.concatenate([res[2] for res in results] + [np.empty(0, np.int64)])
+    return (envelopes, channels, starts, ends, np.array([res[3] for res in results], np.float64),
+            np.array([res[4] for res in results], np.bool_), np.array([res[5] for res in results], np.int64))
+
+
+def _running_mean_ref(x: np.ndarray, n: int) -> np.ndarray:
+    cumsum = np.cumsum(np.insert(x, 0, 0))
+    return (cumsum[n:] - cumsum[:-n]) / float(n)
+
+
+def _noise_gate_ref(signal: np.ndarray, threshold: float, window: int) -> np.ndarray:
+    result = np.array(signal)
+    tmp = _running_mean_ref(np.abs(signal), window)
+    result[:len(tmp)][tmp <= threshold] = 0
+    return result
+
+
+def _envelope_hysteresis_nb(signal, data_offset, envelope, release_factor, upper_threshold, lower_threshold,
+                            is_above, start_idx):
+    n = max(len(signal) - data_offset, 0)
+    envelopes = np.empty(n, np.float64)
+    starts = np.empty(n, np.int64)
+    ends = np.empty(n, np.int64)
+    count = 0
+
+    for idx in range(data_offset, len(signal)):
+        envelope *= release_factor
+        sample = abs(np.float64(signal[idx]))
+        if sample >= envelope:
+            envelope = sample
+        envelopes[idx - data_offset] = envelope
+
+        if envelope > upper_threshold and not is_above:
+            is_above = True
+            start_idx = idx
+
+        elif envelope <= lower_threshold and is_above:
+            is_above = False
+            starts[count] = start_idx
+            ends[count] = idx
+            count += 1
+            start_idx = -1
+
+    return envelopes, starts[:count].copy(), ends[:count].copy(), envelope, is_above, start_idx
+
+
+def _envelope_hysteresis_multi_nb(signals, data_offset, envelope, release_factor, upper_threshold, lower_threshold,
+                                  is_above, start_idx):
+    ch_nr, length = signals.shape
+    n = max(length - data_offset, 0)
+    envelopes = np.empty((ch_nr, n), np.float64)
+    channels = np.empty(ch_nr * n, np.int64)
+    starts = np.empty(ch_nr * n, np.int64)
+    ends = np.empty(ch_nr * n, np.int64)
+    envelope = envelope.copy()
+    is_above = is_above.copy()
+    start_idx = start_idx.copy()
+    count = 0
+
+    for ch in range(ch_nr):
+        env = envelope[ch]
+        above = is_above[ch]
+        s_idx = start_idx[ch]
+
+        for idx in range(data_offset, length):
+            env *= release_factor
+            sample = abs(np.float64(signals[ch, idx]))
+            if sample >= env:
+                env = sample
+            envelopes[ch, idx - data_offset] = env
+
+            if env > upper_threshold[ch] and not above:
+                above = True
+                s_idx = idx
+
+            elif env <= lower_threshold[ch] and above:
+                above = False
+                channels[count] = ch
+                starts[count] = s_idx
+                ends[count] = idx
+                count += 1
+                s_idx = -1
+
+        envelope[ch] = env
+        is_above[ch] = above
+        start_idx[ch] = s_idx
+
+    return (envelopes, channels[:count].copy(), starts[:count].copy(), ends[:count].copy(), envelope, is_above,
+            start_idx)
+
+
+def _cumsum_mean_nb(x, n, n_value):
+    # n_value is n expressed in the dtype of x, to keep the arithmetic of the reference implementation
+    cumsum = np.empty(len(x) + 1, x.dtype)
+    cumsum[0] = 0
+    for idx in range(len(x)):
+        cumsum[idx + 1] = cumsum[idx] + x[idx]
+
+    result = np.empty(max(len(x) + 1 - n, 0), x.dtype)
+    for idx in range(len(result)):
+        result[idx] = (cumsum[idx + n] - cumsum[idx]) / n_value
+    return result
+
+
+def _compile_kernels() -> None:
+    cumsum_mean = numba.njit(_cumsum_mean_nb)
+
+    def noise_gate_nb(signal, threshold, window, n_value):
+        result = signal.copy()
+        mean = cumsum_mean(np.abs(signal), window, n_value)
+        for idx in range(len(mean)):
+            if mean[idx] <= threshold:
+                result[idx] = 0
+        return result
+
+    _compiled["envelope_hysteresis"] = numba.njit(_envelope_hysteresis_nb)
+    _compiled["envelope_hysteresis_multi"] = numba.njit(_envelope_hysteresis_multi_nb)
+    _compiled["cumsum_mean"] = cumsum_mean
+    _compiled["noise_gate"] = numba.njit(noise_gate_nb)
+
+
+def select_backend(backend: Backend = Backend.AUTO, warm_up: bool = True) -> Backend:
+    """Selects the backend of DSP kernels. AUTO chooses Numba if it is installed. Compiled kernels are warmed up with
+       small inputs, so that JIT compilation happens at startup and not on the first processed chunk.
+       Returns the backend actually in use"""
+
+    global _backend
+
+    if backend == Backend.AUTO:
+        backend = Backend.NUMBA if numba is not None else Backend.NUMPY
+
+    if backend == Backend.NUMBA:
+        if numba is None:
+            raise BackendUnavailable("Numba backend requested, but numba is not installed")
+
+        if not _compiled:
+            _compile_kernels()
+
+        if warm_up:
+            for dtype in (np.float32, np.float64):
+                data = np.zeros(16, dtype)
+                _compiled["envelope_hysteresis"](data, 0, 0.0, 0.5, 1.0, 0.5, False, -1)
+                _compiled["cumsum_mean"](data, 4, dtype(4))
+                _compiled["noise_gate"](data, 1.0, 4, dtype(4))
+                _compiled["envelope_hysteresis_multi"](np.zeros((2, 16), dtype), 0, np.zeros(2), 0.5, np.ones(2),
+                                                       np.full(2, 0.5), np.zeros(2, np.bool_), np.full(2, -1))
+
+    _backend = backend
+    return _backend
+
+
+def current_backend() -> Backend:
+    return _backend
+
+
+def _use_compiled(signal: np.ndarray) -> bool:
+    return _backend == Backend.NUMBA and signal.dtype in (np.float32, np.float64)
+
+
+def envelope_hysteresis(signal: np.ndarray, data_offset: int, envelope: float, release_factor: float,
+                        upper_threshold: float, lower_threshold: float, is_above: bool,
+                        start_idx: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float, bool, int]:
+    """Peak envelope follower with hysteresis detection, see _envelope_hysteresis_ref for details"""
+
+    signal = np.asarray(signal)
+    if _use_compiled(signal):
+        return _compiled["envelope_hysteresis"](signal, data_offset, float(envelope), float(release_factor),
+                                                float(upper_threshold), float(lower_threshold), bool(is_above),
+                                                int(start_idx))
+    return _envelope_hysteresis_ref(signal, data_offset, envelope, release_factor, upper_threshold,
+                                    lower_threshold, is_above, start_idx)
+
+
+def envelope_hysteresis_multi(signals: np.ndarray, data_offset: int, envelope: np.ndarray, release_factor: float,
+                              upper_threshold: np.ndarray, lower_threshold: np.ndarray, is_above: np.ndarray,
+                              start_idx: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Envelope follower with hysteresis detection run on all (channels, n) signals in one pass, every channel keeps
+       its own state, see _envelope_hysteresis_multi_ref for details"""
+
+    signals = np.asarray(signals)
+    ch_nr = len(signals)
+    state = (np.asarray(envelope, np.float64), np.broadcast_to(np.asarray(upper_threshold, np.float64), (ch_nr,)),
+             np.broadcast_to(np.asarray(lower_threshold, np.float64), (ch_nr,)), np.asarray(is_above, np.bool_),
+             np.asarray(start_idx, np.int64))
+
+    if _use_compiled(signals):
+        return _compiled["envelope_hysteresis_multi"](signals, data_offset, state[0], float(release_factor),
+                                                      np.ascontiguousarray(state[1]), np.ascontiguousarray(state[2]),
+                                                      state[3], state[4])
+    return _envelope_hysteresis_multi_ref(signals, data_offset, state[0], release_factor, state[1], state[2],
+                                          state[3], state[4])
+
+
+def running_mean(x: np.ndarray, n: int) -> np.ndarray:
+    x = np.asarray(x)
+    if _use_compiled(x):
+        return _compiled["cumsum_mean"](x, n, x.dtype.type(n))
+    return _running_mean_ref(x, n)
+
+
+def noise_gate(signal: np.ndarray, threshold: float, window: int = 15) -> np.ndarray:
+    """Zeroes samples, whose moving average of absolute value starting at them is not above the threshold"""
+
+    signal = np.asarray(signal)
+    if _use_compiled(signal):
+        return _compiled["noise_gate"](signal, float(threshold), window, signal.dtype.type(window))
+    return _noise_gate_ref(signal, threshold, window)
+
+
+def _test_backend_compatibility(length: int = 100000, seed: int = 0) -> bool:
+    """Runs all the kernels with both backends on random signals and checks, if results are bit-identical"""
+
+    rng = np.random.RandomState(seed)
+    previous = current_backend()
+    ok = True
+
+    for dtype in (np.float32, np.float64):
+        signal = (rng.standard_normal(length) * 20000 * (rng.uniform(size=length) > 0.999) +
+                  rng.standard_normal(length) * 500).astype(dtype)
+        results = {}
+        for backend in (Backend.NUMPY, Backend.NUMBA):
+            select_backend(backend)
+            results[backend] = (envelope_hysteresis(signal, 16, 0.0, 0.9993, 12000, 7000, False, -1),
+                                running_mean(np.abs(signal), 15),
+                                noise_gate(signal, 2500),
+                                envelope_hysteresis_multi(signal.reshape(4, -1), 16, np.zeros(4), 0.9993,
+                                                          np.array([12000, 11000, 13000, 12000]), 7000,
+                                                          np.zeros(4, np.bool_), np.full(4, -1)))
+
+        ref, compiled = results[Backend.NUMPY], results[Backend.NUMBA]
+        checks = {
+            "envelope": np.array_equal(ref[0][0], compiled[0][0]),
+            "events": np.array_equal(ref[0][1], compiled[0][1]) and np.array_equal(ref[0][2], compiled[0][2]),
+            "state": tuple(ref[0][3:]) == tuple(compiled[0][3:]),
+            "running_mean": ref[1].dtype == compiled[1].dtype and np.array_equal(ref[1], compiled[1]),
+            "noise_gate": ref[2].dtype == compiled[2].dtype and np.array_equal(ref[2], compiled[2]),
+            "multi_channel": all(np.array_equal(r, c) for r, c in zip(ref[3], compiled[3]))
+        }
+        print("{}: {}".format(np.dtype(dtype).name, checks))
+        ok = ok and all(checks.values())
+
+    select_backend(previous)
+    return ok
+
+# _test_backend_compatibility()
@@ -8,13 +8,16 @@ sensorMat = SensorMatrix([
     (0.0, 1.11, 1.0),
     (1.15, 1.11, 0.72),
     (1.14, 0.0, 0.72)
-], debug=True)
+], debug=True, cache_size=1024, constrain_lags=True)
 
 
 def __main__():
     log.startLogging(sys.stdout)
     App.onSimulate = sensorMat.simulate_wave_propagation
+    App.onSimulateBatch = sensorMat.simulate_batch
     App.onSettings = sensorMat.update_receiver_pos
+    if sensorMat.memory_profiler is not None:
+        App.memory_stats = lambda: sensorMat.memory_profiler.stats
     connection = Connection()
     connection.run()
 
@@ -1,16 +1,22 @@
-from typing import Tuple
+from functools import lru_cache
+from typing import Tuple, NamedTuple
 from scipy.signal import butter, sosfilt, sosfreqz
 
 import numpy as np
+from localizator import kernels
 from localizator.dft import DFT
 import matplotlib.pyplot as plt
 
 
 def gcc_phat(input_signal: np.ndarray, ref_signal: np.ndarray, dft: DFT, phat: bool = False,
              delay_in_seconds: bool = True, interpolation_factor: int = 1,
-             buffered_dft: bool = False, force_delay: bool = False) -> Tuple[float, np.ndarray]:
+             buffered_dft: bool = False, force_delay: bool = False,
+             lag_window: Tuple[float, float] = None) -> Tuple[float, np.ndarray]:
     """Performs General cross correlation in frequency domain with optional Phase Transform filtering(PHAT).
-       Returns a Tuple of delay(in sec or samples) and resulting histogram"""
+       If lag_window (min, max lag in samples) is given, the peak is searched only within it, e.g. within the range
+       of physically feasible delays. Returns a Tuple of delay(in sec or samples) and resulting histogram.
+       Signals may also be 2-D arrays with one window per row, then delays and histograms are computed for all rows
+       at once and lag_window may be given per row as (n, 2) array"""
 
     fft_signal = dft.transform(input_signal)
     if buffered_dft:
@@ -28,10 +34,21 @@ def gcc_phat(input_signal: np.ndarray, ref_signal: np.ndarray, dft: DFT, phat: b
 
     histogram = dft.inverse_transform(corr, interpolation_factor)
     if force_delay:
-        histogram[0] = 0
-    histogram = np.fft.fftshift(histogram)
+        histogram[..., 0] = 0
+    histogram = np.fft.fftshift(histogram, axes=-1)
 
-    delay = (np.argmax(histogram) - dft.size // 2 * interpolation_factor) / interpolation_factor
+    center = dft.size // 2 * interpolation_factor
+    if lag_window is None:
+        peak_idx = np.argmax(histogram, axis=-1)
+    else:
+        lag_window = np.asarray(lag_window, np.float64)
+        l_idx = center + np.floor(lag_window[..., 0] * interpolation_factor)
+        h_idx = center + np.ceil(lag_window[..., 1] * interpolation_factor)
+        lags = np.arange(histogram.shape[-1])
+        in_window = (lags >= np.expand_dims(l_idx, -1)) & (lags <= np.expand_dims(h_idx, -1))
+        peak_idx = np.argmax(np.where(in_window, histogram, -np.inf), axis=-1)
+
+    delay = (peak_idx - center) / interpolation_factor
 
     if delay_in_seconds:
         delay = delay / dft.sampling_rate
@@ -39,9 +56,165 @@ def gcc_phat(input_signal: np.ndarray, ref_signal: np.ndarray, dft: DFT, phat: b
     return delay, histogram
 
 
+class TDoAQuality(NamedTuple):
+    """Confidence measures of cross-correlation peaks, each array holds one value per estimated delay"""
+    peak_to_sidelobe: np.ndarray  # (peak - mean of sidelobes) / std of sidelobes
+    second_peak_ratio: np.ndarray  # highest sidelobe / peak, close to 1 for ambiguous peaks (e.g. reflections)
+    normalized_peak: np.ndarray  # peak / L2 norm of the histogram, 1 for single ideal peak
+
+
+def peak_quality(histogram: np.ndarray, peak_idx: np.ndarray, exclusion: int = 2) -> TDoAQuality:
+    """Computes TDoAQuality of the histogram peaks (one histogram per row). Samples within exclusion of the peak
+       belong to its main lobe, the rest of the histogram is treated as sidelobes"""
+
+    histogram = np.atleast_2d(np.asarray(histogram, np.float64))
+    peak_idx = np.broadcast_to(np.asarray(peak_idx, np.int64).reshape(-1), histogram.shape[:1])
+    peak = histogram[np.arange(len(histogram)), peak_idx]
+
+    sidelobes = np.abs(np.arange(histogram.shape[-1]) - peak_idx[:, np.newaxis]) > exclusion
+    count = np.maximum(np.sum(sidelobes, axis=-1), 1)
+    mean = np.sum(np.where(sidelobes, histogram, 0), axis=-1) / count
+    std = np.sqrt(np.sum(np.where(sidelobes, (histogram - mean[:, np.newaxis]) ** 2, 0), axis=-1) / count)
+    second = np.max(np.where(sidelobes, histogram, -np.inf), axis=-1, initial=-np.inf)
+    norm = np.linalg.norm(histogram, axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        psr = np.where(std > 0, (peak - mean) / std, np.inf)
+        ratio = np.where(peak > 0, np.maximum(second, 0) / peak, 1.0)
+        normalized = np.where(norm > 0, peak / norm, 0.0)
+    return TDoAQuality(psr, ratio, normalized)
+
+
+def parabolic_peak_offset(histogram: np.ndarray, peak_idx: np.ndarray) -> np.ndarray:
+    """Sub-sample offset (within [-0.5, 0.5]) of the histogram peak, given by the vertex of the parabola through the
+       peak and its neighbours. Works on the last axis, peak_idx holds one index per row"""
+
+    histogram = np.asarray(histogram, np.float64)
+    idx = np.clip(np.asarray(peak_idx), 1, histogram.shape[-1] - 2)[..., np.newaxis]
+    left = np.take_along_axis(histogram, idx - 1, axis=-1)[..., 0]
+    peak = np.take_along_axis(histogram, idx, axis=-1)[..., 0]
+    right = np.take_along_axis(histogram, idx + 1, axis=-1)[..., 0]
+
+    denom = left - 2 * peak + right
+    offset = np.where(denom < 0, 0.5 * (left - right) / np.where(denom < 0, denom, 1), 0.0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+class MultiResolutionTDoA(object):
+    """Coarse to fine TDoA estimation on long analysis windows. The PHAT weighted cross spectrum is computed once per
+       pair. In the coarse stage only its bins within the signal band are shifted to baseband and inversely
+       transformed at the rate decimated by the given factor, the envelope of that band limited correlation locates
+       the lag within +- decimation samples. In the fine stage the full band correlation is evaluated at full rate
+       only for lags around the coarse one (pruned inverse DFT) instead of the whole window. Optionally the peak is
+       refined to sub-sample precision by parabolic interpolation"""
+
+    class InvalidInput(Exception):
+        pass
+
+    def __init__(self, size: int = 1024, sampling_rate: float = 44100, band: Tuple[float, float] = (7000, 12000),
+                 decimation: int = 8, fine_margin: int = 4, subsample: bool = False):
+        if decimation < 1 or size % decimation != 0:
+            raise MultiResolutionTDoA.InvalidInput("Window size of {} is not divisible by decimation of {}"
+                                                   .format(size, decimation))
+
+        self.decimation = decimation
+        self.fine_margin = fine_margin
+        self.subsample = subsample
+        self._band = band
+        self._dft = DFT(size, sampling_rate)
+        self._setup_band()
+
+    def _setup_band(self) -> None:
+        size = self._dft.size
+        frequencies = np.arange(self._dft.dft_size) * self._dft.sampling_rate / size
+        self._band_bins = np.flatnonzero((frequencies >= self._band[0]) & (frequencies <= self._band[1]))
+        if len(self._band_bins) == 0 or len(self._band_bins) > size // self.decimation:
+            raise MultiResolutionTDoA.InvalidInput("Band {} does not fit the decimated rate of {} Hz"
+                                                   .format(self._band, self._dft.sampling_rate / self.decimation))
+
+        # one-sided spectrum, bins other than DC and Nyquist stand for both of the conjugate ones
+        self._weights = np.full(self._dft.dft_size, 2.0)
+        self._weights[0] = 1.0
+        if size % 2 == 0:
+            self._weights[-1] = 1.0
+
+    @property
+    def size(self) -> int:
+        return self._dft.size
+
+    @property
+    def sampling_rate(self) -> float:
+        return self._dft.sampling_rate
+
+    @sampling_rate.setter
+    def sampling_rate(self, fs: float) -> None:
+        self._dft.sampling_rate = fs
+        self._setup_band()
+
+    def coarse_lags(self, cross_spectrum: np.ndarray, lag_window: np.ndarray = None,
+                    with_envelope: bool = False) -> np.ndarray:
+        """Lags [samples] of maximal envelope of the band limited correlation, with resolution of decimation factor.
+           With with_envelope set, the envelope (before the lag window is applied) and peak indexes are returned too"""
+
+        decimated_size = self._dft.size // self.decimation
+        baseband = np.zeros(cross_spectrum.shape[:-1] + (decimated_size,), np.complex128)
+        baseband[..., (self._band_bins - self._band_bins[0]) % decimated_size] = cross_spectrum[..., self._band_bins]
+        envelope = np.fft.fftshift(np.abs(np.fft.ifft(baseband, axis=-1)), axes=-1)
+        lags = (np.arange(decimated_size) - decimated_size // 2) * self.decimation
+
+        searched = envelope
+        if lag_window is not None:
+            lag_window = np.asarray(lag_window, np.float64)
+            in_window = (lags >= np.expand_dims(lag_window[..., 0], -1) - self.decimation) & \
+                        (lags <= np.expand_dims(lag_window[..., 1], -1) + self.decimation)
+            searched = np.where(in_window, envelope, -np.inf)
+
+        peak_idx = np.argmax(searched, axis=-1)
+        if with_envelope:
+            return lags[peak_idx], envelope, peak_idx
+        return lags[peak_idx]
+
+    def estimate(self, input_signal: np.ndarray, ref_signal: np.ndarray, lag_window: np.ndarray = None,
+                 delay_in_seconds: bool = True, with_quality: bool = False) -> np.ndarray:
+        """Estimates delays of input signals in relation to the reference ones, both given as windows of the estimator
+           size (one per row for 2-D input). lag_window (min, max lag in samples, or (n, 2) array of them) limits
+           both stages. With with_quality set, a Tuple of delays and TDoAQuality of the coarse peaks is returned"""
+
+        input_signal = np.atleast_2d(input_signal)
+        cross_spectrum = self._dft.transform(input_signal) * np.conj(self._dft.transform(np.atleast_2d(ref_signal)))
+        magnitude = np.abs(cross_spectrum)
+        cross_spectrum = cross_spectrum / np.where(magnitude != 0, magnitude, 1)
+        rows = cross_spectrum.shape[0]
+
+        coarse, envelope, coarse_idx = self.coarse_lags(cross_spectrum, lag_window, with_envelope=True)
+        coarse = np.broadcast_to(coarse, (rows,))
+
+        # full rate correlation evaluated only for lags around the coarse one
+        reach = self.decimation + self.fine_margin
+        lags = coarse[:, np.newaxis] + np.arange(-reach, reach + 1)
+        phase = np.exp(2j * np.pi * lags[..., np.newaxis] * np.arange(self._dft.dft_size) / self._dft.size)
+        corr = np.einsum("rlk,rk->rl", phase, cross_spectrum * self._weights).real
+
+        if lag_window is not None:
+            bounds = np.broadcast_to(np.asarray(lag_window, np.float64), (rows, 2))
+            in_window = (lags >= bounds[:, [0]]) & (lags <= bounds[:, [1]])
+            corr = np.where(in_window | ~np.any(in_window, axis=1, keepdims=True), corr, np.min(corr))
+
+        peak_idx = np.argmax(corr, axis=-1)
+        delay = np.take_along_axis(lags, peak_idx[:, np.newaxis], axis=-1)[:, 0].astype(np.float64)
+        if self.subsample:
+            delay += parabolic_peak_offset(corr, peak_idx)
+
+        if delay_in_seconds:
+            delay = delay / self._dft.sampling_rate
+        if with_quality:
+            # main lobe of the band limited envelope spans about one decimated sample
+            return delay, peak_quality(envelope, coarse_idx, exclusion=1)
+        return delay
+
+
 def running_mean(x, N):
-    cumsum = np.cumsum(np.insert(x, 0, 0))
-    return (cumsum[N:] - cumsum[:-N]) / float(N)
+    return kernels.running_mean(x, N)
 
 
 def _test_gcc_phat():
@@ -148,28 +321,62 @@ def unpack_channels(frames, channel_nr):
         result.append(frames[ch_id::channel_nr])
     return result
 
-def butter_bandpass(lowcut, highcut, fs=44166, order=5):
+@lru_cache(maxsize=32)
+def _butter_bandpass_sos(lowcut, highcut, fs, order):
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
     sos = butter(order, [low, high], analog=False, btype='band', output='sos')
+    sos.setflags(write=False)
     return sos
 
 
+def butter_bandpass(lowcut, highcut, fs=44166, order=5):
+    # designs are cached, every caller gets its own copy, sosfilt does not accept read-only coefficients anyway
+    return _butter_bandpass_sos(lowcut, highcut, fs, order).copy()
+
+
 def butter_bandpass_filter(data, lowcut, highcut, fs=44166, order=5):
     sos = butter_bandpass(lowcut, highcut, fs, order=order)
     y = sosfilt(sos, data)
     return y
 
 
+class StreamingBandpass(object):
+    """Butterworth band-pass filter applied chunk by chunk to multi-channel signal. SOS coefficients are designed once
+       per sampling rate and the filter state of every channel is carried between chunks, so consecutive chunks are
+       filtered as one continuous signal. All channels are filtered with a single sosfilt call"""
+
+    def __init__(self, lowcut: float, highcut: float, channel_nr: int, fs: float = 44166, order: int = 5):
+        self._lowcut, self._highcut, self._order = lowcut, highcut, order
+        self._channel_nr = channel_nr
+        self._fs = fs
+        self._sos = butter_bandpass(lowcut, highcut, fs, order=order)
+        self._zi = np.zeros((self._sos.shape[0], channel_nr, 2), np.float64)
+
+    @property
+    def sampling_rate(self) -> float:
+        return self._fs
+
+    @sampling_rate.setter
+    def sampling_rate(self, fs: float) -> None:
+        if fs != self._fs:
+            self._fs = fs
+            self._sos = butter_bandpass(self._lowcut, self._highcut, fs, order=self._order)
+            self.reset()
+
+    def reset(self) -> None:
+        self._zi = np.zeros((self._sos.shape[0], self._channel_nr, 2), np.float64)
+
+    def process(self, data: np.ndarray) -> np.ndarray:
+        """Filters (channel_nr, n) chunk of data, returns filtered chunk of the same shape"""
+
+        filtered, self._zi = sosfilt(self._sos, data, axis=-1, zi=self._zi)
+        return filtered
+
+
 def remove_noise(self, signal: np.ndarray, treshold = 2500):
-    result = np.array(signal)
-    tmp = np.abs(signal)
-    tmp = running_mean(tmp, 15)
-    for [idx, val] in enumerate(tmp):
-        if val <= treshold:
-            result[idx] = 0
-    return result
+    return kernels.noise_gate(signal, treshold, 15)
 
 
 def xcorr(a: np.ndarray, b: np.ndarray) -> float:
@@ -0,0 +1,265 @@
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import numpy as np
+
+
+class MemoryProfiler(object):
+    """Opt-in memory instrumentation of long running workers. On every sample the sizes of registered structures
+       (ring buffers, event lists, caches) are measured, which is cheap. With tracing enabled, a tracemalloc snapshot is
+       taken as well and the allocations still alive are attributed to pipeline stages by the most recent localizator
+       frame of their traceback, so that memory allocated by numpy or librosa is charged to the line calling them.
+       Top allocation sites of every stage and growth since the previous sample are reported. Tracing slows every
+       allocation down, so it is meant for hunting leaks rather than for regular operation.
+
+       Samples are taken by the processing thread (maybe_sample), the report is replaced as a whole, so that the stats
+       channel reads it from the connection thread without locking"""
+
+    class InvalidInput(Exception):
+        pass
+
+    class Site(NamedTuple):
+        stage: str
+        location: str  # file:line of the allocating code
+        size: int  # bytes alive
+        count: int  # blocks alive
+        size_diff: int  # growth since the previous sample
+
+    # pipeline stages by localizator module, allocations without any localizator frame fall to "other"
+    default_stages = {
+        "acquisition": ("receiver.py", "frame_parser.py", "sample_format.py", "shared_ring.py", "serialReader.py"),
+        "detection": ("sound_detector.py", "kernels.py"),
+        "tdoa": ("math_tools.py", "dft.py"),
+        "solver": ("MLE.py", "tdoa_grid.py", "result_cache.py", "tracker.py"),
+        "output": ("event_store.py", "debug_renderer.py", "connection.py"),
+        "matrix": ("sensor_matrix.py",)
+    }
+
+    # containers longer than that are measured on evenly spaced elements only
+    _sample_limit = 256
+    _max_depth = 4
+
+    def __init__(self, interval: float = 60.0, trace: bool = False, frames: int = 8, top: int = 10,
+                 stages: Dict[str, Tuple[str, ...]] = None):
+        if interval <= 0 or frames <= 0 or top <= 0:
+            raise MemoryProfiler.InvalidInput("Interval, traceback depth and number of sites must be positive")
+
+        self.interval = interval
+        self.trace = trace
+        self.frames = frames
+        self.top = top
+        self._stage_of_file = {file_name: stage for stage, file_names in (stages or MemoryProfiler.default_stages)
+                               .items() for file_name in file_names}
+        self._package_dir = os.path.dirname(os.path.abspath(__file__))
+        # traced file name -> module name within the package, empty for files outside of it
+        self._package_files: Dict[str, str] = {}
+
+        self._structures: Dict[str, Callable[[], object]] = {}
+        self._structure_sizes: Dict[str, int] = {}
+        self._sites: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self._owns_tracing = False
+        self._last_sample = -np.inf
+
+        self.samples = 0
+        self._report: dict = {}
+
+    def register(self, name: str, source: Callable[[], object]) -> None:
+        """Adds structure measured on every sample, the source is called each time, so replaced objects are followed.
+           Sources returning None are skipped"""
+
+        self._structures[name] = source
+
+    def start(self) -> None:
+        """Starts tracemalloc if tracing is enabled, tracing started by someone else is left running on stop"""
+
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._owns_tracing = True
+
+    def stop(self) -> None:
+        """Takes the last sample and stops tracing started by the profiler"""
+
+        self.sample()
+        if self._owns_tracing:
+            tracemalloc.stop()
+            self._owns_tracing = False
+
+    def maybe_sample(self) -> bool:
+        """Samples if the interval elapsed since the end of the last sample, to be called from the processing loop.
+           Traced samples take time proportional to the number of live allocations, counting from the end keeps
+           their share of the loop time bounded"""
+
+        if time.monotonic() - self._last_sample < self.interval:
+            return False
+        self.sample()
+        return True
+
+    def sample(self) -> None:
+        self.samples += 1
+
+        report = {
+            "samples": self.samples,
+            "timestamp": time.time(),
+            "tracing": tracemalloc.is_tracing(),
+            "structures": self._measure_structures()
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            report["traced"] = {"current": current, "peak": peak}
+            report["stages"] = self._stage_report(self._allocation_sites())
+
+        self._report = report
+        self._last_sample = time.monotonic()
+
+    @property
+    def stats(self) -> dict:
+        """The last report, empty before the first sample"""
+
+        return self._report
+
+    def _measure_structures(self) -> dict:
+        sizes = {}
+        for name, source in self._structures.items():
+            structure = source()
+            if structure is None:
+                continue
+
+            size = MemoryProfiler.sizeof(structure)
+            sizes[name] = {
+                "bytes": size,
+                "length": len(structure) if hasattr(structure, "__len__") else None,
+                "growth": size - self._structure_sizes.get(name, size)
+            }
+            self._structure_sizes[name] = size
+        return sizes
+
+    def _allocation_sites(self) -> List['MemoryProfiler.Site']:
+        """Groups traces alive by stage and allocating line, compares them with the previous sample"""
+
+        # snapshots and reports of the profiler itself are not the allocations it looks for
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                              tracemalloc.Filter(False, __file__)])
+        # traces are grouped by the whole traceback first, so that every distinct traceback is attributed once
+        sites: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        for statistic in snapshot.statistics("traceback"):
+            stage, location = self._attribute(statistic.traceback)
+            size, count = sites.get((stage, location), (0, 0))
+            sites[(stage, location)] = (size + statistic.size, count + statistic.count)
+
+        result = [MemoryProfiler.Site(stage, location, size, count, size - self._sites.get((stage, location), (0,))[0])
+                  for (stage, location), (size, count) in sites.items()]
+        # sites freed completely since the previous sample are reported as negative growth
+        result.extend(MemoryProfiler.Site(stage, location, 0, 0, -size)
+                      for (stage, location), (size, count) in self._sites.items() if (stage, location) not in sites)
+
+        self._sites = sites
+        return result
+
+    def _attribute(self, traceback: tracemalloc.Traceback) -> Tuple[str, str]:
+        # frames are ordered from the oldest one, the most recent localizator frame is the responsible code
+        for frame in reversed(traceback):
+            file_name = self._package_files.get(frame.filename)
+            if file_name is None:
+                file_name = os.path.basename(frame.filename) \
+                    if os.path.dirname(frame.filename) == self._package_dir else ""
+                self._package_files[frame.filename] = file_name
+            if file_name:
+                return self._stage_of_file.get(file_name, "other"), "{}:{}".format(file_name, frame.lineno)
+
+        frame = traceback[-1]
+        return "other", "{}:{}".format(frame.filename, frame.lineno)
+
+    def _stage_report(self, sites: List['MemoryProfiler.Site']) -> dict:
+        stages = {}
+        for stage, stage_sites in itertools.groupby(sorted(sites, key=lambda site: site.stage),
+                                                    key=lambda site: site.stage):
+            stage_sites = list(stage_sites)
+            top_size = sorted(stage_sites, key=lambda site: site.size, reverse=True)[:self.top]
+            top_growth = sorted(stage_sites, key=lambda site: site.size_diff, reverse=True)[:self.top]
+            stages[stage] = {
+                "bytes": sum(site.size for site in stage_sites),
+                "blocks": sum(site.count for site in stage_sites),
+                "growth": sum(site.size_diff for site in stage_sites),
+                "top": [MemoryProfiler._site_stats(site) for site in top_size if site.size > 0],
+                "topGrowth": [MemoryProfiler._site_stats(site) for site in top_growth if site.size_diff > 0]
+            }
+        return stages
+
+    @staticmethod
+    def _site_stats(site: 'MemoryProfiler.Site') -> dict:
+        return {"location": site.location, "bytes": site.size, "blocks": site.count, "growth": site.size_diff}
+
+    @staticmethod
+    def sizeof(obj: object, depth: int = 0, seen: set = None) -> int:
+        """Approximate memory held by the object and its content. Arrays count their data once, views count the
+           data of their base, so buffers shared by several views (e.g. shared memory ring) are not counted twice.
+           Long containers are estimated from evenly spaced elements, objects are followed through their attributes
+           down to limited depth"""
+
+        seen = set() if seen is None else seen
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+
+        if isinstance(obj, np.ndarray):
+            # size of an array owning its data includes the data, size of a view does not
+            return sys.getsizeof(obj) + (MemoryProfiler.sizeof(obj.base, depth, seen) if obj.base is not None else 0)
+        if isinstance(obj, memoryview):
+            return obj.nbytes
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool, np.generic)) or depth >= MemoryProfiler._max_depth:
+            return sys.getsizeof(obj)
+
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            items = list(obj.keys()) + list(obj.values()) if len(obj) <= MemoryProfiler._sample_limit else None
+            if items is None:
+                return size + MemoryProfiler._estimate(len(obj), MemoryProfiler._spaced(obj.items()), depth, seen)
+            return size + sum(MemoryProfiler.sizeof(item, depth + 1, seen) for item in items)
+        if isinstance(obj, (list, tuple, deque, set, frozenset)):
+            if len(obj) <= MemoryProfiler._sample_limit:
+                return size + sum(MemoryProfiler.sizeof(item, depth + 1, seen) for item in obj)
+            return size + MemoryProfiler._estimate(len(obj), MemoryProfiler._spaced(obj), depth, seen)
+
+        attributes = getattr(obj, "__dict__", None)
+        if attributes is not None:
+            size += MemoryProfiler.sizeof(attributes, depth + 1, seen)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += MemoryProfiler.sizeof(getattr(obj, slot), depth + 1, seen)
+        return size
+
+    @staticmethod
+    def _spaced(items) -> list:
+        """Every n-th element, so that at most _sample_limit elements are taken, iterating in C"""
+
+        step = max(1, len(items) // MemoryProfiler._sample_limit)
+        return list(itertools.islice(items, 0, None, step))
+
+    @staticmethod
+    def _estimate(length: int, sampled: list, depth: int, seen: set) -> int:
+        # shared items (e.g. interned scalars) are counted as if every element held its own copy
+        sampled_size = sum(MemoryProfiler.sizeof(item, depth + 1, set(seen)) for item in sampled)
+        return int(sampled_size * length / max(1, len(sampled)))
+
+
+def __test_memory_profiler():
+    profiler = MemoryProfiler(interval=1.0, trace=True)
+    buffer = deque(maxlen=100000)
+    leak = []
+    profiler.register("buffer", lambda: buffer)
+    profiler.register("leak", lambda: leak)
+    profiler.start()
+    for _ in range(3):
+        buffer.extend(np.zeros(4096, np.float32))
+        leak.append(np.zeros(1 << 16))
+        profiler.sample()
+    profiler.stop()
+    print(profiler.stats["structures"])
+    print(profiler.stats["stages"].get("other", {}).get("topGrowth"))
+
+# __test_memory_profiler()
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, List
 import numpy as np
 import json
 from collections import deque
@@ -13,8 +13,89 @@ class SliceDeck(deque):
             return type(self)(itertools.islice(self, index.start, index.stop))
 
 
+class ReceiverArray(object):
+    """Geometry of the whole microphone array kept as a single (N, 3) float64 array. Derived quantities (K values,
+       pairwise distances, maximal TDoAs) are computed lazily and cached until the geometry changes. Every change
+       replaces the position array (copy on write) and increments the version, so consumers may cache against it.
+       Positions are changed only by the solver owning the array (MLE.set_geometry), so receivers never report
+       positions its geometry was not built from"""
+
+    __slots__ = ('_positions', '_version', '_k', '_pairwise_dist')
+
+    class InvalidInput(Exception):
+        pass
+
+    def __init__(self, positions: np.ndarray):
+        positions = np.array(positions, np.float64)
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ReceiverArray.InvalidInput("Positions should be of (N, 3) shape, got {}".format(positions.shape))
+
+        self._positions = positions
+        self._version = 0
+        self._k: np.ndarray = None
+        self._pairwise_dist: np.ndarray = None
+
+    @classmethod
+    def from_receivers(cls, receivers: List['Receiver']) -> 'ReceiverArray':
+        """Creates array out of receivers positions and binds receivers to it, so they become views of its rows"""
+
+        array = cls(np.array([rec.position for rec in receivers], np.float64))
+        for idx, rec in enumerate(receivers):
+            rec.bind(array, idx)
+        return array
+
+    def __len__(self):
+        return len(self._positions)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def positions(self) -> np.ndarray:
+        """(N, 3) positions of the receivers, the array is never modified in place"""
+
+        return self._positions
+
+    def _replace(self, positions: np.ndarray) -> None:
+        positions = np.array(positions, np.float64)
+        if positions.shape != self._positions.shape:
+            raise ReceiverArray.InvalidInput("Positions should be of {} shape, got {}"
+                                             .format(self._positions.shape, positions.shape))
+        self._positions = positions
+        self._k = None
+        self._pairwise_dist = None
+        self._version += 1
+
+    @property
+    def k(self) -> np.ndarray:
+        """K = xi^2 + yi^2 + zi^2 for every receiver"""
+
+        if self._k is None:
+            self._k = np.sum(self._positions ** 2, axis=1)
+        return self._k
+
+    @property
+    def pairwise_distances(self) -> np.ndarray:
+        """(N, N) matrix of distances between receivers"""
+
+        if self._pairwise_dist is None:
+            diff = self._positions[:, np.newaxis, :] - self._positions[np.newaxis, :, :]
+            self._pairwise_dist = np.linalg.norm(diff, axis=2)
+        return self._pairwise_dist
+
+    @property
+    def max_tdoa(self) -> np.ndarray:
+        """(N, N) matrix of physically possible maximal TDoA(in seconds) between receivers"""
+
+        return self.pairwise_distances / Receiver.c
+
+
 class Receiver(object):
-    """Class models the receiver in the microphone array and provides interface for the simulation"""
+    """Class models the receiver in the microphone array and provides interface for the simulation. Position is a view
+       of the row in the ReceiverArray, standalone receiver owns a single row array"""
+
+    __slots__ = ('_array', '_idx', '_isReference', '_received_time', 'tDoA', 'data_buffer')
 
     srcX: np.float64 = -10.0
     srcY: np.float64 = -10.0
@@ -27,7 +108,8 @@ class Receiver(object):
     def __init__(self, pos_x: np.float64, pos_y: np.float64, pos_z: np.float64, is_reference: bool = False,
                  buffer_size: int = 2 * 4096, received_time: np.longfloat = 0):
 
-        self._pos_x, self._pos_y, self._pos_z = pos_x, pos_y, pos_z
+        self._array = ReceiverArray(np.array([[pos_x, pos_y, pos_z]], np.float64))
+        self._idx = 0
         self._isReference = is_reference
         self._received_time: np.float64 = np.float64(received_time)
         # public TDOA time variable between this microphone and reference one
@@ -36,6 +118,16 @@ class Receiver(object):
         self.receive()
         self.data_buffer = SliceDeck(maxlen=buffer_size)
 
+    def bind(self, array: ReceiverArray, idx: int) -> None:
+        """Makes the receiver a view of the given row of receiver array"""
+
+        self._array = array
+        self._idx = idx
+
+    @property
+    def array(self) -> ReceiverArray:
+        return self._array
+
     @property
     def is_reference(self) -> bool:
         return self._isReference
@@ -48,13 +140,7 @@ class Receiver(object):
     def position(self) -> np.ndarray:
         """Return the current position of the receiver (x,y,z)"""
 
-        return np.array([self._pos_x, self._pos_y, self._pos_z])
-
-    @position.setter
-    def position(self, pos: Tuple[float, float, float]) -> None:
-        """Sets the position of the receiver (x,y,z)"""
-
-        self._pos_x, self._pos_y, self._pos_z = pos[0], pos[1], pos[2]
+        return self._array.positions[self._idx]
 
     def dist(self, other: 'Receiver') -> np.float:
         """Expresses the distance between two microphones in terms of TDoA between them"""
@@ -63,7 +149,7 @@ class Receiver(object):
         return self.tDoA * Receiver.c
 
     def calc_k(self) -> float:
-        return self._pos_x ** 2 + self._pos_y ** 2 + self._pos_z ** 2
+        return self._array.k[self._idx]
 
     def receive(self) -> None:
         """Simulates the the received time offset, based on src position class variables"""
@@ -72,10 +158,11 @@ class Receiver(object):
 
     @property
     def json(self) -> str:
+        pos = self.position
         obj = {
-            "x": self._pos_x,
-            "y": self._pos_y,
-            "z": self._pos_z,
+            "x": float(pos[0]),
+            "y": float(pos[1]),
+            "z": float(pos[2]),
             "isReference": self._isReference
         }
         return json.dumps(obj)
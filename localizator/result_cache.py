@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+class ResultCache(object):
+    """LRU memoization of localization results. Entries are keyed by the receiver geometry version and the TDoA
+       vector quantized to the given resolution(in seconds), so that bounces landing in the same region of the table,
+       or repeated simulation requests, do not run the solver again. Access is locked, as requests of different clients
+       are handled in parallel threads"""
+
+    class InvalidInput(Exception):
+        pass
+
+    def __init__(self, max_size: int = 1024, resolution: float = 1e-6):
+        if max_size <= 0:
+            raise ResultCache.InvalidInput("Cache size must be positive, got {}".format(max_size))
+        if resolution <= 0:
+            raise ResultCache.InvalidInput("Quantization resolution must be positive, got {}".format(resolution))
+
+        self.max_size = max_size
+        self.resolution = resolution
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, geometry_version: int, tdoa: np.ndarray) -> Tuple[Hashable, ...]:
+        """Builds the cache key out of geometry version and TDoA vector(in seconds)"""
+
+        quantized = np.round(np.asarray(tdoa, np.float64) / self.resolution).astype(np.int64)
+        return (geometry_version,) + tuple(quantized.tolist())
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[List[np.ndarray]]:
+        """Returns copy of the cached roots or None if the key is not present. Updates hit/miss counters"""
+
+        with self._lock:
+            try:
+                roots = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return [np.copy(root) for root in roots]
+
+    def put(self, key: Tuple[Hashable, ...], roots: List[np.ndarray]) -> None:
+        roots = [np.copy(root) for root in roots]
+        with self._lock:
+            self._entries[key] = roots
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Drops all entries, counters are preserved"""
+
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hit_ratio
+        }
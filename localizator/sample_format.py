@@ -0,0 +1,88 @@
+from enum import Enum
+
+import numpy as np
+
+
+class InvalidSampleFormat(Exception):
+    pass
+
+
+class SampleFormat(Enum):
+    """Sample formats delivered by the input sources: 16-bit signed (wav files, MAX11043 in BITS_16 mode), 16-bit
+       unsigned offset binary and packed 3 byte signed samples of BITS_24 mode"""
+
+    INT16 = "int16"
+    UINT16 = "uint16"
+    INT24 = "int24"
+
+    @property
+    def size(self) -> int:
+        """Size of single sample in bytes"""
+
+        return 3 if self == SampleFormat.INT24 else 2
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Smallest integer type holding decoded samples"""
+
+        return np.dtype(np.int32) if self == SampleFormat.INT24 else np.dtype(np.int16)
+
+    @property
+    def scale(self) -> float:
+        """Factor expressing decoded samples in 16-bit full scale units, so that detection thresholds stay the same
+           and 24-bit samples keep their extra resolution as the fractional part"""
+
+        return 1.0 / 256 if self == SampleFormat.INT24 else 1.0
+
+    @staticmethod
+    def from_sample_width(width: int) -> 'SampleFormat':
+        """Format of wav file samples of the given width in bytes"""
+
+        if width == 2:
+            return SampleFormat.INT16
+        if width == 3:
+            return SampleFormat.INT24
+        raise InvalidSampleFormat("Unsupported sample width of {} bytes".format(width))
+
+
+def decode_samples(raw_data: bytes, sample_format: SampleFormat, byte_order: str = "little") -> np.ndarray:
+    """Decodes raw bytes into signed integer samples straight from the byte view, without per-sample Python code.
+       Unsigned samples are shifted to be centered around 0, packed 24-bit ones are sign extended. Trailing bytes
+       not forming a whole sample are ignored"""
+
+    if byte_order not in ("little", "big"):
+        raise InvalidSampleFormat("Byte order should be 'little' or 'big', got {}".format(byte_order))
+
+    endian = "<" if byte_order == "little" else ">"
+    count = len(raw_data) // sample_format.size
+
+    if sample_format == SampleFormat.INT16:
+        return np.frombuffer(raw_data, endian + "i2", count).astype(np.int16)
+
+    if sample_format == SampleFormat.UINT16:
+        return (np.frombuffer(raw_data, endian + "u2", count).astype(np.int32) - 32768).astype(np.int16)
+
+    packed = np.frombuffer(raw_data, np.uint8, count * 3).reshape(-1, 3)
+    if byte_order == "big":
+        packed = packed[:, ::-1]
+
+    # bytes are placed in the upper 3 bytes of little endian int32, arithmetic shift back extends the sign
+    widened = np.zeros((count, 4), np.uint8)
+    widened[:, 1:] = packed
+    return (widened.view("<i4").reshape(-1) >> 8).astype(np.int32)
+
+
+def __test_decode():
+    values = np.array([-8388608, -65536, -1, 0, 1, 255, 65535, 8388607], np.int64)
+    for byte_order in ("little", "big"):
+        raw = b"".join(int(v).to_bytes(3, byte_order, signed=True) for v in values)
+        assert np.array_equal(decode_samples(raw, SampleFormat.INT24, byte_order), values)
+
+        raw = b"".join(int(v).to_bytes(2, byte_order, signed=False) for v in (0, 32768, 65535))
+        assert np.array_equal(decode_samples(raw, SampleFormat.UINT16, byte_order), [-32768, 0, 32767])
+
+        raw = b"".join(int(v).to_bytes(2, byte_order, signed=True) for v in (-32768, -1, 32767))
+        assert np.array_equal(decode_samples(raw + b"\x01", SampleFormat.INT16, byte_order), [-32768, -1, 32767])
+    print("decode ok")
+
+# __test_decode()
@@ -1,17 +1,28 @@
+import threading
+from enum import Enum
+
 import numpy as np
 import serial
-import struct
 from bisect import bisect_left
 from collections import deque
-from typing import Tuple, List, NamedTuple, Sized, Iterable
+from typing import Tuple, List, NamedTuple, Sized, Iterable, Callable
 import itertools
 from localizator.receiver import Receiver, SliceDeck
 from localizator.dft import DFT
-from localizator.MLE import MLE
-from localizator.math_tools import gcc_phat
-from localizator.sound_detector import SoundDetector
+from localizator.MLE import MLE, PerformanceTest
+from localizator.math_tools import gcc_phat, StreamingBandpass, MultiResolutionTDoA, TDoAQuality, peak_quality
+from localizator.result_cache import ResultCache
+from localizator.sample_format import SampleFormat, decode_samples
+from localizator.frame_parser import FrameParser
+from localizator.shared_ring import SharedAudioRing
+from localizator.tdoa_grid import TDoAGrid
+from localizator.tracker import BounceTracker
+from localizator.sound_detector import SoundDetector, MultiChannelDetector, NoiseFloorEstimator
+from localizator.debug_renderer import DebugRenderer
+from localizator.event_store import EventStore
+from localizator.memory_profiler import MemoryProfiler
+from localizator import kernels
 
-import matplotlib.pyplot as plt
 import librosa
 import librosa.display
 
@@ -36,6 +47,10 @@ class DebugHistory(object):
         self._events: List[HistoryEvent] = []
         self._time_offset = 0
 
+    @property
+    def events(self) -> List[HistoryEvent]:
+        return self._events
+
     def extend_data(self, data: Sized):
         if len(self.data_buffer) + len(data) > self.data_buffer.maxlen:
             self._time_offset += len(data)
@@ -54,23 +69,25 @@ class DebugHistory(object):
 
         self._events.append(HistoryEvent(l_bound, u_bound, result))
 
-    def plot(self, env_history: np.ndarray = np.array([])):
-            time_axis = range(self._time_offset, self._time_offset + len(self.data_buffer))
-            plt.figure(figsize=(18, 10))
-            plt.plot(time_axis, np.array(self.data_buffer), 'b.-')
-            plt.axhline(y=12000)
-            plt.axhline(y=7000)
+    def snapshot(self, env_history: Iterable = (), thresholds: Tuple[float, float] = (12000, 7000)) -> dict:
+        """Arrays of the history snapshot rendered by DebugRenderer"""
+
+        events = [(event.start_idx, event.end_idx) for event in self._events if event.start_idx >= self._time_offset]
+        return {
+            "signal": np.array(self.data_buffer, np.float32),
+            "envelope": np.array(env_history, np.float32),
+            "events": np.array(events, np.int64).reshape(-1, 2),
+            "thresholds": np.array(thresholds, np.float64),
+            "time_offset": np.array(self._time_offset)
+        }
 
-            for event in self._events:
-                if event.start_idx >= self._time_offset:
-                    plt.axvspan(event.start_idx, event.end_idx, facecolor='#2ca02c', alpha=0.5)
+    def plot(self, renderer: DebugRenderer, env_history: Iterable = (),
+             thresholds: Tuple[float, float] = (12000, 7000), force: bool = False) -> bool:
+        """Passes the history snapshot to the renderer, unless it is rate limited"""
 
-            plt.plot(time_axis, np.array(env_history), 'r')
-            plt.tight_layout(rect=[0.02, 0.03, 1, 0.95])
-            plt.xlabel("Sample number", fontsize=20)
-            plt.ylabel("ADC value", fontsize=20)
-            plt.savefig("signal.png")
-            plt.show()
+        if not force and not renderer.ready("history"):
+            return False
+        return renderer.submit("history", force, **self.snapshot(env_history, thresholds))
 
 
 class SensorMatrix(object):
@@ -78,42 +95,242 @@ class SensorMatrix(object):
     class InvalidInput(Exception):
         pass
 
+    class LocalizationMode(Enum):
+        MLE = 0
+        GRID = 1
+        MLE_GRID_FALLBACK = 2
+
+    class GateMode(Enum):
+        SKIP = "skip"  # events failing the quality gate are not localized at all
+        WEIGHT = "weight"  # such events are localized, but reported as gated with their confidence weight
+
+    class LocalizationResult(NamedTuple):
+        """Outcome of single event, passed to on_result"""
+        timestamp: float
+        start_idx: int  # sample number of the event start within the whole stream
+        roots: List[np.ndarray]
+        root_idx: int  # index of the chosen root, by the tracker if enabled, 0 otherwise
+        tdoa: np.ndarray  # (N,) TDoAs [s] in relation to the first receiver
+        quality: TDoAQuality  # (N,) arrays, the first receiver holds values which always pass the gate
+        weight: float  # confidence of the weakest receiver pair in [0, 1], for weighted solvers
+        gated: bool  # True if the event failed the quality gate
+
     def __init__(self,
                  receiver_coords: List[Tuple[float, float, float]],
                  reference_rec_id: int = 0,
                  rec_buff_size: int = 4096 * 2,
                  sampling_freq: int = 41666,
                  data_chunk: int = 4096,
-                 debug: bool = False):
+                 debug: bool = False,
+                 cache_size: int = 0,
+                 cache_resolution: float = 1e-6,
+                 tracking: bool = False,
+                 constrain_lags: bool = False,
+                 dsp_backend: kernels.Backend = kernels.Backend.AUTO,
+                 prefilter: bool = False,
+                 multichannel_detection: bool = False,
+                 multires_tdoa: bool = False,
+                 event_log: str = None,
+                 dft_size: int = 512,
+                 release_factor: float = 0.9993,
+                 recognition_settings: dict = None,
+                 memory_profiling: bool = False,
+                 trace_allocations: bool = False):
 
         receivers: List[Receiver] = [Receiver(rec[0], rec[1], rec[2], buffer_size=rec_buff_size)
                                      for rec in receiver_coords]
+        # selects and warms up DSP kernels (envelope follower, moving averages), so JIT happens at startup
+        self.dsp_backend = kernels.select_backend(dsp_backend)
         debug_buff_size = 120 * data_chunk
-        self._sound_detector = SoundDetector(0.9993, debug_buff_size)
+        self._sound_detector = SoundDetector(release_factor, debug_buff_size)
+        self._multi_detector = MultiChannelDetector(len(receivers), release_factor) if multichannel_detection else None
         self._mle_calc = MLE(receivers, src_conditions=lambda src: 0 <= src[2] < 2.0, reference_rec_id=reference_rec_id)
-        self._data_chunk = 4096
-        self._dft = DFT(512, sampling_freq)
+        self._data_chunk = data_chunk
+        self._dft = DFT(dft_size, sampling_freq)
         self._rec_dft_buff = np.array([])
         self._serial_settings = {
             "channelNr": 4,
             "port": '/dev/ttyACM0',
             "baud": 2000000,
             "timeout": 1,
-            "resultSize_bytes": 2
+            "resultSize_bytes": 2,
+            "sampleFormat": SampleFormat.INT16.value,
+            "byteOrder": "little",
+            # framing of the driver built with SERIAL_FRAMING, sync word as hex string or None for raw samples
+            "syncWord": None,
+            "frameCounter": False
         }
         self._recognition_settings = {
             "lowSpectrum": 7000,
             "highSpectrum": 12000,
             "minPart": 0.05,
-            "noiseFloor": 5000
+            "noiseFloor": 5000,
+            "lagMargin": 2,
+            "onsetMargin": 64,
+            "coarseWindow": 1024,
+            "minUpperThreshold": 12000,
+            "minLowerThreshold": 7000,
+            # spectral check of detected events, band level [dB] relative to the event maximum and number of frames
+            "detectionDb": -32.0,
+            "minDetectionFrames": 3,
+            # upsampling of GCC-PHAT histograms for sub-sample delays
+            "interpolationFactor": 1,
+            # quality gate of GCC peaks applied to all receiver pairs, None disables particular condition
+            "minPeakToSidelobe": None,
+            "maxSecondPeakRatio": None,
+            "minNormalizedPeak": None,
+            "gateMode": "skip"
         }
+        if recognition_settings is not None:
+            unknown = set(recognition_settings) - set(self._recognition_settings)
+            if unknown:
+                raise SensorMatrix.InvalidInput("Unknown recognition settings: {}".format(", ".join(sorted(unknown))))
+            self._recognition_settings.update(recognition_settings)
+
+        # detector thresholds follow the background level of each channel, the settings above are their minimums
+        self.noise_floor = self._create_noise_floor()
+
+        # optional band-pass prefilter of the bounce band, its output is used only for TDoA estimation
+        self._prefilter: StreamingBandpass = None
+        self._filtered_buffers: List[SliceDeck] = []
+        if prefilter:
+            self._prefilter = StreamingBandpass(self._recognition_settings["lowSpectrum"],
+                                                self._recognition_settings["highSpectrum"],
+                                                self._serial_settings["channelNr"], sampling_freq)
+            self._filtered_buffers = [SliceDeck(maxlen=rec_buff_size) for _ in receivers]
+
+        # coarse to fine TDoA estimation on long windows, replaces single resolution GCC-PHAT when enabled
+        self.multires_tdoa: MultiResolutionTDoA = None
+        if multires_tdoa:
+            self.multires_tdoa = MultiResolutionTDoA(self._recognition_settings["coarseWindow"], sampling_freq,
+                                                     (self._recognition_settings["lowSpectrum"],
+                                                      self._recognition_settings["highSpectrum"]))
 
         self.debug = debug
+        # debug plots are rendered into files by background process, started with the localization
+        self.debug_renderer: DebugRenderer = DebugRenderer() if debug else None
+
+        # optional memoization of solver results, disabled when cache_size is 0
+        self.result_cache = ResultCache(cache_size, cache_resolution) if cache_size > 0 else None
+
+        # table driven localization, the grid is built on demand by enable_tdoa_grid and kept in the geometry snapshot
+        self._localization_mode = SensorMatrix.LocalizationMode.MLE
+        self._grid_ranges = None
+        self.grid_refinement = True
+
+        # guards the simulated source shared by all receivers, see simulate_wave_propagation
+        self._simulation_lock = threading.Lock()
+
+        # fuses successive bounces, resolves root ambiguity based on the trajectory
+        self.tracker = BounceTracker() if tracking else None
+        self._processed_samples = 0
+
+        # restricts GCC-PHAT peak search to delays allowed by the array geometry
+        self.constrain_lags = constrain_lags
+
+        # raw audio fan-out to other processes, the ring is created when acquisition starts
+        self.shared_ring: SharedAudioRing = None
+        self._shared_ring_settings = None
+
+        # aligns serial stream to whole frames, created when serial acquisition starts
+        self.frame_parser: FrameParser = None
+
+        # peak quality of the last calculated TDoAs, (N,) arrays for calculate_tdoa, (n, N) for the batch variant
+        self.tdoa_quality: TDoAQuality = None
+        self.gated_events = 0
+        # called with SensorMatrix.LocalizationResult of every localized event
+        self.on_result: Callable[['SensorMatrix.LocalizationResult'], None] = None
+        # columnar log of all results in the given directory, queried by analytics instead of parsing stdout
+        self.event_store: EventStore = EventStore(event_log, len(receivers)) if event_log else None
 
         self.debug_history = DebugHistory(data_chunk, debug_buff_size)
 
+        # sizes of buffers and caches sampled during localization, allocation sites too if tracing is enabled
+        self.memory_profiler: MemoryProfiler = None
+        if memory_profiling:
+            self.memory_profiler = MemoryProfiler(trace=trace_allocations)
+            self._register_memory_structures(self.memory_profiler)
+
+    def _register_memory_structures(self, profiler: MemoryProfiler) -> None:
+        profiler.register("receivers.dataBuffer", lambda: [rec.data_buffer for rec in self._mle_calc.receivers])
+        profiler.register("receivers.filteredBuffer", lambda: self._filtered_buffers)
+        profiler.register("debugHistory.dataBuffer", lambda: self.debug_history.data_buffer)
+        profiler.register("debugHistory.events", lambda: self.debug_history.events)
+        profiler.register("soundDetector.envHistory", lambda: self._sound_detector.env_history)
+        profiler.register("multiDetector", lambda: self._multi_detector)
+        profiler.register("noiseFloor", lambda: self.noise_floor)
+        profiler.register("resultCache", lambda: self.result_cache)
+        profiler.register("tdoaGrid", lambda: self._mle_calc.geometry.grid)
+        profiler.register("eventStore", lambda: self.event_store)
+        profiler.register("sharedRing", lambda: self.shared_ring)
+        profiler.register("frameParser", lambda: self.frame_parser)
+
+    def enable_shared_ring(self, name: str = None, capacity: int = 1 << 16) -> None:
+        """Publishes raw frames acquired by start_cont_localization into shared memory ring of the given name and
+           capacity(in frames), so that other processes can consume them with SharedAudioReader"""
+
+        self._shared_ring_settings = {"name": name, "capacity": capacity}
+
+    def _open_shared_ring(self) -> None:
+        if self._shared_ring_settings is None or self.shared_ring is not None:
+            return
+
+        self.shared_ring = SharedAudioRing.create(self._serial_settings["channelNr"],
+                                                  self._shared_ring_settings["capacity"],
+                                                  self.sample_format.dtype, self._shared_ring_settings["name"])
+
+    def close_shared_ring(self) -> None:
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+            self.shared_ring = None
+
+    @property
+    def sample_format(self) -> SampleFormat:
+        return SampleFormat(self._serial_settings["sampleFormat"])
+
+    def set_sample_format(self, sample_format: SampleFormat, byte_order: str = "little") -> None:
+        """Declares format of samples delivered by the input source, e.g. BITS_24 mode of the driver sends packed
+           3 byte samples"""
+
+        if byte_order not in ("little", "big"):
+            raise SensorMatrix.InvalidInput("Byte order should be 'little' or 'big', got {}".format(byte_order))
+
+        self._serial_settings["sampleFormat"] = SampleFormat(sample_format).value
+        self._serial_settings["byteOrder"] = byte_order
+        self._serial_settings["resultSize_bytes"] = SampleFormat(sample_format).size
+
+    def set_channel_nr(self, channel_nr: int) -> None:
+        """Declares number of channels delivered by the input source, per channel noise floor is recreated if it
+           changes"""
+
+        if channel_nr <= 0:
+            raise SensorMatrix.InvalidInput("Channel number must be positive, got {}".format(channel_nr))
+        if channel_nr == self._serial_settings["channelNr"]:
+            return
+
+        self._serial_settings["channelNr"] = channel_nr
+        self.noise_floor = self._create_noise_floor()
+
+    def _create_noise_floor(self) -> NoiseFloorEstimator:
+        return NoiseFloorEstimator(self._serial_settings["channelNr"],
+                                   min_upper=self._recognition_settings["minUpperThreshold"],
+                                   min_lower=self._recognition_settings["minLowerThreshold"])
+
+    def decode_frames(self, raw_data: bytes) -> np.ndarray:
+        """Decodes raw input into integer samples of whole frames, interleaved by channel"""
+
+        samples = decode_samples(raw_data, self.sample_format, self._serial_settings["byteOrder"])
+        return samples[:len(samples) - len(samples) % self._serial_settings["channelNr"]]
+
+    def _acquire(self, raw_data: bytes, idx: int = 0) -> None:
+        frames = self.decode_frames(raw_data)
+        if self.shared_ring is not None:
+            self.shared_ring.write(frames.reshape(-1, self._serial_settings["channelNr"]))
+        self.localize_frames(frames, idx)
+        if self.memory_profiler is not None:
+            self.memory_profiler.maybe_sample()
+
     def start_cont_localization(self, input_src: str = "serial", filename="input.wav"):
-        byte_count = self._serial_settings["channelNr"] * self._data_chunk * self._serial_settings["resultSize_bytes"]
         Receiver.isSimulation = False
 
         if input_src == "wav":
@@ -121,74 +338,275 @@ class SensorMatrix(object):
 
             with wave.open(filename, "rb") as wav:
                 self._dft.sampling_rate = wav.getframerate()
-                self._serial_settings["channelNr"] = wav.getnchannels()
+                if self._prefilter is not None:
+                    self._prefilter.sampling_rate = wav.getframerate()
+                if self.multires_tdoa is not None:
+                    self.multires_tdoa.sampling_rate = wav.getframerate()
+                self.set_channel_nr(wav.getnchannels())
+                self.set_sample_format(SampleFormat.from_sample_width(wav.getsampwidth()))
                 length = wav.getnframes() // self._data_chunk
-
-                for idx in range(0, length):
-                    input_bytes = wav.readframes(self._data_chunk)
-                    self.localize(input_bytes, idx)
-
-                if self.debug:
-                    self.debug_history.plot(self._sound_detector.env_history)
+                self._open_shared_ring()
+                if self.event_store is not None:
+                    self.event_store.begin_session()
+                try:
+                    if self.debug:
+                        self.debug_renderer.start()
+                    if self.memory_profiler is not None:
+                        self.memory_profiler.start()
+
+                    for idx in range(0, length):
+                        input_bytes = wav.readframes(self._data_chunk)
+                        self._acquire(input_bytes, idx)
+
+                    if self.debug:
+                        self.debug_history.plot(self.debug_renderer, self._sound_detector.env_history,
+                                                self.noise_floor.thresholds(0), force=True)
+                    if self.memory_profiler is not None:
+                        self.memory_profiler.stop()
+                finally:
+                    if self.debug:
+                        self.debug_renderer.stop()
+                    if self.event_store is not None:
+                        self.event_store.flush()
+                    self.close_shared_ring()
         else:
+            sync_word = self._serial_settings["syncWord"]
+            self.frame_parser = FrameParser(self._serial_settings["channelNr"], self.sample_format.size,
+                                            bytes.fromhex(sync_word) if sync_word else None,
+                                            self._serial_settings["frameCounter"])
+            byte_count = self._data_chunk * self.frame_parser.frame_size
+
             with serial.Serial(self._serial_settings["port"],
                                self._serial_settings["baud"],
                                timeout=self._serial_settings["timeout"]) as ser:
-                while ser.is_open:
-                    input_bytes = ser.read(byte_count)
-                    self.localize(input_bytes)
+                self._open_shared_ring()
+                if self.event_store is not None:
+                    self.event_store.begin_session()
+                try:
+                    if self.debug:
+                        self.debug_renderer.start()
+                    if self.memory_profiler is not None:
+                        self.memory_profiler.start()
+                    while ser.is_open:
+                        input_bytes = self.frame_parser.feed(ser.read(byte_count))
+                        self._acquire(input_bytes)
+                        if self.debug:
+                            self.debug_history.plot(self.debug_renderer, self._sound_detector.env_history,
+                                                    self.noise_floor.thresholds(0))
+                finally:
+                    if self.debug:
+                        self.debug_renderer.stop()
+                    if self.event_store is not None:
+                        self.event_store.flush()
+                    self.close_shared_ring()
 
     def localize(self, raw_data: bytes, idx: int = 0):
         """Performs the whole localization process: check for searched signal, and if it is found calculate the
         src position, returns true if it was detected and false otherwise(for statistics)"""
-        byte_len = len(raw_data)
-        frames: List[int] = struct.unpack("{}h".format(byte_len // self._serial_settings["resultSize_bytes"]),
-                                          raw_data)
+
+        self.localize_frames(self.decode_frames(raw_data), idx)
+
+    def localize_frames(self, frames: np.ndarray, idx: int = 0):
+        """Localization of already decoded interleaved samples, see localize"""
+
         recs = self._mle_calc.receivers
         energy = []
 
-        # Split data into separate channels
-        for ch_id in range(0, self._serial_settings["channelNr"]):
-            ch_data = np.array(frames[ch_id::self._serial_settings["channelNr"]], dtype=np.float32)
+        # Split data into separate channels, samples are expressed in 16-bit full scale units
+        channel_nr = self._serial_settings["channelNr"]
+        channels = np.array(frames[:len(frames) - len(frames) % channel_nr], dtype=np.float32)
+        if self.sample_format.scale != 1.0:
+            channels *= np.float32(self.sample_format.scale)
+        channels = channels.reshape(-1, channel_nr).T
+        new_samples = channels.shape[1]
+        # short reads (serial timeouts, frames held back by the parser) may bring no complete frame at all
+        if new_samples == 0:
+            return
+
+        buffered = len(recs[0].data_buffer)
+        for ch_id, ch_data in enumerate(channels):
             energy.append(sum(map(lambda x: x * x, ch_data)))
             recs[ch_id].data_buffer.extend(ch_data)
 
+        if self._prefilter is not None:
+            for buffer, ch_data in zip(self._filtered_buffers, self._prefilter.process(channels)):
+                buffer.extend(ch_data.astype(np.float32))
+
+        self.noise_floor.update(channels)
+        self._processed_samples += len(frames) // self._serial_settings["channelNr"]
+        # sample number of the first element in receiver buffers
+        buffer_start = self._processed_samples - len(recs[0].data_buffer)
+        # reads are not always whole chunks, the detectors scan only samples not seen before and move indexes they
+        # carry over by the number of samples pushed out of the buffers
+        data_offset = len(recs[0].data_buffer) - new_samples
+        shift = buffered + new_samples - len(recs[0].data_buffer)
+
         # claculate energy of all channels na choose the strongest
         strongest_idx: int = np.argmax(energy)
 
         if self.debug:
-            self.debug_history.extend_data(recs[strongest_idx].data_buffer[self._data_chunk::])
-
-        signal_buffer = recs[strongest_idx].data_buffer
-
-        self._sound_detector.detect_sound(signal_buffer, 12000, 7000, data_offset=self._data_chunk)
-
-        while len(self._sound_detector.events) > 0:
-            l_idx, h_idx, s_mic = self._sound_detector.events.pop()
-
-            is_event = self.is_event_detected(signal_buffer[l_idx: h_idx])
-
-            if is_event:
-                # find TdoA
-                self.calculate_tdoa(l_idx, h_idx)
-                # calculate src
-                res = self.estimate_src_position()
-                print("calculation result:{}".format(res))
-                self.debug_history.append_event(idx, l_idx, h_idx, res)
-                # send to server
+            self.debug_history.extend_data(recs[strongest_idx].data_buffer[data_offset::])
+
+        onsets = None
+        if self._multi_detector is not None:
+            # every channel is analysed with its own detector state, onsets of all channels are fused into one event
+            signals = np.array([np.asarray(rec.data_buffer, np.float32) for rec in recs])
+            fused = self._multi_detector.detect(signals, self.noise_floor.upper_thresholds,
+                                                self.noise_floor.lower_thresholds, data_offset, shift)
+            events = [(event.start_idx, event.end_idx, event.first_channel) for event in fused]
+            onsets = [event.onsets for event in fused]
+        else:
+            signal_buffer = recs[strongest_idx].data_buffer
+
+            upper_threshold, lower_threshold = self.noise_floor.thresholds(strongest_idx)
+            self._sound_detector.detect_sound(signal_buffer, upper_threshold, lower_threshold,
+                                              data_offset=data_offset, shift=shift)
+
+            # gather all events found in the chunk and process them as a batch, in time order
+            events = sorted(self._sound_detector.events, key=lambda event: event[0])
+            self._sound_detector.events.clear()
+            signals = np.asarray(signal_buffer, np.float32)[np.newaxis, :]
+
+        if len(events) == 0:
+            return
+
+        # spectral check is done on the channel, which detected the event (the strongest one in single channel mode)
+        is_event = self.detect_events([signals[s_mic if onsets is not None else 0, l_idx: h_idx]
+                                       for l_idx, h_idx, s_mic in events])
+        events = [event for event, detected in zip(events, is_event) if detected]
+        if onsets is not None:
+            onsets = [onset for onset, detected in zip(onsets, is_event) if detected]
+        if len(events) == 0:
+            return
+
+        timestamps = [(buffer_start + l_idx) / self._dft.sampling_rate for l_idx, h_idx, s_mic in events]
+        # find TdoA
+        tdoa = self.calculate_tdoa_batch([l_idx for l_idx, h_idx, s_mic in events], timestamps, onsets)
+        quality = self.tdoa_quality
+
+        # events with unreliable peaks (reflections, noise bursts) are not worth the solver time
+        passed = self.quality_gate(quality)
+        self.gated_events += int(np.count_nonzero(~passed))
+        if self.gate_mode == SensorMatrix.GateMode.SKIP:
+            kept = np.flatnonzero(passed)
+            events = [events[event_idx] for event_idx in kept]
+            timestamps = [timestamps[event_idx] for event_idx in kept]
+            tdoa = tdoa[kept]
+            quality = TDoAQuality(*(values[kept] for values in quality))
+            passed = passed[kept]
+            if len(events) == 0:
+                return
+
+        # calculate src
+        results = self.estimate_src_positions(tdoa)
+        weights = np.min(quality.normalized_peak, axis=1)
+
+        for event_idx, ((l_idx, h_idx, s_mic), timestamp, res) in enumerate(zip(events, timestamps, results)):
+            print("calculation result:{}".format(res))
+            root_idx = 0
+            if self.tracker is not None:
+                track = self.tracker.update(res, timestamp)
+                root_idx = track.root_idx
+                print("tracked position:{}, root: {}".format(track.position, track.root_idx))
+            self.debug_history.append_event(idx, l_idx, h_idx, res)
+            # send to server
+            if self.on_result is None and self.event_store is None:
+                continue
+            result = SensorMatrix.LocalizationResult(timestamp, buffer_start + l_idx, res, root_idx, tdoa[event_idx],
+                                                     TDoAQuality(*(values[event_idx] for values in quality)),
+                                                     float(weights[event_idx]), not passed[event_idx])
+            if self.event_store is not None:
+                self.event_store.append(result)
+            if self.on_result is not None:
+                self.on_result(result)
 
     def update_receiver_pos(self, positions: List[Tuple[float, float, float]], ref_id: int = 0):
         """Updates the spatial positions of all microphones connected to the array. If less than 4 new positions are
            provided, then only first few will be updated. If more than 4 values are provided it raises InvalidInput
-           Exception"""
+           Exception.
+
+           The new solver geometry together with the TDoA grid (if enabled) is computed and validated aside, then
+           swapped in at once, so events being localized meanwhile finish on the old geometry and grid. Invalid
+           geometry leaves the current one untouched"""
 
         if len(positions) > len(self._mle_calc.receivers):
             raise SensorMatrix.InvalidInput("Too large position array to update only 4 receiver location!")
 
-        for [idx, pos] in enumerate(positions):
-            self._mle_calc.receivers[idx].position = pos
-
-        self._mle_calc.ref_rec = ref_id
+        new_positions = np.array(self._mle_calc.geometry.positions)
+        new_positions[:len(positions)] = positions
+        try:
+            geometry = MLE.build_geometry(new_positions, ref_id)
+        except MLE.InvalidInput as ex:
+            raise SensorMatrix.InvalidInput("Receiver geometry rejected: {}".format(ex))
+
+        if self._grid_ranges is not None:
+            geometry = geometry._replace(grid=self._build_tdoa_grid(*self._grid_ranges, geometry=geometry))
+        self._mle_calc.set_geometry(geometry)
+
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+
+    @property
+    def geometry_version(self) -> Tuple[int, int]:
+        """Identifies current receiver geometry: receiver array version and the reference receiver id"""
+
+        return self._mle_calc.geometry.version
+
+    def lag_windows(self, timestamp: float = None, onsets: np.ndarray = None) -> List[Tuple[float, float]]:
+        """Returns lag windows [samples] for each receiver in relation to the first one. The windows are derived from
+           the array geometry and, if the tracker follows the ball, narrowed down to the predicted bounce region.
+           Per-channel onsets of the event (from multi-channel detection) narrow them down to the onset difference
+           +- onsetMargin"""
+
+        fs = self._dft.sampling_rate
+        margin = self._recognition_settings["lagMargin"]
+        # physical TDoA between receiver and the first one (reference in calculate_tdoa) is bounded by their
+        # distance divided by the speed of sound
+        max_tdoa = self._mle_calc.receiver_array.max_tdoa[0]
+        windows = [(-max_lag * fs - margin, max_lag * fs + margin) for max_lag in max_tdoa]
+
+        if self.tracker is not None and self.tracker.is_tracking and timestamp is not None \
+                and self._mle_calc.ref_idx == 0:
+            positions = self._mle_calc.receiver_array.positions
+            predicted = self.tracker.predicted_lag_window(positions, 0, timestamp, fs)
+            for rec_idx in range(1, len(windows)):
+                low = max(windows[rec_idx][0], predicted[rec_idx - 1][0] - margin)
+                high = min(windows[rec_idx][1], predicted[rec_idx - 1][1] + margin)
+                if low <= high:
+                    windows[rec_idx] = (low, high)
+
+        if onsets is not None and onsets[0] >= 0:
+            onset_margin = self._recognition_settings["onsetMargin"]
+            for rec_idx in range(1, len(windows)):
+                if onsets[rec_idx] < 0:
+                    continue
+                onset_lag = onsets[rec_idx] - onsets[0]
+                low = max(windows[rec_idx][0], onset_lag - onset_margin)
+                high = min(windows[rec_idx][1], onset_lag + onset_margin)
+                if low <= high:
+                    windows[rec_idx] = (low, high)
+
+        return windows
+
+    def enable_tdoa_grid(self, x_range: PerformanceTest.Range, y_range: PerformanceTest.Range,
+                         z_range: PerformanceTest.Range,
+                         mode: LocalizationMode = LocalizationMode.MLE_GRID_FALLBACK) -> None:
+        """Precomputes the TDoA lookup grid over the play area and switches localization mode. In GRID mode every
+           event is localized by grid lookup, in MLE_GRID_FALLBACK mode only when MLE result is degenerate or none of
+           its roots is plausible. The grid is rebuilt whenever receiver positions are updated"""
+
+        self._grid_ranges = (x_range, y_range, z_range)
+        geometry = self._mle_calc.geometry
+        self._mle_calc.set_geometry(geometry._replace(grid=self._build_tdoa_grid(x_range, y_range, z_range, geometry)))
+        self._localization_mode = mode
+
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+
+    def _build_tdoa_grid(self, x_range, y_range, z_range, geometry: MLE.Geometry = None) -> TDoAGrid:
+        if geometry is None:
+            geometry = self._mle_calc.geometry
+        return TDoAGrid(geometry.positions, x_range, y_range, z_range, reference_rec_id=geometry.ref_idx)
 
     def get_raw_data(self):
         pass
@@ -208,16 +626,56 @@ class SensorMatrix(object):
         pos_h = bisect_left(frequencies, self._recognition_settings["highSpectrum"])
 
         spec_slice = np.mean(spectrogram_db[pos_l:pos_h, :], axis=0)
-        bounce_idx = [idx for idx, el in enumerate(spec_slice) if el >= -32.0]
+        bounce_idx = [idx for idx, el in enumerate(spec_slice) if el >= self._recognition_settings["detectionDb"]]
 
-        if len(bounce_idx) >= 3:
+        if len(bounce_idx) >= self._recognition_settings["minDetectionFrames"]:
             return True
 
         return False
 
-    def calculate_tdoa(self, s_idx: int, e_idx: int):
+    def detect_events(self, sound_signals: List[np.ndarray]) -> np.ndarray:
+        """Batch counterpart of is_event_detected. Signals are zero padded to common length and the spectrograms of
+           all of them are computed at once, frames past the end of each signal are masked out, so the result is the
+           same as for separate calls. Returns array of detection flags"""
+
+        n_fft = 64
+        hop_length = n_fft // 4
+        lengths = np.array([len(signal) for signal in sound_signals])
+        batch = np.zeros((len(sound_signals), max(np.max(lengths), n_fft)), np.float32)
+        for row, signal in zip(batch, sound_signals):
+            row[:len(signal)] = signal
+
+        spectrogram = np.abs(librosa.stft(batch, n_fft=n_fft, hop_length=hop_length))
+        valid = np.arange(spectrogram.shape[-1]) < (1 + lengths // hop_length)[:, np.newaxis]
+
+        # amplitude_to_db with ref=np.max and top_db=80, evaluated per signal over its valid frames
+        amin, top_db = 1e-10, 80.0
+        power = np.square(spectrogram)
+        ref_power = np.max(np.where(valid[:, np.newaxis, :], power, 0), axis=(1, 2))
+        spectrogram_db = 10.0 * np.log10(np.maximum(amin, power))
+        spectrogram_db -= 10.0 * np.log10(np.maximum(amin, ref_power))[:, np.newaxis, np.newaxis]
+        db_max = np.max(np.where(valid[:, np.newaxis, :], spectrogram_db, -np.inf), axis=(1, 2))
+        spectrogram_db = np.maximum(spectrogram_db, (db_max - top_db)[:, np.newaxis, np.newaxis])
+
+        frequencies = np.linspace(0, 41666, 33)
+        pos_l = bisect_left(frequencies, self._recognition_settings["lowSpectrum"])
+        pos_h = bisect_left(frequencies, self._recognition_settings["highSpectrum"])
+
+        spec_slice = np.mean(spectrogram_db[:, pos_l:pos_h, :], axis=1)
+        return np.sum((spec_slice >= self._recognition_settings["detectionDb"]) & valid, axis=1) >= \
+            self._recognition_settings["minDetectionFrames"]
+
+    @property
+    def tdoa_buffers(self) -> List[SliceDeck]:
+        """Buffers the TDoA is estimated from, band-pass filtered ones if prefilter is enabled"""
+
+        if self._prefilter is not None:
+            return self._filtered_buffers
+        return [rec.data_buffer for rec in self._mle_calc.receivers]
+
+    def calculate_tdoa(self, s_idx: int, e_idx: int, timestamp: float = None):
         """Calculates TDoA between all receivers and reference one in the sensor matrix. Results are stored within
-           receiver object"""
+           receiver object. With constrain_lags set, only physically feasible delays are considered"""
 
         # extract bounce sound and its surrounding from rec buffers
         l_bound = s_idx - self._dft.dft_size + 1
@@ -229,46 +687,251 @@ class SensorMatrix(object):
         if u_bound >= len(self._mle_calc.receivers[0].data_buffer):
             u_bound = len(self._mle_calc.receivers[0].data_buffer)
 
-        bounce_data = [rec.data_buffer[l_bound: u_bound] for rec in self._mle_calc.receivers]
+        bounce_data = [buffer[l_bound: u_bound] for buffer in self.tdoa_buffers]
+        windows = self.lag_windows(timestamp) if self.constrain_lags else None
+        quality = np.array(self._reference_quality(len(self._mle_calc.receivers)))
+        delays, histograms = [], []
+        factor = self._recognition_settings["interpolationFactor"]
 
         for rec_idx in range(1, self._serial_settings["channelNr"]):
 
             delay, hist = gcc_phat(bounce_data[rec_idx], bounce_data[0], self._dft, phat=True,
-                                   delay_in_seconds=True, buffered_dft=False)
+                                   delay_in_seconds=False, buffered_dft=False, interpolation_factor=factor,
+                                   lag_window=windows[rec_idx] if windows else None)
+            quality[:, rec_idx] = np.ravel(peak_quality(hist, int(round((self._dft.size // 2 + delay) * factor)),
+                                                        exclusion=2 * factor))
+            delays.append(delay)
+            histograms.append(hist)
+            delay = delay / self._dft.sampling_rate
             self._mle_calc.receivers[rec_idx].tDoA = delay
+        self.tdoa_quality = TDoAQuality(*quality)
         if self.debug:
             print(delay)
-            plt.figure(figsize=(18, 10))
-            plt.subplot(311)
-            plt.plot(bounce_data[0], label="mic_1")
-            plt.plot(bounce_data[1], label="mic_2")
-            plt.legend()
-            plt.subplot(312)
-            plt.plot(bounce_data[0], label="mic_1")
-            plt.plot(bounce_data[2], label="mic_3")
-            plt.legend()
-            plt.subplot(313)
-            plt.plot(bounce_data[0], label="mic_1")
-            plt.plot(bounce_data[3], label="mic_4")
-            plt.xlabel("Sample number")
-            #plt.tight_layout(rect=[0.00, 0.03, 1, 0.95])
-            plt.legend()
-            plt.show()
-
-    def estimate_src_position(self) -> List[np.ndarray]:
-        r1 = self._mle_calc.calculate()
+            self._debug_tdoa_snapshot([np.asarray(data) for data in bounce_data], histograms, delays)
+
+    def calculate_tdoa_batch(self, start_indexes: List[int], timestamps: List[float] = None,
+                             onsets: List[np.ndarray] = None) -> np.ndarray:
+        """Batch counterpart of calculate_tdoa. Windows of all events are stacked into one array per receiver and
+           GCC-PHAT is performed for all of them at once. Returns (n, N) array of TDoAs(in seconds) of all receivers in
+           relation to the first one, receivers hold TDoAs of the last event, tdoa_quality the peak quality of all of
+           them. Optional per-channel onsets of events narrow down the lag search windows"""
+
+        recs = self._mle_calc.receivers
+        size = self._dft.size
+        buffers = np.array([np.asarray(buffer, np.float32) for buffer in self.tdoa_buffers])
+
+        windows = None
+        if self.constrain_lags:
+            if timestamps is None:
+                timestamps = [None] * len(start_indexes)
+            if onsets is None:
+                onsets = [None] * len(start_indexes)
+            windows = np.array([self.lag_windows(timestamp, onset) for timestamp, onset in zip(timestamps, onsets)],
+                               np.float64)
+
+        tdoa = np.zeros((len(start_indexes), len(recs)), np.float64)
+        quality = np.repeat(self._reference_quality(len(recs))[:, np.newaxis], len(start_indexes), axis=1)
+        if self.multires_tdoa is not None:
+            return self._calculate_tdoa_multires(buffers, start_indexes, windows, tdoa, quality)
+
+        # windows are zero padded at front, as they would be by DFT.transform
+        bounce_data = np.zeros((len(recs), len(start_indexes), size), np.float32)
+        for event_idx, s_idx in enumerate(start_indexes):
+            l_bound = max(s_idx - self._dft.dft_size + 1, 0)
+            u_bound = min(s_idx + self._dft.dft_size - 1, buffers.shape[1])
+            length = max(u_bound - l_bound, 0)
+            bounce_data[:, event_idx, size - length:] = buffers[:, l_bound: u_bound]
+
+        histograms = []
+        factor = self._recognition_settings["interpolationFactor"]
+        for rec_idx in range(1, self._serial_settings["channelNr"]):
+            delay, hist = gcc_phat(bounce_data[rec_idx], bounce_data[0], self._dft, phat=True,
+                                   delay_in_seconds=False, buffered_dft=False, interpolation_factor=factor,
+                                   lag_window=windows[:, rec_idx] if windows is not None else None)
+            quality[:, :, rec_idx] = peak_quality(hist, np.round((size // 2 + delay) * factor).astype(np.int64),
+                                                  exclusion=2 * factor)
+            tdoa[:, rec_idx] = delay / self._dft.sampling_rate
+            recs[rec_idx].tDoA = tdoa[-1, rec_idx]
+            histograms.append(hist[-1])
+
+        self.tdoa_quality = TDoAQuality(*quality)
+        if self.debug:
+            self._debug_tdoa_snapshot(bounce_data[:, -1], histograms, tdoa[-1, 1:] * self._dft.sampling_rate)
+        return tdoa
+
+    def _calculate_tdoa_multires(self, buffers: np.ndarray, start_indexes: List[int], lag_windows: np.ndarray,
+                                 tdoa: np.ndarray, quality: np.ndarray) -> np.ndarray:
+        """Coarse to fine variant of calculate_tdoa_batch, analysis windows of coarseWindow samples are centered at
+           event starts. Samples outside of the buffers are zeros"""
+
+        recs = self._mle_calc.receivers
+        coarse_size = self.multires_tdoa.size
+        starts = np.asarray(start_indexes, np.int64) - coarse_size // 2
+        idx = starts[:, np.newaxis] + np.arange(coarse_size)
+        in_buffer = (idx >= 0) & (idx < buffers.shape[1])
+        bounce_data = np.where(in_buffer, buffers[:, np.clip(idx, 0, buffers.shape[1] - 1)], 0.0)
+
+        for rec_idx in range(1, self._serial_settings["channelNr"]):
+            tdoa[:, rec_idx], pair_quality = self.multires_tdoa.estimate(
+                bounce_data[rec_idx], bounce_data[0],
+                lag_window=lag_windows[:, rec_idx] if lag_windows is not None else None, with_quality=True)
+            quality[:, :, rec_idx] = pair_quality
+            recs[rec_idx].tDoA = tdoa[-1, rec_idx]
+
+        self.tdoa_quality = TDoAQuality(*quality)
+        if self.debug:
+            self._debug_tdoa_snapshot(bounce_data[:, -1], None, tdoa[-1, 1:] * self.multires_tdoa.sampling_rate)
+        return tdoa
+
+    def _debug_tdoa_snapshot(self, windows: List[np.ndarray], histograms: List[np.ndarray] = None,
+                             delays: np.ndarray = None) -> None:
+        """Passes event windows of all receivers, their GCC histograms and delays [samples] to the debug renderer"""
+
+        if self.debug_renderer is None or not self.debug_renderer.ready("tdoa"):
+            return
+
+        arrays = {"windows": np.array(windows, np.float32), "delays": np.asarray(delays, np.float64)}
+        if histograms is not None:
+            arrays["histograms"] = np.array(histograms, np.float32)
+            arrays["interpolation"] = np.array(self._recognition_settings["interpolationFactor"])
+        self.debug_renderer.submit("tdoa", **arrays)
+
+    @staticmethod
+    def _reference_quality(rec_nr: int) -> np.ndarray:
+        """(3, N) TDoAQuality values, the reference receiver column holds ones which always pass the gate"""
+
+        quality = np.zeros((3, rec_nr), np.float64)
+        quality[:, 0] = (np.inf, 0.0, 1.0)
+        return quality
+
+    @property
+    def gate_mode(self) -> 'SensorMatrix.GateMode':
+        return SensorMatrix.GateMode(self._recognition_settings["gateMode"])
+
+    def quality_gate(self, quality: TDoAQuality = None) -> np.ndarray:
+        """Returns True for events(rows of (n, N) quality arrays, last calculated ones by default), whose GCC peaks
+           meet the quality conditions of the recognition settings for all receiver pairs"""
+
+        if quality is None:
+            quality = self.tdoa_quality
+        passed = np.ones(np.shape(quality.normalized_peak)[:-1], np.bool_)
+
+        min_psr = self._recognition_settings["minPeakToSidelobe"]
+        max_ratio = self._recognition_settings["maxSecondPeakRatio"]
+        min_peak = self._recognition_settings["minNormalizedPeak"]
+        if min_psr is not None:
+            passed &= np.all(quality.peak_to_sidelobe >= min_psr, axis=-1)
+        if max_ratio is not None:
+            passed &= np.all(quality.second_peak_ratio <= max_ratio, axis=-1)
+        if min_peak is not None:
+            passed &= np.all(quality.normalized_peak >= min_peak, axis=-1)
+        return passed
+
+    def current_tdoa(self, geometry: MLE.Geometry = None) -> np.ndarray:
+        """Returns TDoA vector(in seconds) of all receivers in relation to the reference one"""
+
+        return self._mle_calc.receiver_tdoa(geometry)
+
+    def estimate_src_position(self, geometry: MLE.Geometry = None, tdoa: np.ndarray = None) -> List[np.ndarray]:
+        """Localizes single event of (N-1,) TDoAs, those of the receivers by default. Solver, grid and cache key are
+           taken from one geometry snapshot, the current one unless given"""
+
+        if geometry is None:
+            geometry = self._mle_calc.geometry
+        if tdoa is None:
+            tdoa = self.current_tdoa(geometry)
+        if self.result_cache is None:
+            return self._solve_src_position(geometry, tdoa)
+
+        key = self.result_cache.make_key(geometry.version, tdoa)
+        roots = self.result_cache.get(key)
+        if roots is None:
+            roots = self._solve_src_position(geometry, tdoa)
+            self.result_cache.put(key, roots)
+        return roots
+
+    def estimate_src_positions(self, tdoa: np.ndarray, geometry: MLE.Geometry = None) -> List[List[np.ndarray]]:
+        """Batch counterpart of estimate_src_position for (n, N) array of TDoAs returned by calculate_tdoa_batch. Cached
+           results are reused, the remaining events are solved at once"""
+
+        # single geometry snapshot for the whole batch, even if receivers are recalibrated meanwhile
+        if geometry is None:
+            geometry = self._mle_calc.geometry
+        tdoa = tdoa[:, geometry.others]
+        results: List[List[np.ndarray]] = [None] * len(tdoa)
+        keys = [None] * len(tdoa)
+
+        if self.result_cache is not None:
+            for event_idx, event_tdoa in enumerate(tdoa):
+                keys[event_idx] = self.result_cache.make_key(geometry.version, event_tdoa)
+                results[event_idx] = self.result_cache.get(keys[event_idx])
+
+        missing = [event_idx for event_idx, res in enumerate(results) if res is None]
+        if len(missing) == 0:
+            return results
+
+        if self._localization_mode == SensorMatrix.LocalizationMode.GRID:
+            for event_idx in missing:
+                results[event_idx] = self._grid_src_position(geometry, tdoa[event_idx])
+        else:
+            batch = self._mle_calc.calculate_batch(tdoa[missing], geometry=geometry)
+            fallback = self._localization_mode == SensorMatrix.LocalizationMode.MLE_GRID_FALLBACK
+            for row, event_idx in enumerate(missing):
+                if fallback and (batch.degenerate[row] or not batch.plausible[row]):
+                    results[event_idx] = self._grid_src_position(geometry, tdoa[event_idx])
+                else:
+                    results[event_idx] = [batch.positions[row], batch.other_positions[row]]
+
+        if self.result_cache is not None:
+            for event_idx in missing:
+                self.result_cache.put(keys[event_idx], results[event_idx])
+
+        return results
+
+    def _solve_src_position(self, geometry: MLE.Geometry, tdoa: np.ndarray) -> List[np.ndarray]:
+        if self._localization_mode == SensorMatrix.LocalizationMode.GRID:
+            return self._grid_src_position(geometry, tdoa)
+
+        r1 = self._mle_calc.calculate(geometry=geometry, tdoa=tdoa)
         r2 = self._mle_calc.get_other_solution()
         r1 = np.squeeze(np.asarray(r1))
         r2 = np.squeeze(np.asarray(r2))
+
+        if self._localization_mode == SensorMatrix.LocalizationMode.MLE_GRID_FALLBACK and \
+                (self._mle_calc.is_degenerate or not self._mle_calc.roots_plausible):
+            return self._grid_src_position(geometry, tdoa)
+
         return [r1, r2]
 
+    def _grid_src_position(self, geometry: MLE.Geometry, tdoa: np.ndarray) -> List[np.ndarray]:
+        """Grid lookup yields single, unambiguous position, so it is returned as both roots. The grid is taken from
+           the geometry snapshot the TDoAs belong to"""
+
+        pos, residual = geometry.grid.locate(tdoa, refine=self.grid_refinement)
+        return [pos, np.copy(pos)]
+
     def simulate_wave_propagation(self, src_pos: Tuple[float, float, float]) -> List[np.ndarray]:
         """Simulates the propagation of the sound from given src points and based on time differences, recalculates
            the position of the sound"source. Returns both roots found during the process, with first one being chosen
             by the algorithm as the correct one"""
 
-        Receiver.set_source_position(src_pos)
-        Receiver.isSimulation = True
-        for rec in self._mle_calc.receivers:
-            rec.receive()
-        return self.estimate_src_position()
\ No newline at end of file
+        # TDoAs are simulated on the same geometry snapshot they are solved with, even if receivers are moved meanwhile
+        geometry = self._mle_calc.geometry
+        tdoa = MLE.simulated_tdoa(np.array([src_pos], np.float64), geometry)[0, geometry.others]
+
+        # simulated source and received times are shared by all receivers, requests of different clients may come
+        # from parallel threads
+        with self._simulation_lock:
+            Receiver.set_source_position(src_pos)
+            Receiver.isSimulation = True
+            for rec in self._mle_calc.receivers:
+                rec.receive()
+            return self.estimate_src_position(geometry, tdoa)
+
+    def simulate_batch(self, src_positions: np.ndarray) -> List[List[np.ndarray]]:
+        """Vectorized counterpart of simulate_wave_propagation for (n, 3) source positions. TDoAs are computed for all
+           sources at once, with the same rounding as simulated receivers use, and solved as a single batch"""
+
+        src_positions = np.asarray(src_positions, np.float64).reshape(-1, 3)
+        geometry = self._mle_calc.geometry
+        return self.estimate_src_positions(MLE.simulated_tdoa(src_positions, geometry), geometry)
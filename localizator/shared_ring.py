@@ -0,0 +1,208 @@
+import threading
+import types
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+
+class SharedAudioRing(object):
+    """Single writer ring buffer of multi-channel PCM frames placed in shared memory, so that the acquisition loop can
+       fan raw audio out to any number of consumer processes without copying it through pipes. Readers attach by
+       name, keep their own cursors and never lock the writer.
+
+       The segment starts with a header of int64 values followed by (capacity, channel_nr) frames. The writer first
+       announces the range it is going to overwrite (reserved cursor), copies the frames and then publishes them
+       (committed cursor). A reader copies frames up to the committed cursor and checks the reserved cursor
+       afterwards, if the writer got into the copied range meanwhile the read is reported as overrun"""
+
+    class InvalidInput(Exception):
+        pass
+
+    class Overrun(Exception):
+        def __init__(self, lost_frames: int):
+            super().__init__("Reader was overrun by the writer, {} frames lost".format(lost_frames))
+            self.lost_frames = lost_frames
+
+    # header layout (int64): magic, channel_nr, capacity, dtype itemsize, reserved cursor, committed cursor
+    _magic = 0x52494E47
+    _header_size = 8
+    _RESERVED = 4
+    _COMMITTED = 5
+
+    _dtypes = {2: np.int16, 4: np.int32}
+
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        self._memory = memory
+        self._owner = owner
+        self._header = np.ndarray((SharedAudioRing._header_size,), np.int64, memory.buf)
+
+        if self._header[0] != SharedAudioRing._magic:
+            raise SharedAudioRing.InvalidInput("Shared memory {} does not hold an audio ring".format(memory.name))
+
+        self.channel_nr = int(self._header[1])
+        self.capacity = int(self._header[2])
+        self.dtype = np.dtype(SharedAudioRing._dtypes[int(self._header[3])])
+        self._frames = np.ndarray((self.capacity, self.channel_nr), self.dtype, memory.buf,
+                                  offset=SharedAudioRing._header_size * 8)
+        # bytes of an incomplete frame, kept until the rest of it is written
+        self._carry = b""
+
+    @classmethod
+    def create(cls, channel_nr: int = 4, capacity: int = 1 << 16, dtype=np.int16,
+               name: Optional[str] = None) -> 'SharedAudioRing':
+        """Creates the shared segment for capacity frames, the creator is the only writer and owns the segment"""
+
+        dtype = np.dtype(dtype)
+        if channel_nr <= 0 or capacity <= 0:
+            raise SharedAudioRing.InvalidInput("Channel number and capacity must be positive")
+        if dtype.itemsize not in SharedAudioRing._dtypes or dtype.kind != "i":
+            raise SharedAudioRing.InvalidInput("Unsupported sample type {}".format(dtype))
+
+        size = SharedAudioRing._header_size * 8 + capacity * channel_nr * dtype.itemsize
+        memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((SharedAudioRing._header_size,), np.int64, memory.buf)
+        header[:] = 0
+        header[1:4] = (channel_nr, capacity, dtype.itemsize)
+        header[0] = SharedAudioRing._magic
+        del header
+        return cls(memory, owner=True)
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    @property
+    def cursor(self) -> int:
+        """Overall number of frames published by the writer"""
+
+        return int(self._header[SharedAudioRing._COMMITTED])
+
+    def write(self, frames: np.ndarray) -> int:
+        """Appends (n, channel_nr) frames and returns the new cursor"""
+
+        frames = np.asarray(frames, self.dtype).reshape(-1, self.channel_nr)
+        start = int(self._header[SharedAudioRing._COMMITTED])
+        end = start + len(frames)
+        self._header[SharedAudioRing._RESERVED] = end
+
+        # frames, which would be overwritten within the same call, are skipped, but still counted
+        if len(frames) > self.capacity:
+            start += len(frames) - self.capacity
+            frames = frames[-self.capacity:]
+
+        first = start % self.capacity
+        head = min(len(frames), self.capacity - first)
+        self._frames[first: first + head] = frames[:head]
+        self._frames[:len(frames) - head] = frames[head:]
+
+        self._header[SharedAudioRing._COMMITTED] = end
+        return end
+
+    def write_bytes(self, raw_data: bytes) -> int:
+        """Appends raw interleaved PCM in native byte order, incomplete trailing frame is kept for the next call"""
+
+        frame_bytes = self.channel_nr * self.dtype.itemsize
+        raw_data = self._carry + raw_data
+        complete = len(raw_data) - len(raw_data) % frame_bytes
+        self._carry = raw_data[complete:]
+        return self.write(np.frombuffer(raw_data[:complete], self.dtype))
+
+    def reader(self, from_oldest: bool = False) -> 'SharedAudioReader':
+        """Creates reader of this ring in the current process"""
+
+        return SharedAudioReader(self.name, from_oldest)
+
+    def close(self) -> None:
+        del self._frames, self._header
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_attach_lock = threading.Lock()
+_no_tracker = types.SimpleNamespace(register=lambda name, rtype: None, unregister=lambda name, rtype: None)
+
+
+def _attach_untracked(name: str) -> shared_memory.SharedMemory:
+    """Attaches existing segment without registering it with the resource tracker. Before Python 3.13 attached
+       segments are always registered and unlinked by the tracker at exit of the process, which destroys the segment
+       of the writer. Unregistering afterwards is not an option, forked processes share the tracker of the writer"""
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    with _attach_lock:
+        tracker = shared_memory.resource_tracker
+        shared_memory.resource_tracker = _no_tracker
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            shared_memory.resource_tracker = tracker
+
+
+class SharedAudioReader(object):
+    """Lock free reader of SharedAudioRing, usually living in another process. It keeps its own cursor, so multiple
+       readers consume the stream at their own pace. When the reader falls behind by more than the ring capacity,
+       the lost frames are counted, the cursor jumps to the oldest frame still available and Overrun is raised"""
+
+    def __init__(self, name: str, from_oldest: bool = False):
+        # the segment belongs to the writer, it should not be unlinked when the reader process exits
+        memory = _attach_untracked(name)
+        self._ring = SharedAudioRing(memory, owner=False)
+        self.channel_nr = self._ring.channel_nr
+        self.capacity = self._ring.capacity
+        self.lost_frames = 0
+
+        cursor = self._ring.cursor
+        self.cursor = max(cursor - self.capacity, 0) if from_oldest else cursor
+
+    @property
+    def available(self) -> int:
+        """Number of published frames not consumed by this reader yet"""
+
+        return self._ring.cursor - self.cursor
+
+    def read(self, max_frames: Optional[int] = None) -> np.ndarray:
+        """Returns copy of (n, channel_nr) frames published since the last read, at most max_frames of them"""
+
+        header = self._ring._header
+        committed = int(header[SharedAudioRing._COMMITTED])
+        self._check_overrun(committed)
+
+        end = committed if max_frames is None else min(committed, self.cursor + max_frames)
+        first = self.cursor % self.capacity
+        count = end - self.cursor
+        head = min(count, self.capacity - first)
+        frames = np.concatenate((self._ring._frames[first: first + head], self._ring._frames[:count - head]))
+
+        # the writer could have overwritten the copied range in the meantime
+        self._check_overrun(int(header[SharedAudioRing._RESERVED]))
+
+        self.cursor = end
+        return frames
+
+    def _check_overrun(self, writer_cursor: int) -> None:
+        oldest = writer_cursor - self.capacity
+        if self.cursor < oldest:
+            lost = oldest - self.cursor
+            self.lost_frames += lost
+            self.cursor = oldest
+            raise SharedAudioRing.Overrun(lost)
+
+    def close(self) -> None:
+        self._ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
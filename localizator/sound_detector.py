@@ -1,7 +1,9 @@
-from typing import Tuple, List
+from typing import Tuple, List, NamedTuple
 from collections import deque
 import numpy as np
 
+from localizator import kernels
+
 
 class SoundDetector:
     def __init__(self, release_factor: float, buffer_size: int):
@@ -15,27 +17,231 @@ class SoundDetector:
         self.env_history = deque(maxlen=buffer_size)
 
     def detect_sound(self, signal: np.ndarray, upper_treshold: float, lower_treshold:float,
-                     data_offset = 0, mic_id = 0):
+                     data_offset = 0, mic_id = 0, shift: int = None):
+        """Scans samples of the signal buffer from data_offset on, the earlier ones were seen in the previous call.
+           Shift is the number of samples pushed out of the front of the buffer since the previous call, by default
+           data_offset, as when the buffer advances by whole chunks"""
 
-        for idx in range(data_offset, len(signal)):
-            self.envelope *= self.release_factor
-            self.envelope = max(abs(signal[idx]), self.envelope)
-            self.env_history.append(self.envelope)
+        # start of an event still open is moved along with the buffer
+        shift = data_offset if shift is None else shift
+        if self.start_idx > 0:
+            self.start_idx = max(self.start_idx - shift, 0)
 
-            if self.envelope > upper_treshold and not self.is_above_threshold:
-                self.is_above_threshold = True
-                self.start_idx = idx
-                self.star_mic_id = mic_id
+        was_above = self.is_above_threshold
 
-            elif self.envelope <= lower_treshold and self.is_above_threshold:
-                self.is_above_threshold = False
-                self.end_idx = idx
-                self.events.append((self.start_idx, self.end_idx, self.star_mic_id))
-                self.reset_indexes()
+        # envelope follower and hysteresis run in the kernel selected in kernels module
+        envelopes, starts, ends, self.envelope, self.is_above_threshold, self.start_idx = \
+            kernels.envelope_hysteresis(np.asarray(signal), data_offset, self.envelope, self.release_factor,
+                                        upper_treshold, lower_treshold, self.is_above_threshold, self.start_idx)
+        self.env_history.extend(envelopes)
 
-        if self.start_idx > 0:
-            self.start_idx -= data_offset
+        for event_nr, (start_idx, end_idx) in enumerate(zip(starts, ends)):
+            # only the first event may have been started during previous call
+            start_mic = self.star_mic_id if event_nr == 0 and was_above else mic_id
+            self.events.append((int(start_idx), int(end_idx), start_mic))
+
+        if self.is_above_threshold and (len(starts) > 0 or not was_above):
+            self.star_mic_id = mic_id
 
     def reset_indexes(self):
         self.start_idx = -1
         self.end_idx = -1
+
+
+class MultiChannelDetector:
+    """Envelope follower with hysteresis run on all channels at once, each channel keeps its own envelope and
+       threshold state, so there is no discontinuity when the loudest channel changes between chunks. Intervals
+       detected on separate channels, which overlap in time (or are closer than fusion_gap samples), are fused into
+       a single event holding onset index of every channel. An event is held back while any channel overlapping it
+       is still above the threshold, unless it would fall out of the buffer with the next chunk"""
+
+    class Event(NamedTuple):
+        start_idx: int
+        end_idx: int
+        onsets: np.ndarray  # onset index of each channel, -1 for channels which did not trigger
+        first_channel: int
+
+    def __init__(self, channel_nr: int, release_factor: float, fusion_gap: int = 0):
+        self.channel_nr = channel_nr
+        self.release_factor = release_factor
+        self.fusion_gap = fusion_gap
+        self.envelope = np.zeros(channel_nr, np.float64)
+        self.is_above_threshold = np.zeros(channel_nr, np.bool_)
+        self.start_idx = np.full(channel_nr, -1, np.int64)
+        self.last_envelopes = np.zeros((channel_nr, 0), np.float64)
+        self._pending: List[Tuple[int, int, int]] = []
+
+    def reset(self):
+        self.envelope[:] = 0
+        self.is_above_threshold[:] = False
+        self.start_idx[:] = -1
+        self._pending.clear()
+
+    def detect(self, signals: np.ndarray, upper_thresholds: np.ndarray, lower_thresholds: np.ndarray,
+               data_offset: int = 0, shift: int = None) -> List["MultiChannelDetector.Event"]:
+        """Processes (channel_nr, n) buffers, of which samples before data_offset were already seen in the previous
+           call and shift samples were pushed out of their front since then (data_offset by default). Returns events
+           completed in this call, indexes refer to the given buffers"""
+
+        # indexes of held intervals and open events are moved along with the buffers
+        shift = data_offset if shift is None else shift
+        self._pending = [(s_idx - shift, e_idx - shift, ch) for s_idx, e_idx, ch in self._pending]
+        self.start_idx[self.is_above_threshold] = np.maximum(self.start_idx[self.is_above_threshold] - shift, 0)
+
+        self.last_envelopes, channels, starts, ends, self.envelope, self.is_above_threshold, self.start_idx = \
+            kernels.envelope_hysteresis_multi(signals, data_offset, self.envelope, self.release_factor,
+                                              upper_thresholds, lower_thresholds, self.is_above_threshold,
+                                              self.start_idx)
+
+        self._pending.extend(zip(starts.tolist(), ends.tolist(), channels.tolist()))
+        self._pending.sort()
+
+        events: List[MultiChannelDetector.Event] = []
+        held: List[Tuple[int, int, int]] = []
+        open_starts = self.start_idx[self.is_above_threshold]
+
+        for group in self._fuse(self._pending):
+            start = group[0][0]
+            end = max(interval[1] for interval in group)
+            overlaps_open = np.any(open_starts <= end + self.fusion_gap)
+
+            if overlaps_open and start - data_offset >= 0:
+                held.extend(group)
+                continue
+
+            onsets = np.full(self.channel_nr, -1, np.int64)
+            for s_idx, e_idx, ch in group:
+                if onsets[ch] < 0:
+                    onsets[ch] = s_idx
+            events.append(MultiChannelDetector.Event(start, end, onsets, group[0][2]))
+
+        self._pending = held
+        return events
+
+    def _fuse(self, intervals: List[Tuple[int, int, int]]) -> List[List[Tuple[int, int, int]]]:
+        """Groups intervals sorted by start index, which overlap or are closer than fusion_gap"""
+
+        groups = []
+        group_end = None
+        for interval in intervals:
+            if group_end is None or interval[0] > group_end + self.fusion_gap:
+                groups.append([])
+                group_end = interval[1]
+            groups[-1].append(interval)
+            group_end = max(group_end, interval[1])
+        return groups
+
+
+class NoiseFloorEstimator:
+    """Online estimate of the background level of every channel. Each processed block contributes its mean absolute
+       value and the noise floor is a low percentile of recent block levels, so bounces, which occupy only a small
+       fraction of blocks, do not raise it. Detection thresholds follow the floor scaled by the ratios, but never fall
+       below the configured minimums.
+
+       The percentile is tracked by stochastic approximation: every block moves the estimate up or down by a step
+       proportional to the typical deviation of levels from it, so an update costs O(1) regardless of the history
+       size, which sets how fast the floor adapts (about 1.5 history lengths to follow a change of the background).
+       The estimate starts from the exact percentile of the warm up blocks"""
+
+    class InvalidInput(Exception):
+        pass
+
+    # step of the tracker relative to the spread and the history, trades accuracy for speed of adaptation
+    _gain = 2.0
+
+    def __init__(self, channel_nr: int,
+                 history: int = 64,
+                 percentile: float = 20.0,
+                 upper_ratio: float = 12.0,
+                 lower_ratio: float = 7.0,
+                 min_upper: float = 12000,
+                 min_lower: float = 7000,
+                 warm_up: int = 8):
+
+        if channel_nr <= 0 or history <= 0:
+            raise NoiseFloorEstimator.InvalidInput("Channel number and history size must be positive")
+        if not 0 <= percentile <= 100:
+            raise NoiseFloorEstimator.InvalidInput("Percentile of {} is out of [0, 100] range".format(percentile))
+        if upper_ratio < lower_ratio or min_upper < min_lower:
+            raise NoiseFloorEstimator.InvalidInput("Upper threshold can not be lower than the lower one")
+
+        self.channel_nr = channel_nr
+        self.percentile = percentile
+        self.upper_ratio = upper_ratio
+        self.lower_ratio = lower_ratio
+        self.min_upper = min_upper
+        self.min_lower = min_lower
+        self.warm_up = min(warm_up, history)
+
+        self.history = history
+        self._warm_up_levels = np.zeros((max(self.warm_up, 1), channel_nr), np.float64)
+        self._count = 0
+        self._floor = np.zeros(channel_nr, np.float64)
+        # mean absolute deviation of block levels from the floor, scales steps of the tracker
+        self._spread = np.zeros(channel_nr, np.float64)
+
+    def reset(self):
+        self._count = 0
+        self._floor[:] = 0
+        self._spread[:] = 0
+
+    def update(self, blocks: np.ndarray) -> np.ndarray:
+        """Consumes (channel_nr, n) block of samples and returns the updated noise floor of each channel"""
+
+        blocks = np.asarray(blocks)
+        if blocks.ndim != 2 or blocks.shape[0] != self.channel_nr:
+            raise NoiseFloorEstimator.InvalidInput("Expected ({}, n) block, got {}".format(self.channel_nr,
+                                                                                          blocks.shape))
+        if blocks.shape[1] == 0:
+            return self.floor
+
+        levels = np.mean(np.abs(blocks), axis=1, dtype=np.float64)
+        if self._count < len(self._warm_up_levels):
+            self._warm_up_levels[self._count] = levels
+            seen = self._warm_up_levels[:self._count + 1]
+            self._floor = np.percentile(seen, self.percentile, axis=0)
+            self._spread = np.mean(np.abs(seen - self._floor), axis=0)
+        else:
+            # outliers (bounces) are clipped, so that they do not inflate the step
+            deviation = np.minimum(np.abs(levels - self._floor), 4 * self._spread)
+            self._spread += (deviation - self._spread) / self.history
+            quantile = self.percentile / 100
+            step = self._gain * self._spread / self.history / max(np.sqrt(quantile * (1 - quantile)), 1e-3)
+            self._floor = np.maximum(self._floor + step * (quantile - (levels < self._floor)), 0)
+
+        self._count = min(self._count + 1, self.history)
+        return self.floor
+
+    @property
+    def is_warmed_up(self) -> bool:
+        return self._count >= self.warm_up
+
+    @property
+    def floor(self) -> np.ndarray:
+        return self._floor.copy()
+
+    @property
+    def upper_thresholds(self) -> np.ndarray:
+        if not self.is_warmed_up:
+            return np.full(self.channel_nr, float(self.min_upper))
+        return np.maximum(self._floor * self.upper_ratio, self.min_upper)
+
+    @property
+    def lower_thresholds(self) -> np.ndarray:
+        if not self.is_warmed_up:
+            return np.full(self.channel_nr, float(self.min_lower))
+        return np.maximum(self._floor * self.lower_ratio, self.min_lower)
+
+    def thresholds(self, channel: int) -> Tuple[float, float]:
+        """Returns (upper, lower) hysteresis thresholds for the given channel"""
+
+        return float(self.upper_thresholds[channel]), float(self.lower_thresholds[channel])
+
+    @property
+    def estimates(self) -> dict:
+        return {
+            "floor": self._floor.tolist(),
+            "upper": self.upper_thresholds.tolist(),
+            "lower": self.lower_thresholds.tolist(),
+            "blocks": self._count
+        }
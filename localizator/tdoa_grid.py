@@ -0,0 +1,90 @@
+from typing import Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from localizator.MLE import PerformanceTest
+from localizator.receiver import Receiver
+
+
+class TDoAGrid(object):
+    """Table driven localization. For every point of a 3-D grid over the play area the expected TDoA vector (in
+       relation to the reference receiver) is precomputed and stored in KD-tree. Localization of the event is then
+       a nearest neighbour lookup, optionally refined by a few Gauss-Newton iterations on range differences.
+       The latency of the lookup is bounded and it does not suffer from the degenerate cases of the closed form MLE"""
+
+    class InvalidInput(Exception):
+        pass
+
+    def __init__(self,
+                 rec_positions: np.ndarray,
+                 x_range: PerformanceTest.Range,
+                 y_range: PerformanceTest.Range,
+                 z_range: PerformanceTest.Range,
+                 reference_rec_id: int = 0):
+
+        rec_positions = np.asarray(rec_positions, np.float64)
+        if rec_positions.ndim != 2 or rec_positions.shape[1] != 3:
+            raise TDoAGrid.InvalidInput("Receiver positions should be of (N, 3) shape, got {}"
+                                        .format(rec_positions.shape))
+
+        if not 0 <= reference_rec_id < len(rec_positions):
+            raise TDoAGrid.InvalidInput("Reference receiver id of {} is invalid!".format(reference_rec_id))
+
+        self._rec_positions = rec_positions
+        self._ref_idx = reference_rec_id
+        self._others = [idx for idx in range(len(rec_positions)) if idx != reference_rec_id]
+
+        axes = [PerformanceTest.Range(*r).expand_to_pts() for r in (x_range, y_range, z_range)]
+        self.cell_size = np.array([PerformanceTest.Range(*r).step for r in (x_range, y_range, z_range)], np.float64)
+        self.points = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        # the tree is built over range differences (in meters), which are better conditioned than seconds
+        self._tree = cKDTree(self.range_differences(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def range_differences(self, src_positions: np.ndarray) -> np.ndarray:
+        """Returns (M, N-1) matrix of range differences between each receiver and the reference one for given
+           (M, 3) source positions"""
+
+        dist = np.linalg.norm(src_positions[:, np.newaxis, :] - self._rec_positions[np.newaxis, :, :], axis=2)
+        return dist[:, self._others] - dist[:, [self._ref_idx]]
+
+    def locate(self, tdoa: np.ndarray, refine: bool = True, iterations: int = 5) -> Tuple[np.ndarray, float]:
+        """Finds the grid point, whose expected TDoA vector(in seconds) is closest to the measured one and refines it
+           if requested. Returns the position and the range difference residual [m]"""
+
+        measured = np.asarray(tdoa, np.float64) * Receiver.c
+        residual, idx = self._tree.query(measured)
+        position = np.copy(self.points[idx])
+
+        if refine:
+            refined, refined_residual = self._refine(position, measured, iterations)
+            if refined_residual < residual:
+                return refined, refined_residual
+
+        return position, residual
+
+    def _refine(self, position: np.ndarray, measured: np.ndarray, iterations: int) -> Tuple[np.ndarray, float]:
+        """Gauss-Newton iterations on range difference equations, a single step is limited to the grid cell size"""
+
+        ref_pos = self._rec_positions[self._ref_idx]
+        others = self._rec_positions[self._others]
+
+        for _ in range(iterations):
+            to_others = position - others
+            to_ref = position - ref_pos
+            d_others = np.linalg.norm(to_others, axis=1)
+            d_ref = np.linalg.norm(to_ref)
+            if d_ref == 0 or np.any(d_others == 0):
+                break
+
+            err = d_others - d_ref - measured
+            jacobian = to_others / d_others[:, np.newaxis] - to_ref / d_ref
+            step = np.linalg.lstsq(jacobian, -err, rcond=None)[0]
+            position = position + np.clip(step, -self.cell_size, self.cell_size)
+
+        residual = np.linalg.norm(self.range_differences(position[np.newaxis, :])[0] - measured)
+        return position, residual
@@ -0,0 +1,136 @@
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from localizator.receiver import Receiver
+
+
+class TrackUpdate(NamedTuple):
+    root_idx: int
+    position: np.ndarray
+    gated: bool
+
+
+class BounceTracker(object):
+    """Constant velocity Kalman filter fusing successive bounce positions. Each localization yields two roots, the
+       one closer to the predicted position (in terms of Mahalanobis distance) is chosen and fused into the track.
+       Measurements outside of the gate are rejected, after max_misses consecutive rejections or when the time gap
+       between events exceeds max_gap the track is restarted from the root chosen by the localization algorithm"""
+
+    class NoTrack(Exception):
+        pass
+
+    # chi-square 99% quantile for 3 degrees of freedom
+    default_gate: float = 11.34
+
+    def __init__(self,
+                 measurement_std: float = 0.05,
+                 acceleration_std: float = 20.0,
+                 initial_velocity_std: float = 5.0,
+                 gate: float = default_gate,
+                 max_gap: float = 2.0,
+                 max_misses: int = 2):
+
+        self.measurement_std = measurement_std
+        self.acceleration_std = acceleration_std
+        self.initial_velocity_std = initial_velocity_std
+        self.gate = gate
+        self.max_gap = max_gap
+        self.max_misses = max_misses
+
+        self._state: np.ndarray = None  # [x, y, z, vx, vy, vz]
+        self._covariance: np.ndarray = None
+        self._timestamp = 0.0
+        self._misses = 0
+        self._h = np.hstack((np.eye(3), np.zeros((3, 3))))
+        self._r = np.eye(3) * measurement_std ** 2
+
+    @property
+    def is_tracking(self) -> bool:
+        return self._state is not None
+
+    @property
+    def position(self) -> np.ndarray:
+        return None if self._state is None else self._state[0:3].copy()
+
+    @property
+    def velocity(self) -> np.ndarray:
+        return None if self._state is None else self._state[3:6].copy()
+
+    def reset(self) -> None:
+        self._state = None
+        self._covariance = None
+        self._misses = 0
+
+    def _transition(self, dt: float) -> Tuple[np.ndarray, np.ndarray]:
+        f = np.eye(6)
+        f[0:3, 3:6] = np.eye(3) * dt
+        q = self.acceleration_std ** 2 * np.block([[np.eye(3) * dt ** 3 / 3, np.eye(3) * dt ** 2 / 2],
+                                                   [np.eye(3) * dt ** 2 / 2, np.eye(3) * dt]])
+        return f, q
+
+    def predict(self, timestamp: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns predicted state and its covariance for the given time, the track itself is not altered"""
+
+        if self._state is None:
+            raise BounceTracker.NoTrack("No track to predict from")
+
+        f, q = self._transition(max(timestamp - self._timestamp, 0.0))
+        return f @ self._state, f @ self._covariance @ f.T + q
+
+    def predicted_region(self, timestamp: float, n_sigma: float = 3.0) -> Tuple[np.ndarray, float]:
+        """Returns center and radius of the sphere in which the next bounce is expected"""
+
+        state, cov = self.predict(timestamp)
+        radius = n_sigma * np.sqrt(np.max(np.linalg.eigvalsh(cov[0:3, 0:3] + self._r)))
+        return state[0:3], radius
+
+    def predicted_lag_window(self, rec_positions: np.ndarray, ref_idx: int, timestamp: float, sampling_rate: float,
+                             n_sigma: float = 3.0) -> np.ndarray:
+        """Converts predicted bounce region into (N-1, 2) array of lag bounds [samples] for each receiver in relation
+           to the reference one. Each distance may change at most by the region radius, so range difference by
+           twice of it"""
+
+        center, radius = self.predicted_region(timestamp, n_sigma)
+        dist = np.linalg.norm(np.asarray(rec_positions, np.float64) - center, axis=1)
+        others = [idx for idx in range(len(dist)) if idx != ref_idx]
+        range_diff = dist[others] - dist[ref_idx]
+        bounds = np.stack((range_diff - 2 * radius, range_diff + 2 * radius), axis=1)
+        return bounds / Receiver.c * sampling_rate
+
+    def update(self, roots: List[np.ndarray], timestamp: float) -> TrackUpdate:
+        """Consumes [r1, r2] roots of single event, with first one being the choice of the localization algorithm.
+           Returns index of the root consistent with the track, filtered position and gating flag"""
+
+        roots = [np.asarray(root, np.float64).flatten() for root in roots]
+
+        if self._state is None or timestamp - self._timestamp > self.max_gap:
+            self._start(roots[0], timestamp)
+            return TrackUpdate(0, roots[0], False)
+
+        state, cov = self.predict(timestamp)
+        s = self._h @ cov @ self._h.T + self._r
+        s_inv = np.linalg.inv(s)
+        innovations = [root - state[0:3] for root in roots]
+        distances = [float(inn @ s_inv @ inn) for inn in innovations]
+        root_idx = int(np.argmin(distances))
+
+        if distances[root_idx] > self.gate:
+            self._misses += 1
+            if self._misses > self.max_misses:
+                self._start(roots[0], timestamp)
+                return TrackUpdate(0, roots[0], False)
+            return TrackUpdate(root_idx, state[0:3], True)
+
+        gain = cov @ self._h.T @ s_inv
+        self._state = state + gain @ innovations[root_idx]
+        self._covariance = (np.eye(6) - gain @ self._h) @ cov
+        self._timestamp = timestamp
+        self._misses = 0
+        return TrackUpdate(root_idx, self._state[0:3].copy(), False)
+
+    def _start(self, position: np.ndarray, timestamp: float) -> None:
+        self._state = np.concatenate((position, np.zeros(3)))
+        self._covariance = np.diag([self.measurement_std ** 2] * 3 + [self.initial_velocity_std ** 2] * 3)
+        self._timestamp = timestamp
+        self._misses = 0
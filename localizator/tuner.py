@@ -0,0 +1,250 @@
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, NamedTuple, Dict, Sequence, Optional
+
+import numpy as np
+
+
+class DSPTuner(object):
+    """Searches DSP parameters of SensorMatrix over recorded wav sessions. Every configuration is run on all sessions
+       in parallel processes and scored by detection accuracy (F1 score of detected events matched to labelled ones
+       within tolerance, mean position error if labels hold positions) and by compute cost, CPU seconds spent per
+       second of audio. The Pareto front of accuracy against cost allows to pick the cheapest configuration meeting
+       the accuracy target of a venue.
+
+       Sessions without labels are scored against detections of the reference configuration (defaults of
+       SensorMatrix, unless given), so cheaper configurations are judged by how well they reproduce it.
+
+       Worker processes are warmed up before the first trial. Cost of a run is the minimum over repeats, as timing
+       noise only ever adds to it"""
+
+    class InvalidInput(Exception):
+        pass
+
+    # tunable parameters, constructor arguments of SensorMatrix followed by its recognition settings
+    matrix_params = ("dft_size", "data_chunk", "release_factor")
+    recognition_params = ("minUpperThreshold", "minLowerThreshold", "detectionDb", "minDetectionFrames",
+                          "interpolationFactor", "lowSpectrum", "highSpectrum")
+
+    class Session(NamedTuple):
+        wav: str
+        timestamps: Optional[np.ndarray] = None  # (n,) labelled event times [s]
+        positions: Optional[np.ndarray] = None  # (n, 3) labelled bounce positions
+
+        @staticmethod
+        def load(wav: str, labels: str = None) -> 'DSPTuner.Session':
+            """Labels are .npy or text (.csv) file with rows: timestamp[, x, y, z]"""
+
+            if labels is None:
+                return DSPTuner.Session(wav)
+
+            rows = np.load(labels) if labels.endswith(".npy") else np.loadtxt(labels, delimiter=",", ndmin=2)
+            rows = np.atleast_2d(np.asarray(rows, np.float64))
+            return DSPTuner.Session(wav, rows[:, 0], rows[:, 1:4] if rows.shape[1] >= 4 else None)
+
+    class Trial(NamedTuple):
+        params: Dict
+        precision: float
+        recall: float
+        f1: float
+        position_error: float  # mean error of matched events [m], nan without labelled positions
+        cost: float  # CPU seconds per second of audio
+
+    def __init__(self, receiver_coords: List[Tuple[float, float, float]], sessions: List['DSPTuner.Session'],
+                 tolerance: float = 0.02, workers: int = None, reference: Dict = None, repeats: int = 1):
+        if len(sessions) == 0:
+            raise DSPTuner.InvalidInput("At least one session is needed")
+        if repeats <= 0:
+            raise DSPTuner.InvalidInput("Number of repeats must be positive")
+
+        self.receiver_coords = list(receiver_coords)
+        self.sessions = list(sessions)
+        self.tolerance = tolerance
+        self.workers = workers
+        self.reference = dict(reference or {})
+        self.repeats = repeats
+        self._references: Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def grid(space: Dict[str, Sequence]) -> List[Dict]:
+        """All combinations of the given parameter values"""
+
+        DSPTuner._check_params(space)
+        names = list(space)
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+    @staticmethod
+    def random(space: Dict[str, Sequence], count: int, seed: int = 0) -> List[Dict]:
+        """Random configurations, parameters given as (low, high) tuple are drawn uniformly (integers for integer
+           bounds), lists are sampled as discrete choices"""
+
+        DSPTuner._check_params(space)
+        rng = np.random.RandomState(seed)
+        configs = []
+        for _ in range(count):
+            config = {}
+            for name, values in space.items():
+                if isinstance(values, tuple) and len(values) == 2:
+                    if all(isinstance(value, (int, np.integer)) for value in values):
+                        config[name] = int(rng.randint(values[0], values[1] + 1))
+                    else:
+                        config[name] = float(rng.uniform(*values))
+                else:
+                    config[name] = values[rng.randint(len(values))]
+            configs.append(config)
+        return configs
+
+    @staticmethod
+    def _check_params(space: Dict) -> None:
+        unknown = set(space) - set(DSPTuner.matrix_params) - set(DSPTuner.recognition_params)
+        if unknown:
+            raise DSPTuner.InvalidInput("Unknown parameters: {}".format(", ".join(sorted(unknown))))
+
+    def evaluate(self, configs: List[Dict]) -> List['DSPTuner.Trial']:
+        """Runs all configurations on all sessions in a process pool and scores them"""
+
+        # workers are warmed up first, so that one-off costs of a fresh process are not charged to the first trials
+        with ProcessPoolExecutor(self.workers, initializer=_warm_up,
+                                 initargs=(self.receiver_coords, self.sessions[0].wav)) as pool:
+            unlabelled = [session for session in self.sessions if session.timestamps is None and
+                          session.wav not in self._references]
+            runs = pool.map(_run_session, [self.receiver_coords] * len(unlabelled), [self.reference] * len(unlabelled),
+                            [session.wav for session in unlabelled])
+            for session, (timestamps, positions, cpu_time, duration) in zip(unlabelled, runs):
+                self._references[session.wav] = timestamps
+
+            jobs = [(config, session) for config in configs for session in self.sessions]
+            runs = list(pool.map(_run_session, [self.receiver_coords] * len(jobs),
+                                 [config for config, session in jobs], [session.wav for config, session in jobs],
+                                 [self.repeats] * len(jobs)))
+
+        trials = []
+        for config_idx, config in enumerate(configs):
+            session_runs = runs[config_idx * len(self.sessions): (config_idx + 1) * len(self.sessions)]
+            trials.append(self._score(config, session_runs))
+        return trials
+
+    def _score(self, config: Dict, runs: List[Tuple]) -> 'DSPTuner.Trial':
+        matched, detected, labelled = 0, 0, 0
+        errors = []
+        cpu_time, duration = 0.0, 0.0
+
+        for session, (timestamps, positions, run_cpu_time, run_duration) in zip(self.sessions, runs):
+            expected = session.timestamps if session.timestamps is not None else self._references[session.wav]
+            pairs = match_events(expected, timestamps, self.tolerance)
+            matched += len(pairs)
+            detected += len(timestamps)
+            labelled += len(expected)
+            if session.positions is not None and len(pairs) > 0:
+                errors.extend(np.linalg.norm(positions[pairs[:, 1]] - session.positions[pairs[:, 0]], axis=1))
+            cpu_time += run_cpu_time
+            duration += run_duration
+
+        precision = matched / detected if detected > 0 else 0.0
+        recall = matched / labelled if labelled > 0 else 1.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        position_error = float(np.nanmean(errors)) if len(errors) > 0 else float("nan")
+        return DSPTuner.Trial(config, precision, recall, f1, position_error, cpu_time / duration)
+
+    @staticmethod
+    def pareto_front(trials: List['DSPTuner.Trial'], accuracy: str = "f1") -> List['DSPTuner.Trial']:
+        """Trials not dominated by any other one in both accuracy (higher is better, or lower for position_error)
+           and cost, sorted by cost"""
+
+        sign = -1.0 if accuracy == "position_error" else 1.0
+        front = []
+        best = -np.inf
+        for trial in sorted(trials, key=lambda t: (t.cost, -sign * getattr(t, accuracy))):
+            score = sign * getattr(trial, accuracy)
+            if score > best:
+                front.append(trial)
+                best = score
+        return front
+
+    @staticmethod
+    def cheapest(trials: List['DSPTuner.Trial'], target: float, accuracy: str = "f1") -> Optional['DSPTuner.Trial']:
+        """The cheapest trial meeting the accuracy target, None if there is no such"""
+
+        if accuracy == "position_error":
+            feasible = [trial for trial in trials if trial.position_error <= target]
+        else:
+            feasible = [trial for trial in trials if getattr(trial, accuracy) >= target]
+        return min(feasible, key=lambda trial: trial.cost) if feasible else None
+
+
+def match_events(expected: np.ndarray, detected: np.ndarray, tolerance: float) -> np.ndarray:
+    """One to one matching of detected event times to expected ones in time order, returns (m, 2) array of index
+       pairs (expected, detected) closer than tolerance"""
+
+    pairs = []
+    detected_idx = 0
+    for expected_idx, timestamp in enumerate(np.asarray(expected, np.float64)):
+        while detected_idx < len(detected) and detected[detected_idx] < timestamp - tolerance:
+            detected_idx += 1
+        if detected_idx < len(detected) and abs(detected[detected_idx] - timestamp) <= tolerance:
+            pairs.append((expected_idx, detected_idx))
+            detected_idx += 1
+    return np.array(pairs, np.int64).reshape(-1, 2)
+
+
+def _warm_up(receiver_coords: List[Tuple[float, float, float]], wav_path: str, frames: int = 16 * 4096) -> None:
+    """Initializer of worker processes, localizes the beginning of a session once, so that imports, JIT compilation
+       of DSP kernels and caches filled by the first run do not inflate the measured cost of a trial"""
+
+    with wave.open(wav_path, "rb") as wav, tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "warm_up.wav")
+        with wave.open(path, "wb") as head:
+            head.setparams(wav.getparams())
+            head.writeframes(wav.readframes(frames))
+        _run_session(receiver_coords, {}, path)
+
+
+def _run_session(receiver_coords: List[Tuple[float, float, float]], params: Dict, wav_path: str,
+                 repeats: int = 1) -> Tuple[np.ndarray, np.ndarray, float, float]:
+    """Localizes the whole session with given parameters, returns timestamps and chosen positions of the events,
+       CPU time of the processing (the least of repeated runs) and duration of the audio"""
+
+    from localizator.sensor_matrix import SensorMatrix
+
+    matrix_params = {name: params[name] for name in DSPTuner.matrix_params if name in params}
+    data_chunk = matrix_params.get("data_chunk", 4096)
+
+    with wave.open(wav_path, "rb") as wav:
+        duration = wav.getnframes() / wav.getframerate()
+
+    cpu_time = np.inf
+    for _ in range(repeats):
+        matrix = SensorMatrix(receiver_coords, rec_buff_size=2 * data_chunk, **matrix_params,
+                              recognition_settings={name: params[name] for name in DSPTuner.recognition_params
+                                                    if name in params})
+        results = []
+        matrix.on_result = results.append
+
+        start = time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            matrix.start_cont_localization(input_src="wav", filename=os.fspath(wav_path))
+        cpu_time = min(cpu_time, time.process_time() - start)
+
+    timestamps = np.array([result.timestamp for result in results], np.float64)
+    positions = np.array([np.asarray(result.roots[result.root_idx], np.float64).reshape(3) for result in results],
+                         np.float64).reshape(-1, 3)
+    return timestamps, positions, cpu_time, duration
+
+
+def __test_tuner():
+    coords = [(0.0, 0.0, 0.72), (0.0, 1.11, 1.0), (1.15, 1.11, 0.72), (1.14, 0.0, 0.72)]
+    sessions = [DSPTuner.Session("samples/finalTest{}.wav".format(idx)) for idx in range(1, 5)]
+    tuner = DSPTuner(coords, sessions)
+    trials = tuner.evaluate(DSPTuner.grid({"dft_size": [256, 512], "release_factor": [0.999, 0.9993],
+                                           "minDetectionFrames": [2, 3]}))
+    for trial in DSPTuner.pareto_front(trials):
+        print(trial)
+    print(DSPTuner.cheapest(trials, 0.9))
+
+# __test_tuner()
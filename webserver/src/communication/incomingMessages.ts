@@ -3,8 +3,14 @@
 export enum IncomingMessageTypes {
     Connect = "Connect",
     Simulate = "Simulate",
+    SimulateBatch = "SimulateBatch",
     Settings = "Settings",
     Result = "Result",
+    SimulateBatchResult = "SimulateBatchResult",
+    Progress = "Progress",
+    GetStats = "GetStats",
+    Stats = "Stats",
+    ClientClosed = "ClientClosed",
     Error = "Error"
 }
 
@@ -17,6 +23,8 @@ export enum ClientTypes {
 export abstract class IncomingMessage {
     type: IncomingMessageTypes
     html?: String;
+    // set by the server on requests forwarded to workers, identifies the originating client
+    clientId?: number;
 }
 
 export class ConnectMessage extends IncomingMessage {
@@ -39,6 +47,40 @@ export class SimulateMessage extends IncomingMessage {
     }
 }
 
+export interface AxisRange {
+    start: number;
+    stop: number;
+    step: number;
+}
+
+export interface GridSpec {
+    x: AxisRange;
+    y: AxisRange;
+    z: AxisRange;
+}
+
+export class SimulateBatchMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.SimulateBatch;
+    batchId: string | number;
+    sources?: Array<SoundSource>;
+    grid?: GridSpec;
+    chunkSize?: number;
+
+    constructor(batchId: string | number, sources?: Array<SoundSource>, grid?: GridSpec, chunkSize?: number) {
+        super();
+        this.batchId = batchId;
+        if (sources) {
+            this.sources = sources;
+        }
+        if (grid) {
+            this.grid = grid;
+        }
+        if (chunkSize) {
+            this.chunkSize = chunkSize;
+        }
+    }
+}
+
 export class SettingsMessage extends IncomingMessage {
     type: IncomingMessageTypes = IncomingMessageTypes.Settings;
     receivers: Array<Receiver>;
@@ -59,6 +101,39 @@ export class ResultMessage extends IncomingMessage {
     chosenRootId: number;
 }
 
+export class SimulateBatchResultMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.SimulateBatchResult;
+    batchId: string | number;
+    offset: number;
+    results: Array<{ roots: Array<SoundSource>, chosenRootId: number }>;
+}
+
+export class ProgressMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.Progress;
+    batchId: string | number;
+    done: number;
+    total: number;
+}
+
+export class GetStatsMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.GetStats;
+}
+
+export class StatsMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.Stats;
+    stats: { [section: string]: any };
+}
+
+export class ClientClosedMessage extends IncomingMessage {
+    type: IncomingMessageTypes = IncomingMessageTypes.ClientClosed;
+    clientId: number;
+
+    constructor(clientId: number) {
+        super();
+        this.clientId = clientId;
+    }
+}
+
 export class ErrorMessage extends IncomingMessage {
     type: IncomingMessageTypes = IncomingMessageTypes.Error;
     msg: string;
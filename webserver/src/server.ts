@@ -2,11 +2,12 @@ import * as express from 'express';
 import * as WebSocket from 'ws';
 import * as http from 'http';
 import * as path from 'path';
-import { ClientTypes, IncomingMessage, IncomingMessageTypes, ConnectMessage, ResultMessage, SettingsMessage } from './communication/incomingMessages';
+import { ClientTypes, IncomingMessage, IncomingMessageTypes, ConnectMessage, ResultMessage, SettingsMessage, ClientClosedMessage } from './communication/incomingMessages';
 import { ErrorMessage, ErrorTypes } from './communication/errorMessages';
 
 class ExtWebSocket extends WebSocket {
     public clientType: ClientTypes = ClientTypes.NotDefined;
+    public clientId: number;
     public isAlive: boolean;
 }
 
@@ -41,12 +42,20 @@ app.use((err: any, req: express.Request, res: express.Response, next: express.Ne
     res.status(500).send(`Error: \r\n${err}`);
 });
 
+// requests are forwarded to workers with the id of the originating client, so that workers limit concurrency per client
+let nextClientId = 0;
+function fromClient(message: IncomingMessage, ws: ExtWebSocket): string {
+    message.clientId = ws.clientId;
+    return JSON.stringify(message);
+}
+
 const server = http.createServer(app);
 const wsServer: ExtWebSocketServer = new ExtWebSocketServer({ server });
 //server.on('upgrade', wsServer.handleUpgrade);
 
 wsServer.on('connection', (ws: ExtWebSocket) => {
     console.log("Registered new connection");
+    ws.clientId = nextClientId++;
     ws.isAlive = true;
     ws.on('pong', () => {
         ws.isAlive = true;
@@ -56,6 +65,12 @@ wsServer.on('connection', (ws: ExtWebSocket) => {
 
     });
 
+    ws.on('close', () => {
+        if (ws.clientType == ClientTypes.GUI) {
+            wsServer.sendTo(ClientTypes.Worker, JSON.stringify(new ClientClosedMessage(ws.clientId)));
+        }
+    });
+
     ws.on('message', (message: string) => {
         console.log(`received: %s`, message);
         let incTask: IncomingMessage
@@ -77,10 +92,21 @@ wsServer.on('connection', (ws: ExtWebSocket) => {
                 wsServer.sendTo(ClientTypes.GUI, message);
                 break;
             case IncomingMessageTypes.Settings:
-                wsServer.sendTo(ClientTypes.Worker, message);
+                wsServer.sendTo(ClientTypes.Worker, fromClient(incTask, ws));
                 break;
             case IncomingMessageTypes.Simulate:
-                wsServer.sendTo(ClientTypes.Worker, message);
+                wsServer.sendTo(ClientTypes.Worker, fromClient(incTask, ws));
+                break;
+            case IncomingMessageTypes.SimulateBatch:
+                wsServer.sendTo(ClientTypes.Worker, fromClient(incTask, ws));
+                break;
+            case IncomingMessageTypes.GetStats:
+                wsServer.sendTo(ClientTypes.Worker, fromClient(incTask, ws));
+                break;
+            case IncomingMessageTypes.SimulateBatchResult:
+            case IncomingMessageTypes.Progress:
+            case IncomingMessageTypes.Stats:
+                wsServer.sendTo(ClientTypes.GUI, message);
                 break;
             case IncomingMessageTypes.Error:
                 if (ws.clientType == ClientTypes.Worker) {